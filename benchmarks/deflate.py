@@ -0,0 +1,90 @@
+"""
+Compare the bytes sent and the CPU time spent compressing for each event broadcast to a room, with permessage-deflate
+off, with uvicorn's default settings (each connection keeping its own compressor), with the same per-connection
+compressors at the smaller window and memory settings necsus uses, and with the 'shared' mode, where each message is
+compressed once for all the websockets it goes to (see necsus/compression.py).
+
+Only the compression is measured, not the websocket writes. Run from the repository root with:
+
+    python -m benchmarks.deflate
+"""
+import time
+
+from websockets.extensions.permessage_deflate import (
+    ClientPerMessageDeflateFactory,
+    ServerPerMessageDeflateFactory,
+)
+from websockets.frames import Frame, Opcode
+
+from necsus.broker import encode_event
+from necsus.compression import deflate_factory
+
+SUBSCRIBERS = 100
+ROUNDS = 20
+
+
+def frames(round: int) -> list[bytes]:
+    """The encoded events of one round of a quiz: a user's answer, and the bot's next question and scoreboard."""
+    user_message = {
+        'id': 2 * round, 'room': 'room', 'author': f'Student {round % 7}', 'kind': 'user', 'when': f'2024-01-15 04:{round:02}:32',
+        'text': f'quizbot the answer is option {round % 4}', 'image': None, 'media': None, 'js': None, 'css': None,
+        'from_bot': None, 'base_url': None, 'state': None,
+    }
+    bot_reply = {
+        'id': 2 * round + 1, 'room': 'room', 'author': 'Quiz Bot', 'kind': 'bot', 'when': f'2024-01-15 04:{round:02}:33',
+        'text': (
+            f'<div class="quiz"><h3>Question {round + 1} of {ROUNDS}</h3><p>What is {round} times {round + 3}?</p><form>'
+            + ''.join(f'<label><input type="radio" name="answer" value="{i}"> {round * (round + 3) + i - 1}</label><br>' for i in range(4))
+            + '<button type="submit">Answer</button></form><table>'
+            + ''.join(f'<tr><td>Player {i}</td><td>{(i * 7 + round * 3) % 50} points</td></tr>' for i in range(40))
+            + '</table></div>'
+        ),
+        'image': None, 'media': None, 'js': 'https://bot.example.com/static/quiz.js', 'css': 'https://bot.example.com/static/quiz.css',
+        'from_bot': 12, 'base_url': 'https://bot.example.com/quiz', 'state': f'{{"question": {round + 1}}}',
+    }
+    return [encode_event('message', user_message).encode(), encode_event('message', bot_reply).encode()]
+
+
+ROUNDS_FRAMES = [frames(round) for round in range(ROUNDS)]
+
+SETTINGS = {
+    'off': None,
+    'uvicorn default': ServerPerMessageDeflateFactory(),
+    'context': deflate_factory('context'),
+    'shared': deflate_factory('shared'),
+}
+
+
+def connect(factory: ServerPerMessageDeflateFactory):
+    """Negotiate permessage-deflate as a browser would, returning the server's side of the extension."""
+    client_factory = ClientPerMessageDeflateFactory(client_max_window_bits=True)
+    _, extension = factory.process_request_params(client_factory.get_request_params(), [])
+    return extension
+
+
+def broadcast(factory) -> tuple[float, float]:
+    """Return the bytes sent to each subscriber, and the CPU seconds spent, for each event broadcast."""
+    extensions = [connect(factory) if factory is not None else None for _ in range(SUBSCRIBERS)]
+    sent = 0
+
+    start = time.process_time()
+    for round_frames in ROUNDS_FRAMES:
+        for data in round_frames:
+            for extension in extensions:
+                frame = Frame(Opcode.TEXT, data)
+                sent += len((extension.encode(frame) if extension is not None else frame).data)
+    events = sum(map(len, ROUNDS_FRAMES))
+    return sent / events / SUBSCRIBERS, (time.process_time() - start) / events
+
+
+def main():
+    sizes = [len(data) for round_frames in ROUNDS_FRAMES for data in round_frames]
+    print(f"Average event of {sum(sizes) / len(sizes):.0f} bytes, sent to {SUBSCRIBERS} websockets\n")
+    print(f"{'settings':>16} {'bytes per websocket':>20} {'CPU per broadcast (us)':>23}")
+    for name, factory in SETTINGS.items():
+        sent, seconds = broadcast(factory)
+        print(f"{name:>16} {sent:>20.0f} {seconds * 1e6:>23.1f}")
+
+
+if __name__ == '__main__':
+    main()
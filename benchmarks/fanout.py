@@ -0,0 +1,64 @@
+"""
+Compare the CPU cost of fanning a message out to every websocket in a room, encoding the event once per subscriber
+(as WebSocket.send_json() did), against the Broker's encoding it once and sharing the encoded frame through the
+room log.
+
+Only the queueing (or logging) and encoding is measured, not the websocket writes. Run from the repository root with:
+
+    python -m benchmarks.fanout
+"""
+import json
+import time
+
+import anyio
+
+from necsus.broker import Broker
+
+MESSAGES = 200
+MESSAGE = {
+    'id': 123456, 'room': 'room', 'author': 'Some Bot', 'kind': 'bot', 'when': '2024-01-15 04:12:33',
+    'text': '<p>Here is a longer reply from a bot, of the kind which is fairly common: ' + 'lorem ipsum ' * 40 + '</p>',
+    'image': None, 'media': None, 'js': None, 'css': None, 'from_bot': 12, 'base_url': 'http://bot/reply', 'state': None,
+}
+
+
+def per_subscriber(subscribers: int) -> float:
+    """Queue the same event dict for every subscriber, and encode it once per subscriber as it is sent."""
+    streams = [anyio.create_memory_object_stream(max_buffer_size=float('inf')) for _ in range(subscribers)]
+
+    start = time.perf_counter()
+    for _ in range(MESSAGES):
+        event = {'kind': 'message', 'data': MESSAGE}
+        for send, _ in streams:
+            send.send_nowait(event)
+        for _, recv in streams:
+            json.dumps(recv.receive_nowait(), separators=(",", ":"), ensure_ascii=False)
+    return (time.perf_counter() - start) / MESSAGES
+
+
+def shared_frame(subscribers: int) -> float:
+    """Publish through the Broker, which encodes once and appends the frame to the room log each subscriber reads."""
+    broker = Broker(log_size=MESSAGES)
+
+    async def publish():
+        subscriptions = [broker.subscribe('room', since_id=-1, init_bots=[]) for _ in range(subscribers)]
+        start = time.perf_counter()
+        for _ in range(MESSAGES):
+            await broker.publish_message('room', MESSAGE)
+            for subscription in subscriptions:
+                subscription.poll()
+        return time.perf_counter() - start
+
+    return anyio.run(publish) / MESSAGES
+
+
+def main():
+    print(f"{'subscribers':>12} {'per subscriber (us)':>20} {'shared (us)':>12} {'speedup':>8}")
+    for subscribers in [1, 10, 50, 100, 300, 1000]:
+        old = per_subscriber(subscribers)
+        new = shared_frame(subscribers)
+        print(f"{subscribers:>12} {old * 1e6:>20.1f} {new * 1e6:>12.1f} {old / new:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
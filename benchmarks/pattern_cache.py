@@ -0,0 +1,54 @@
+"""
+Compare the cost of matching a message against every bot in a room, using raw pattern strings with regex.search()
+(relying on the regex module's own small cache), against the Matcher's cache of compiled patterns.
+
+Messages are spread over many rooms, so that the total number of distinct patterns is much larger than the regex
+module's cache. Run from the repository root with:
+
+    python -m benchmarks.pattern_cache
+"""
+import itertools
+import time
+
+import regex
+
+from necsus.matching import BOT_PATTERN_FLAGS, Matcher
+
+ROOMS = 300
+MESSAGES = 2000
+TEXT = 'hello there, does anyone know how to make my bot reply with an image?'
+
+
+def room_patterns(bots_per_room: int):
+    return [
+        [rf'(?:hello|hi|hey)\s+bot{room}x{bot}\b(?P<rest>.*)' for bot in range(bots_per_room)]
+        for room in range(ROOMS)
+    ]
+
+
+def time_per_message(search, rooms) -> float:
+    # Warm up by visiting every room once, so that the steady state is measured.
+    for patterns in rooms:
+        for pattern in patterns:
+            search(pattern)
+
+    start = time.perf_counter()
+    for patterns in itertools.islice(itertools.cycle(rooms), MESSAGES):
+        for pattern in patterns:
+            search(pattern)
+    return (time.perf_counter() - start) / MESSAGES
+
+
+def main():
+    print(f"{'bots/room':>10} {'regex.search (us)':>18} {'Matcher (us)':>13} {'speedup':>8}")
+    for bots_per_room in [1, 5, 10, 25, 50, 100]:
+        rooms = room_patterns(bots_per_room)
+        matcher = Matcher(max_patterns=ROOMS * bots_per_room)
+
+        raw = time_per_message(lambda pattern: regex.search(pattern, TEXT, flags=BOT_PATTERN_FLAGS, timeout=0.01), rooms)
+        cached = time_per_message(lambda pattern: matcher.compile(pattern).search(TEXT, timeout=0.01), rooms)
+        print(f"{bots_per_room:>10} {raw * 1e6:>18.1f} {cached * 1e6:>13.1f} {raw / cached:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Compare the per-call cost of the database's most common queries, building each query with pypika and inlining its
+values into the SQL (as necsus.db used to), against the cached parameterised SQL that necsus.db now uses.
+
+Both run against the same in-memory database, so the difference is the Python-side query building plus sqlite3
+having to re-prepare a statement whose text changes with every value. Run from the repository root with:
+
+    python -m benchmarks.statements
+"""
+import time
+
+from pypika import Order, Query, Table
+
+from necsus.db import DB
+from necsus.server import create_db_connection
+
+CALLS = 5000
+ROOMS = 50
+
+
+def pypika_find_bots(db: DB, i: int):
+    bots = Table('bots')
+    q = Query.from_(bots).select('*').where(bots.room == f'room{i % ROOMS}')
+    return db._connection.execute(q.get_sql()).fetchall()
+
+
+def pypika_since(db: DB, i: int):
+    messages = Table('messages')
+    q = Query.from_(messages).select('*').where(messages.room == f'room{i % ROOMS}').where(messages.id > i).orderby('id', order=Order.asc)
+    return db._connection.execute(q.get_sql()).fetchall()
+
+
+def pypika_insert(db: DB, i: int):
+    messages = Table('messages')
+    q = Query.into(messages).columns('room', 'author', 'text', 'when').insert(f'room{i % ROOMS}', 'User', f'Message {i}', time.time())
+    db._connection.execute(q.get_sql())
+
+
+def prepared_find_bots(db: DB, i: int):
+    return db.bots.find_all(room=f'room{i % ROOMS}')
+
+
+def prepared_since(db: DB, i: int):
+    return db.messages.since(f'room{i % ROOMS}', i)
+
+
+def prepared_insert(db: DB, i: int):
+    # Not db.messages.add(), which also returns the row and updates the room state.
+    db._connection.execute('INSERT INTO "messages" ("room", "author", "text", "when") VALUES (?, ?, ?, ?)', (f'room{i % ROOMS}', 'User', f'Message {i}', time.time()))
+
+
+def time_per_call(query, db: DB) -> float:
+    start = time.perf_counter()
+    for i in range(CALLS):
+        query(db, i)
+    return (time.perf_counter() - start) / CALLS
+
+
+def main():
+    db = DB(create_db_connection(':memory:'), autocommit=False)
+    for i in range(200):
+        db.bots.add(room=f'room{i % ROOMS}', name=f'Bot{i}', url=f'http://bot/{i}')
+
+    print(f"{'query':>10} {'pypika (us)':>12} {'prepared (us)':>14} {'speedup':>8}")
+    for name, pypika_query, prepared_query in [
+        ('insert', pypika_insert, prepared_insert),
+        ('find bots', pypika_find_bots, prepared_find_bots),
+        ('since', pypika_since, prepared_since),
+    ]:
+        old = time_per_call(pypika_query, db)
+        new = time_per_call(prepared_query, db)
+        print(f"{name:>10} {old * 1e6:>12.1f} {new * 1e6:>14.1f} {old / new:>7.1f}x")
+
+
+if __name__ == '__main__':
+    main()
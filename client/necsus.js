@@ -38,6 +38,8 @@ let Necsus = new Vue({
     replyToBotName: undefined,
     websocketConnected: false,  // UI indicator.
     websocketRetries: 0,        // Used for exponential backoff on reconnects.
+    olderMessagesPossible: false,  // On first connecting we only get the latest messages, and may need to fetch more.
+    loadingOlderMessages: false,
     lectureMode: false,         // Hide room name during lectures
 
     messageListeners: new Map(),  // Maps user-installed functions to lists of yet-to-be-processed messages.
@@ -267,7 +269,6 @@ let Necsus = new Vue({
       this.clearRoomShow = false;
       this.clearRoomConfirm = "";
     },
-    // Now unused
     fetchBots: async function() {
       let response = await fetch('/api/bots?' + new URLSearchParams({room: this.room}));
       let bots = await response.json();
@@ -358,9 +359,31 @@ let Necsus = new Vue({
       this.messagesById.set(message.id, message)
       this.enqueueMessageIdForListeners(message.id)
     },
+    /** Fetch a page of messages from before the earliest one we have, and put them at the start of the list. */
+    loadOlderMessages: async function() {
+      if (this.messages.length == 0 || this.loadingOlderMessages)
+        return
+      this.loadingOlderMessages = true
+
+      try {
+        let before = this.messages[0].id
+        let response = await fetch('/api/messages?' + new URLSearchParams({room: this.room, before: before, limit: 100}))
+        let older = (await response.json()).filter((message) => !this.messagesById.has(message.id))
+        for (let message of older)
+          this.messagesById.set(message.id, message)
+        this.messages.unshift(...older)
+        this.toPostprocessMessages.push(...older)
+        this.olderMessagesPossible = response.headers.has('X-Next-Cursor')
+      } finally {
+        this.loadingOlderMessages = false
+      }
+    },
     createWebsocket: function() {
       let last_id = (this.lastMessage) ? this.lastMessage.id : -1
-      let ws_uri = `${location.protocol == 'https:' ? 'wss:' : 'ws:'}//${location.host}/ws/${this.room}?since=${last_id}`
+      // Connecting without a since id gets only the latest messages from the server.
+      if (last_id == -1)
+        this.olderMessagesPossible = true
+      let ws_uri = `${location.protocol == 'https:' ? 'wss:' : 'ws:'}//${location.host}/ws/${this.room}` + ((last_id == -1) ? '' : `?since=${last_id}`)
       console.log(`Connecting to websocket ... (${ws_uri})`)
       let ws = new WebSocket(ws_uri)
       this.ws = ws
@@ -383,8 +406,11 @@ let Necsus = new Vue({
         else if (response.kind == 'clear_messages') {
           this.messages = []
           this.messagesById = new Map()
+          this.olderMessagesPossible = false
           Necsus.clearListenerQueues()
         }
+        else if (response.kind == 'resync')
+          this.resync(response.data.cleared)
       }
 
       ws.onerror = (e) => {
@@ -396,12 +422,36 @@ let Necsus = new Vue({
       // without getting crushed by a zillion coordinated requests.
       ws.onclose = (e) => {
         this.websocketConnected = false
-        this.websocketRetries += 1
+        // The server closes with code 4000 when we fell too far behind: we can reconnect and catch up straight away.
+        if (e.code == 4000)
+          this.websocketRetries = 0
+        else
+          this.websocketRetries += 1
         let retryTime = 500 * Math.pow(2, this.websocketRetries) * (1 + Math.random())
         console.log(`Websocket closed, will retry after ${retryTime} ms`)
         setTimeout(() => this.createWebsocket(), retryTime)
       }
     },
+    // The server skipped some events because we fell too far behind: load any messages we missed (all of them, if the
+    // room was cleared in the meantime), and the current bots. Messages can arrive over the websocket while this is
+    // happening, so skip those we already have and put the rest back in order.
+    resync: async function(cleared) {
+      if (cleared) {
+        this.messages = []
+        this.messagesById = new Map()
+        this.clearListenerQueues()
+      }
+
+      let since = (this.lastMessage) ? this.lastMessage.id : -1
+      let response = await fetch('/api/messages?' + new URLSearchParams({room: this.room, since: since}))
+      for (let message of await response.json()) {
+        if (!this.messagesById.has(message.id))
+          this.insertMessage(message)
+      }
+      this.messages.sort((a, b) => a.id - b.id)
+
+      await this.fetchBots()
+    },
     // Kick the websocket off for a few seconds to simulate a disconnect (for testing purposes).
     // This can be done by double-clicking the connected/disconnected status indicator in the UI.
     kickWebSocket: function() {
@@ -1,16 +1,32 @@
+import multiprocessing
+import os
+import pathlib
+import time
+
 import uvicorn
+from uvicorn.supervisors import Multiprocess
+
+from . import compression, hub
+from .server import BASE_DIR
+from .server import config as necsus_config
 
-from .server import app
+# NECSUS_WORKERS sets the number of worker processes. Each worker runs its own event loop, so more than one lets the
+# server use more than one CPU core. The workers then share events through a hub process (see necsus/hub.py).
+workers = necsus_config.get('WORKERS', int, 1)
 
 config = uvicorn.Config(
-    app=app,
+    app='necsus.server:app',
     host='localhost',
     port=6277,
 
-    # We are running an async framework, with uvloop as the backing event loop.
-    # As a result, we need only one process and one thread.
+    # We are running an async framework, with uvloop as the backing event loop. One process is enough for many
+    # concurrent requests, but each process only uses one core.
     loop='uvloop',
-    workers=1,
+    workers=workers,
+
+    # Websocket frames are compressed with settings chosen for sending the same events to many websockets at once
+    # (see necsus/compression.py), rather than uvicorn's defaults.
+    ws=compression.WebSocketProtocol,
 
     # When running behind a reverse proxy, connections will always seem to come from localhost, and this makes the
     # access logs less useful than they could be. These reverse proxies add some extra X-Forwarded-For headers of where
@@ -19,6 +35,29 @@ config = uvicorn.Config(
     log_config='logconfig.yaml',
 )
 
+
+def start_hub() -> multiprocessing.Process:
+    """Start the hub in its own process, and set up the environment so that the workers use it."""
+    hub_path = necsus_config.get('BROKER_HUB', str, str(BASE_DIR / 'necsus-hub.sock'))
+    os.environ['NECSUS_BROKER'] = 'hub'
+    os.environ['NECSUS_BROKER_HUB'] = hub_path
+
+    process = multiprocessing.Process(target=hub.main, args=(hub_path,), name='necsus-hub', daemon=True)
+    process.start()
+
+    # The workers retry until the hub is up, but waiting here avoids a burst of warnings as they start.
+    deadline = time.monotonic() + 5
+    while not pathlib.Path(hub_path).exists() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    return process
+
+
 if __name__ == '__main__':
-    server = uvicorn.Server(config)
-    server.run()
+    if workers > 1:
+        hub_process = start_hub()
+        sock = config.bind_socket()
+        Multiprocess(config, target=uvicorn.Server(config).run, sockets=[sock]).run()
+        hub_process.terminate()
+    else:
+        server = uvicorn.Server(config)
+        server.run()
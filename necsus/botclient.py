@@ -0,0 +1,169 @@
+"""
+The BotClient is the long-lived HTTP client used to contact bots, shared by every request for the lifetime of the app.
+"""
+import contextlib
+import time
+import urllib.parse
+
+import anyio
+import httpx
+
+from . import circuit
+from .metrics import Counter, Histogram
+from .timeouts import AdaptiveTimeouts
+
+POOL_HITS = Counter('necsus_bot_pool_hits', 'Bot requests which reused a kept-alive connection.')
+POOL_MISSES = Counter('necsus_bot_pool_misses', 'Bot requests which had to open a new connection.')
+HOST_LIMIT_WAITS = Counter('necsus_bot_host_limit_waits', 'Bot requests which queued because their host was at its connection limit.')
+CONNECTION_WAIT_SECONDS = Histogram(
+    'necsus_bot_connection_wait_seconds',
+    'Time bot requests waited for a connection: for a slot under their host\'s limit, then for one from the pool.',
+)
+
+# The trace events of the first thing done with a connection once the pool hands it to a request: connecting a new
+# connection, or sending the request on one kept alive.
+_CONNECTION_ACQUIRED_EVENTS = {
+    'connection.connect_tcp.started',
+    'connection.connect_unix_socket.started',
+    'http11.send_request_headers.started',
+    'http2.send_request_headers.started',
+}
+
+# Headers describing the body as sent, which no longer apply once it has been read (and decompressed).
+_BODY_HEADERS = {b'content-encoding', b'content-length', b'transfer-encoding'}
+
+
+def _content_length(reply: httpx.Response) -> int | None:
+    """
+    The reply's Content-Length, or None if it has none or a malformed one (for instance a list of lengths): the body is
+    counted as it arrives either way.
+    """
+    try:
+        return int(reply.headers['content-length'])
+    except (KeyError, ValueError):
+        return None
+
+
+class ReplyTooLarge(Exception):
+    """A bot's reply was longer than the client reads, and was abandoned."""
+
+    def __init__(self, max_bytes: int):
+        super().__init__(f"The reply was longer than {max_bytes} bytes")
+        self.max_bytes = max_bytes
+
+
+class BotClient:
+    """
+    Wraps a single httpx.AsyncClient, so that requests to bots share a connection pool (and so skip the TCP and TLS
+    handshakes when a bot is contacted again). On top of the pool's total limit, the number of concurrent requests to
+    any single host is also limited, so that one slow host cannot take up the whole pool.
+
+    The client also holds the policy for triggering several bots at once: how many bots may be running at once in
+    total and in each room, and whether replies are posted in the order they arrive ('arrival') or in the order of the
+    bots in the room ('bot'). Its circuit breakers decide which bot hosts are worth contacting at all, and its
+    timeouts how long to wait for each bot. Replies are read up to max_reply_bytes, and the fields of a reply's message
+    are limited to max_text_chars (for its text) and max_asset_chars (for its css and js).
+    """
+
+    def __init__(
+        self,
+        max_connections: int = 200,
+        max_connections_per_host: int = 20,
+        max_keepalive_connections: int = 100,
+        keepalive_expiry: float = 30.0,
+        http2: bool = False,
+        max_concurrent_bots: int = 200,
+        max_concurrent_bots_per_room: int = 20,
+        reply_order: str = 'bot',
+        breakers: circuit.CircuitBreakers | None = None,
+        timeouts: AdaptiveTimeouts | None = None,
+        max_reply_bytes: int = 2 * 1024 * 1024,
+        max_text_chars: int = 256 * 1024,
+        max_asset_chars: int = 64 * 1024,
+    ):
+        if reply_order not in ('arrival', 'bot'):
+            raise ValueError(f"The reply order should be 'arrival' or 'bot', got {reply_order!r}")
+
+        self.max_connections_per_host = max_connections_per_host
+        self.max_concurrent_bots_per_room = max_concurrent_bots_per_room
+        self.reply_order = reply_order
+        self.breakers = breakers if breakers is not None else circuit.CircuitBreakers()
+        self.timeouts = timeouts if timeouts is not None else AdaptiveTimeouts()
+        self.max_reply_bytes = max_reply_bytes
+        self.max_text_chars = max_text_chars
+        self.max_asset_chars = max_asset_chars
+        self.http = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_keepalive_connections,
+                keepalive_expiry=keepalive_expiry,
+            ),
+            http2=http2,
+        )
+        self._host_limits: dict[str, anyio.Semaphore] = {}
+        self._room_limits: dict[str, anyio.Semaphore] = {}
+        self._dispatch_limit = anyio.Semaphore(max_concurrent_bots)
+
+    def _host_limit(self, url: str) -> anyio.Semaphore:
+        host = urllib.parse.urlsplit(url).netloc
+        if (limit := self._host_limits.get(host)) is None:
+            limit = self._host_limits[host] = anyio.Semaphore(self.max_connections_per_host)
+        return limit
+
+    @contextlib.asynccontextmanager
+    async def dispatch_slot(self, room: str):
+        """Wait until another bot may be triggered in the room, holding the slot until the context exits."""
+        if (room_limit := self._room_limits.get(room)) is None:
+            room_limit = self._room_limits[room] = anyio.Semaphore(self.max_concurrent_bots_per_room)
+
+        async with room_limit, self._dispatch_limit:
+            yield
+
+    async def post(self, url: str, json, timeout: httpx.Timeout) -> httpx.Response:
+        """
+        POST the JSON-encoded payload to a bot, waiting for a free slot for its host first. The reply is read as it
+        arrives, and if it turns out to be longer than max_reply_bytes, it is abandoned and ReplyTooLarge raised.
+        """
+        opened_connection = False
+        connected_at = None
+
+        async def trace(event_name: str, info):
+            nonlocal opened_connection, connected_at
+            if event_name.startswith('connection.connect_') and event_name.endswith('.started'):
+                opened_connection = True
+            if connected_at is None and event_name in _CONNECTION_ACQUIRED_EVENTS:
+                connected_at = time.perf_counter()
+
+        limit = self._host_limit(url)
+        if limit.value == 0:
+            HOST_LIMIT_WAITS.inc()
+
+        started_at = time.perf_counter()
+        async with limit, self.http.stream('POST', url, json=json, timeout=timeout, extensions={'trace': trace}) as reply:
+            (POOL_MISSES if opened_connection else POOL_HITS).inc()
+            # Without a real connection (with a mocked transport, say) there are no trace events.
+            if connected_at is not None:
+                CONNECTION_WAIT_SECONDS.observe(connected_at - started_at)
+            body = await self._read_body(reply)
+
+        # The reply as if it had been read in one go, which leaving the stream's context would not allow.
+        headers = [(name, value) for name, value in reply.headers.raw if name.lower() not in _BODY_HEADERS]
+        extensions = {'reason_phrase': reply.extensions['reason_phrase']} if 'reason_phrase' in reply.extensions else {}
+        return httpx.Response(reply.status_code, headers=headers, content=body, request=reply.request, extensions=extensions)
+
+    async def _read_body(self, reply: httpx.Response) -> bytes:
+        # Leaving the stream's context closes the connection without reading the rest of a reply given up on.
+        if (_content_length(reply) or 0) > self.max_reply_bytes and 'content-encoding' not in reply.headers:
+            raise ReplyTooLarge(self.max_reply_bytes)
+
+        chunks = []
+        size = 0
+        async for chunk in reply.aiter_bytes():
+            size += len(chunk)
+            if size > self.max_reply_bytes:
+                raise ReplyTooLarge(self.max_reply_bytes)
+            chunks.append(chunk)
+        return b''.join(chunks)
+
+    async def aclose(self):
+        await self.http.aclose()
@@ -1,63 +1,515 @@
-from collections import defaultdict
+import collections
+import itertools
+import json
+import logging
+import math
+import time
+import uuid
 
-import anyio.streams.memory
+import anyio
+
+from . import hub
+from .metrics import Counter, Gauge
+
+logger = logging.getLogger('necsus')
+
+# The same encoding as WebSocket.send_json(), with the encoder built once rather than on every call.
+_encode = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False).encode
+
+# What to do when a subscriber falls further behind than the room log holds, see Broker.
+OVERFLOW_POLICIES = ('drop', 'coalesce', 'block')
+
+# The websocket close code sent to a subscriber dropped for falling behind, telling the client to reconnect (with
+# ?since= its last message) straight away. Codes 4000-4999 are for use by applications.
+RESYNC_CLOSE_CODE = 4000
+
+SUBSCRIBERS = Gauge('necsus_broker_subscribers', 'Websockets subscribed to a room.', ['room'])
+QUEUE_DEPTH = Gauge('necsus_broker_queue_depth', 'Events waiting to be sent to the websockets in a room.', ['room'])
+SUBSCRIBER_QUEUE_DEPTH = Gauge('necsus_broker_subscriber_queue_depth', 'Events waiting to be sent to a websocket.', ['room', 'subscriber'])
+SUBSCRIBERS_OVERFLOWED = Counter('necsus_broker_overflows', 'Subscribers who fell too far behind, by overflow policy.', ['policy'])
+HUB_OVERFLOWS = Counter('necsus_broker_hub_overflows', 'Times the events queued for the hub were dropped because it fell too far behind.')
+ROOM_LOGS = Gauge('necsus_broker_room_logs', 'Rooms with a log of recent events in memory.')
+ROOM_LOG_BYTES = Gauge('necsus_broker_room_log_bytes', 'Total length of the frames in the room logs.')
+CATCH_UPS = Counter('necsus_broker_catch_ups', 'Websockets caught up on connecting, by where the missed messages came from.', ['source'])
+
+
+def encode_event(kind: str, data) -> str:
+  """Encode an event as the text of a websocket frame."""
+  return _encode({'kind': kind, 'data': data})
+
+
+class RoomLog:
+  """
+  A ring buffer of the most recent events in a room, as (kind, frame, id) tuples. Sequence numbers count up from 0,
+  and the event with sequence number seq lives at entries[seq % size] until it is dropped: the log holds at most size
+  events, whose frames are at most max_bytes long in total (apart from the latest, which is kept however long it is).
+  For messages, the id is the message id, and for clears it is the id of the last message cleared.
+
+  The log is complete after floor_id: every message with a larger id, and every clear of such a message, is either in
+  the log or yet to be published. Until the first message or clear is published, floor_id is None.
+  """
+
+  def __init__(self, size: int, max_bytes: int = math.inf):
+    self.size = size
+    self.max_bytes = max_bytes
+    self.entries = [None] * size
+    self.first_seq = 0
+    self.next_seq = 0
+    self.bytes = 0  # The total length of the frames in the log.
+    self.floor_id = None
+    self.last_clear_seq = -1
+    self.idle_since = None  # When the log was first seen without subscribers, see Broker.forget_idle_logs().
+    self.subscriptions = set()
+    self.changed = anyio.Event()
+    self.advanced = anyio.Event()
+
+  def drops(self, frame: str) -> int:
+    """How many of the oldest events appending a frame would drop."""
+    count = self.next_seq - self.first_seq
+    total = self.bytes + len(frame)
+    drops = 0
+    while drops < count and (count - drops >= self.size or total > self.max_bytes):
+      total -= len(self.entries[(self.first_seq + drops) % self.size][1])
+      drops += 1
+    return drops
+
+  def append(self, kind: str, frame: str, id):
+    """Add an event to the log, dropping the oldest to make room for it, and wake the subscribers."""
+    for _ in range(self.drops(frame)):
+      index = self.first_seq % self.size
+      _, oldest_frame, oldest_id = self.entries[index]
+      if oldest_id is not None:
+        self.floor_id = oldest_id if self.floor_id is None else max(self.floor_id, oldest_id)
+      self.entries[index] = None
+      self.bytes -= len(oldest_frame)
+      self.first_seq += 1
+    if self.floor_id is None and id is not None:
+      self.floor_id = id - 1 if kind == 'message' else id
+
+    self.entries[self.next_seq % self.size] = (kind, frame, id)
+    self.bytes += len(frame)
+    if kind == 'clear_messages':
+      self.last_clear_seq = self.next_seq
+    self.next_seq += 1
+    self.wake()
+
+  def wake(self):
+    self.changed.set()
+    self.changed = anyio.Event()
+
+  def since(self, since_id: int):
+    """
+    Return the frames which a subscriber who has seen the messages up to since_id is missing: a clear if there has been
+    one since, then the messages after since_id (or after the clear). Returns None if the log does not go back that far.
+    """
+    if self.floor_id is None or since_id < self.floor_id:
+      return None
+
+    frames = []
+    for seq in range(self.first_seq, self.next_seq):
+      kind, frame, id = self.entries[seq % self.size]
+      if kind == 'clear_messages' and id >= since_id:
+        frames = [frame]
+      elif kind == 'message' and id is not None and id > since_id:
+        frames.append(frame)
+    return frames
+
+  def slowest_seq(self) -> int:
+    return min((subscription.cursor for subscription in self.subscriptions), default=self.next_seq)
+
+
+class Subscription:
+  """
+  A subscriber's cursor into its room's log, read with .frames(). The subscriber first gets its initial frames (the
+  bots, and the messages it missed, which may be replayed from the database a page at a time), then each event in the
+  log from the cursor on. If the subscriber is evicted for falling behind, .evicted is set and .frames() stops, and
+  likewise .failed if reading a page of the replay fails.
+  """
+
+  def __init__(self, id: int, room: str, log: RoomLog, broker: 'Broker'):
+    self.id = id
+    self.room = room
+    self.log = log
+    self.broker = broker
+    self.cursor = log.next_seq
+    self.init = collections.deque()
+    self.catching_up = False
+    self.skip_through_id = None
+    self.replaying = None  # (fetch_page, page_size, after_id) while replaying missed messages, see .replay().
+    self.evicted = False
+    self.failed = False
+    self.closed = False
+    self.warned = False
+
+  @property
+  def depth(self) -> int:
+    return len(self.init) + self.log.next_seq - self.cursor
+
+  def add_bots(self, bots: list):
+    """
+    Send the room's bots before anything else. Reading them after subscribing means that any change to the bots since
+    is either in what was read, or follows in the log (or both, which is harmless).
+    """
+    self.init.extendleft(encode_event('put_bot', bot) for bot in reversed(bots))
+
+  def catch_up(self, init_messages: list, should_clear: bool):
+    """
+    Add the messages (read from the database) which the subscriber missed. Events published since subscribing are in
+    the log already, so any message there which is also in init_messages is skipped.
+    """
+    if should_clear:
+      self.init.append(encode_event('clear_messages', {}))
+    self.init.extend(encode_event('message', message) for message in init_messages)
+
+    if init_messages:
+      self.skip_through_id = init_messages[-1]['id']
+    self.catching_up = False
+
+  def replay(self, fetch_page, page_size: int, since_id: int, through_id: int | None, should_clear: bool):
+    """
+    Like .catch_up(), for when the subscriber may have missed too many messages to hold in memory at once. Instead,
+    .frames() awaits fetch_page(after_id, page_size) for each page of messages (in ascending ID order, and with IDs
+    strictly greater than after_id) as the subscriber is ready for it, until it reaches through_id, the ID of the latest
+    message stored when the subscriber subscribed. Events published since subscribing wait in the log until then, and
+    any message there which was replayed is skipped.
+    """
+    if should_clear:
+      self.init.append(encode_event('clear_messages', {}))
+
+    if through_id is not None and through_id > since_id:
+      self.replaying = (fetch_page, page_size, since_id)
+      self.skip_through_id = through_id
+    self.catching_up = False
+
+  async def _replay_page(self):
+    fetch_page, page_size, after_id = self.replaying
+    page = await fetch_page(after_id, page_size)
+
+    # Anything after through_id is in the log, so the replay stops there.
+    through_id = self.skip_through_id
+    self.init.extend(encode_event('message', message) for message in page if message['id'] <= through_id)
+    if len(page) < page_size or page[-1]['id'] >= through_id:
+      self.replaying = None
+    else:
+      self.replaying = (fetch_page, page_size, page[-1]['id'])
+
+  def poll(self):
+    """Return the next frame, or None if there is nothing new yet (or the subscriber has just been evicted)."""
+    if self.init:
+      return self.init.popleft()
+    if self.replaying is not None:
+      return None
+
+    log = self.log
+    while self.cursor < log.next_seq:
+      if self.cursor < log.first_seq:
+        cleared = log.last_clear_seq >= self.cursor
+        self.broker._overflow(self)
+        return None if self.evicted else encode_event('resync', {'cleared': cleared})
+
+      kind, frame, id = log.entries[self.cursor % log.size]
+      self.cursor += 1
+      if self.broker.overflow == 'block':
+        log.advanced.set()
+
+      if kind == 'message' and self.skip_through_id is not None and id is not None and id <= self.skip_through_id:
+        continue
+
+      behind = log.next_seq - self.cursor
+      if behind >= self.broker.warn_depth and not self.warned:
+        logger.warning(f"A websocket in room {self.room!r} is {behind} events behind")
+        self.warned = True
+      elif behind < self.broker.warn_depth // 2:
+        self.warned = False
+      return frame
+
+    return None
+
+  async def frames(self):
+    """Yield each encoded event, until unsubscribed, evicted, or the replay fails."""
+    while not (self.evicted or self.failed or self.closed):
+      if (frame := self.poll()) is not None:
+        yield frame
+      elif self.replaying is not None:
+        try:
+          await self._replay_page()
+        except Exception:
+          logger.exception(f"Failed to replay missed messages to a websocket in room {self.room!r}")
+          self.failed = True
+      elif not (self.evicted or self.closed):
+        await self.log.changed.wait()
 
 
 class Broker:
   """
-  The Broker is used as a singleton, and facilitates broadcasting to WebSockets. It manages a collection of unbounded
-  queues, and each action .publish_message(), .clear_room(), etc will post into those queues.
+  The Broker is used as a singleton, and facilitates broadcasting to WebSockets. Each room has a RoomLog, a fixed-size
+  ring buffer of its most recent events, and each subscriber is a cursor into that log. Publishing an event encodes it
+  to JSON once, appends it to the log, and wakes the room's subscribers. A subscriber reconnecting with a since id
+  which the log goes back to is caught up from memory, without reading the database.
+
+  Each log holds at most log_size events, and log_bytes of frames. The log of a room which has had no subscribers for
+  idle_seconds is forgotten by .run(), so that rooms no longer in use do not hold memory.
+
+  A subscriber which stops reading (a stalled browser tab, for example) can only fall as far behind as the log holds.
+  After that, the overflow policy decides what happens:
+    - 'drop': the subscriber is evicted, and its websocket closed with RESYNC_CLOSE_CODE so the client reconnects.
+    - 'coalesce': the subscriber skips to the end of the log, after a single 'resync' event telling the client to
+      reload what it missed (and whether the room was cleared in the meantime).
+    - 'block': publishing waits until the slowest subscriber has read the events it would drop, holding up the whole
+      room.
   """
-  queues_by_room: defaultdict[str, set[anyio.streams.memory.MemoryObjectSendStream]]
 
-  def __init__(self):
-    self.queues_by_room = defaultdict(set)
+  def __init__(
+    self,
+    log_size: int = 1000,
+    overflow: str = 'drop',
+    warn_depth: int | None = None,
+    log_bytes: int = 4 * 1024 * 1024,
+    idle_seconds: float = 600.0,
+  ):
+    if overflow not in OVERFLOW_POLICIES:
+      raise ValueError(f"The overflow policy should be one of {OVERFLOW_POLICIES}, got {overflow!r}")
+
+    self.log_size = log_size
+    self.log_bytes = log_bytes
+    self.idle_seconds = idle_seconds
+    self.overflow = overflow
+    self.warn_depth = warn_depth if warn_depth is not None else log_size // 2
+    self.logs = {}
+    self._ids = itertools.count()
+
+    SUBSCRIBERS.set_function(lambda: [((room,), len(log.subscriptions)) for room, log in self.logs.items() if log.subscriptions])
+    QUEUE_DEPTH.set_function(lambda: [
+      ((room,), sum(subscription.depth for subscription in log.subscriptions))
+      for room, log in self.logs.items()
+      if log.subscriptions
+    ])
+    SUBSCRIBER_QUEUE_DEPTH.set_function(lambda: [
+      ((room, str(subscription.id)), subscription.depth)
+      for room, log in self.logs.items()
+      for subscription in log.subscriptions
+    ])
+    ROOM_LOGS.set_function(lambda: [((), len(self.logs))])
+    ROOM_LOG_BYTES.set_function(lambda: [((), sum(log.bytes for log in self.logs.values()))])
+
+  async def run(self, task_status=anyio.TASK_STATUS_IGNORED):
+    """Run the background work the broker needs, until cancelled."""
+    task_status.started()
+    await self._forget_idle_logs_forever()
+
+  async def _forget_idle_logs_forever(self):
+    while True:
+      await anyio.sleep(max(self.idle_seconds / 2, 1.0))
+      self.forget_idle_logs()
+
+  def forget_idle_logs(self):
+    """
+    Forget the log of each room which has had no subscribers since at least idle_seconds ago, as far as calls to this
+    have seen. A subscriber to the room later on catches up from the database.
+    """
+    now = time.monotonic()
+    for room, log in list(self.logs.items()):
+      if log.subscriptions:
+        log.idle_since = None
+      elif log.idle_since is None:
+        log.idle_since = now
+      elif now - log.idle_since >= self.idle_seconds:
+        del self.logs[room]
 
-  def _notify_room(self, room: str, msg):
-    """Post a message into all queues associated with a room."""
-    for queue in self.queues_by_room.get(room, set()):
-      queue.send_nowait(msg)
+  def _log(self, room: str) -> RoomLog:
+    if (log := self.logs.get(room)) is None:
+      log = self.logs[room] = RoomLog(self.log_size, self.log_bytes)
+    return log
 
-  def publish_message(self, room: str, message):
+  async def _notify_room(self, room: str, kind: str, data, id=None):
+    """Append an event to the room's log."""
+    log = self._log(room)
+    frame = encode_event(kind, data)
+    if self.overflow == 'block':
+      while log.slowest_seq() < log.first_seq + log.drops(frame):
+        await log.advanced.wait()
+        log.advanced = anyio.Event()
+
+    log.append(kind, frame, id)
+
+  def _overflow(self, subscription: Subscription):
+    """Apply the overflow policy to a subscriber whose cursor has fallen out of the log."""
+    SUBSCRIBERS_OVERFLOWED.labels(self.overflow).inc()
+    behind = subscription.log.next_seq - subscription.cursor
+    if self.overflow == 'coalesce':
+      logger.warning(f"Asking a websocket in room {subscription.room!r} which fell {behind} events behind to resync")
+      subscription.cursor = subscription.log.next_seq
+    else:
+      logger.warning(f"Dropping a websocket in room {subscription.room!r} which fell {behind} events behind")
+      subscription.evicted = True
+      subscription.log.subscriptions.discard(subscription)
+
+  async def publish_message(self, room: str, message):
     """Notify of a new message."""
-    self._notify_room(room, {'kind': 'message', 'data': message})
+    await self._notify_room(room, 'message', message, message.get('id'))
 
-  def clear_room(self, room: str):
-    """Clear all messages in a room"""
-    self._notify_room(room, {'kind': 'clear_messages', 'data': {}})
+  async def clear_room(self, room: str, last_cleared_id: int):
+    """Clear all messages in a room, up to and including the message last_cleared_id."""
+    await self._notify_room(room, 'clear_messages', {}, last_cleared_id)
 
-  def put_bot(self, room: str, bot):
+  async def put_bot(self, room: str, bot):
     """Notify of a bot created or updated."""
-    self._notify_room(room, {'kind': 'put_bot', 'data': bot})
+    await self._notify_room(room, 'put_bot', bot)
 
-  def delete_bot(self, room: str, bot):
+  async def delete_bot(self, room: str, bot):
     """Notify of a bot deletion."""
-    self._notify_room(room, {'kind': 'delete_bot', 'data': bot})
+    await self._notify_room(room, 'delete_bot', bot)
 
-  def subscribe(self, room: str, init_messages: list, init_bots: list, should_clear: bool):
+  def subscribe(self, room: str, since_id: int, init_bots: list = ()) -> Subscription:
     """
-    Subscribe to all actions associated to a particular room.
-    A pair (recv, tag) is returned, where recv is a stream (queue) which messages are fed into,
-    and tag is an opaque tag which can then be used to unsubscribe.
+    Subscribe to all actions associated to a particular room, for a subscriber who has seen the messages up to
+    since_id. The returned Subscription's .frames() yields each encoded event in turn, starting with the bots (given
+    here, or read after subscribing and passed to .add_bots()). If the room log goes back to since_id the messages
+    missed follow, and otherwise .catching_up is set: the caller should read them from the database and pass them to
+    .catch_up(), or have them read as needed with .replay(). Pass the Subscription to unsubscribe() when done.
     """
+    log = self._log(room)
+    log.idle_since = None
+    subscription = Subscription(next(self._ids), room, log, self)
+    subscription.init.extend(encode_event('put_bot', bot) for bot in init_bots)
 
-    # Joel: It is generally bad practice to use unbounded queues. We didn't see any problems from this in 2023, but
-    #       perhaps we should add some monitoring, and log a warning if any queue looks like it's filling up over time.
-    send, recv = anyio.create_memory_object_stream(max_buffer_size=float('inf'))
-    self.queues_by_room[room].add(send)
+    if (missed := log.since(since_id)) is None:
+      subscription.catching_up = True
+      CATCH_UPS.labels('database').inc()
+    else:
+      subscription.init.extend(missed)
+      CATCH_UPS.labels('memory').inc()
 
-    if should_clear:
-      send.send_nowait({'kind': 'clear_messages', 'data': {}})
+    log.subscriptions.add(subscription)
+    return subscription
+
+  def unsubscribe(self, subscription: Subscription):
+    subscription.closed = True
+    subscription.log.subscriptions.discard(subscription)
+    subscription.log.wake()
+    if self.overflow == 'block':
+      subscription.log.advanced.set()
+
+
+class HubBroker(Broker):
+  """
+  A Broker for running several worker processes, which publishes each event through the hub (see necsus.hub) rather
+  than straight into the room log. Every worker appends the events sent back by the hub, so each room log holds the
+  events published by all workers, in the same order in every worker. .run() must be running for any events to arrive.
+
+  Bots are cached by each worker's database, so when another worker changes a bot, on_remote_bot_change() is called
+  (in the background) to invalidate the cache. The 'block' overflow policy is not supported, since a slow subscriber would hold up the
+  events of every room.
+  """
 
-    for bot in init_bots:
-      send.send_nowait({'kind': 'put_bot', 'data': bot})
+  def __init__(self, path: str, on_remote_bot_change=None, queue_size: int = hub.QUEUE_SIZE, **kwargs):
+    super().__init__(**kwargs)
+    if self.overflow == 'block':
+      raise ValueError("The 'block' overflow policy can't be used with the hub broker")
+
+    self.path = path
+    self.on_remote_bot_change = on_remote_bot_change
+    self.origin = uuid.uuid4().hex
+    # Events are queued until they can be sent, so publishing never waits for the hub, even if it is restarting. If
+    # queue_size events are waiting, they are dropped and the connection to the hub restarted.
+    self.queue_size = queue_size
+    self._outbox_send, self._outbox_recv = anyio.create_memory_object_stream(max_buffer_size=queue_size)
+    self._unsent = None
+    self._connection_scope = None
+    self._seqs = itertools.count()
+    self._last_seqs = {}  # Maps the origin of each worker heard from -> the seq of the last of its events received.
+
+  async def _notify_room(self, room: str, kind: str, data, id=None):
+    line = hub.encode_line(self.origin, next(self._seqs), room, kind, id, encode_event(kind, data))
+    if len(line) > hub.MAX_LINE:
+      # The hub would close the connection rather than relay it.
+      logger.error(f"Not publishing a {kind!r} event in room {room!r} which is longer than the hub accepts")
+      return
+    try:
+      self._outbox_send.send_nowait(line)
+    except anyio.WouldBlock:
+      self._drop_outbox()
+
+  def _drop_outbox(self):
+    """Drop the events queued for a hub which has fallen too far behind, and reconnect to it."""
+    logger.warning(f"Dropping {self.queue_size} events waiting to be sent to the hub, and reconnecting")
+    HUB_OVERFLOWS.inc()
+    while True:
+      try:
+        self._outbox_recv.receive_nowait()
+      except anyio.WouldBlock:
+        break
+    self._unsent = None
+    if self._connection_scope is not None:
+      self._connection_scope.cancel()
+    self._evict_all()
+
+  async def run(self, task_status=anyio.TASK_STATUS_IGNORED):
+    """Stay connected to the hub, sending the events published here and receiving those from every worker."""
+    task_status.started()
+    retry_delay = 0.1
+    async with anyio.create_task_group() as tg:
+      tg.start_soon(self._forget_idle_logs_forever)
+      while True:
+        try:
+          stream = await anyio.connect_unix(self.path)
+        except OSError as e:
+          logger.warning(f"Could not connect to the hub at {self.path!r}, retrying in {retry_delay}s: {e!r}")
+          await anyio.sleep(retry_delay)
+          retry_delay = min(retry_delay * 2, 5.0)
+          continue
+
+        retry_delay = 0.1
+        async with stream, anyio.create_task_group() as connection_tg:
+          self._connection_scope = connection_tg.cancel_scope
+          connection_tg.start_soon(self._send_lines, stream, connection_tg.cancel_scope)
+          try:
+            async for line in hub.read_lines(stream):
+              self._receive(line, tg)
+          except (anyio.BrokenResourceError, OSError) as e:
+            logger.warning(f"Lost the connection to the hub: {e!r}")
+          connection_tg.cancel_scope.cancel()
+        self._connection_scope = None
+
+        logger.warning("Disconnected from the hub, reconnecting")
+        self._evict_all()
+
+  def _evict_all(self):
+    """
+    Start every room log afresh and make every websocket reconnect and catch up from the database, since events which
+    did not make it through the hub are missing from the logs.
+    """
+    for log in self.logs.values():
+      for subscription in list(log.subscriptions):
+        subscription.evicted = True
+      log.subscriptions.clear()
+      log.wake()
+    self.logs.clear()
 
-    for message in init_messages:
-      send.send_nowait({'kind': 'message', 'data': message})
+  async def _send_lines(self, stream, cancel_scope: anyio.CancelScope):
+    while True:
+      if self._unsent is None:
+        self._unsent = await self._outbox_recv.receive()
+      try:
+        await stream.send(self._unsent)
+      except (anyio.BrokenResourceError, anyio.ClosedResourceError, OSError) as e:
+        # The event is sent again once reconnected. If it reached the hub after all, the second copy is dropped.
+        logger.warning(f"Lost the connection to the hub while sending: {e!r}")
+        cancel_scope.cancel()
+        return
+      self._unsent = None
 
-    return recv, (room, send)
+  def _receive(self, line: bytes, tg):
+    try:
+      origin, seq, room, kind, id, frame = hub.decode_line(line)
+    except ValueError:
+      logger.error(f"Ignoring a malformed line from the hub: {line[:100]!r}")
+      return
 
-  def unsubscribe(self, tag):
-    room, send = tag
-    send.close()
-    self.queues_by_room[room].remove(send)
+    # The hub relays each worker's events in the order they were sent, so a seq not above the last is a repeat.
+    if seq <= self._last_seqs.get(origin, -1):
+      return
+    self._last_seqs[origin] = seq
+    self._log(room).append(kind, frame, id)
+    if origin != self.origin and kind in ('put_bot', 'delete_bot') and self.on_remote_bot_change is not None:
+      tg.start_soon(self.on_remote_bot_change)
@@ -0,0 +1,140 @@
+"""
+The CatchUpReader coalesces the database reads of websockets catching up on a room at the same time, as happens when
+the server restarts or a proxy drops its connections, and every client reconnects within a few seconds. Rather than
+each websocket running its own queries, the reads for a room are gathered for a short window and answered together:
+one lookup of the room's last clear and latest message, one read of the latest messages for websockets connecting for
+the first time, and one page of missed messages from the smallest ID asked for, of which each websocket takes its own
+suffix.
+
+A read only ever joins a query which has not started yet, so its result is never older than the caller's subscription
+to the broker, and nothing published in between can be missed (see WebSocketRoom.on_connect).
+"""
+import bisect
+
+import anyio
+
+from .metrics import Counter
+
+QUERY_NAMES = ('last_ids', 'latest', 'since')
+
+# The difference between these is the number of database queries saved by coalescing.
+READS = Counter('necsus_catch_up_reads', 'Reads asked for by websockets catching up on a room, by query.', ['query'])
+QUERIES = Counter('necsus_catch_up_queries', 'Database queries run to answer catch-up reads, by query.', ['query'])
+
+_READS = {query: READS.labels(query) for query in QUERY_NAMES}
+_QUERIES = {query: QUERIES.labels(query) for query in QUERY_NAMES}
+
+
+class _Gather:
+    """The reads of one room gathered for one query, which the first of them runs when the window closes."""
+
+    def __init__(self):
+        self.requests = []
+        self.done = anyio.Event()
+        self.result = None
+        self.error = None
+        self.abandoned = False
+
+
+class CatchUpReader:
+    """
+    Reads what websockets catching up on a room need from an AsyncDB, coalescing the reads of the same room which
+    arrive within `window` seconds of each other. With a window of 0, every read is its own query.
+    """
+
+    def __init__(self, db, window: float = 0.01):
+        self.db = db
+        self.window = window
+        self._gathering = {}  # Maps (query, room) -> the _Gather which has not started its query yet.
+
+    async def _gathered(self, query: str, room: str, request, run):
+        """
+        Add a request to the gather for (query, room), starting one if there is none, and return the result of
+        run(requests) once the gather's query has run. Only the first request in a gather runs the query.
+        """
+        key = (query, room)
+        if (gather := self._gathering.get(key)) is not None:
+            gather.requests.append(request)
+            await gather.done.wait()
+            if gather.abandoned:
+                return await self._gathered(query, room, request, run)
+            if gather.error is not None:
+                raise gather.error
+            return gather.result
+
+        gather = self._gathering[key] = _Gather()
+        gather.requests.append(request)
+        try:
+            await anyio.sleep(self.window)
+            del self._gathering[key]
+            _QUERIES[query].inc()
+            gather.result = await run(gather.requests)
+            return gather.result
+        except Exception as e:
+            gather.error = e
+            raise
+        finally:
+            # If the first request was cancelled (its websocket closed, say), the others go again without it.
+            if gather.result is None and gather.error is None:
+                gather.abandoned = True
+                if self._gathering.get(key) is gather:
+                    del self._gathering[key]
+            gather.done.set()
+
+    async def last_ids(self, room: str) -> tuple:
+        """Return (the ID of the last message cleared from the room, the ID of the latest message), either maybe None."""
+        _READS['last_ids'].inc()
+        if self.window <= 0:
+            _QUERIES['last_ids'].inc()
+            return await self._last_ids(room)
+        return await self._gathered('last_ids', room, None, lambda requests: self._last_ids(room))
+
+    async def _last_ids(self, room: str) -> tuple:
+        last_cleared_entry = await self.db.clears.find(room=room)
+        latest_message = await self.db.messages.last(room)
+        return (
+            last_cleared_entry['last_cleared_id'] if last_cleared_entry is not None else None,
+            latest_message['id'] if latest_message is not None else None,
+        )
+
+    async def latest(self, room: str, limit: int) -> list:
+        """Return the latest `limit` messages in the room, in ascending ID order."""
+        _READS['latest'].inc()
+        if self.window <= 0:
+            _QUERIES['latest'].inc()
+            return await self.db.messages.before(room, limit=limit)
+
+        async def run(limits):
+            return await self.db.messages.before(room, limit=max(limits))
+
+        messages = await self._gathered('latest', room, limit, run)
+        return messages[-limit:]
+
+    async def since(self, room: str, after_id: int, limit: int) -> list:
+        """
+        Return the first `limit` messages in the room with IDs strictly greater than after_id, in ascending ID order,
+        as DB.messages.since(). The gathered query starts from the smallest after_id, and reads as many messages as
+        the separate queries would have together, so if the others asked for messages much further on, it may not
+        reach the end of this read, and the rest is read separately.
+        """
+        _READS['since'].inc()
+        if self.window <= 0:
+            _QUERIES['since'].inc()
+            return await self.db.messages.since(room, after_id, limit)
+
+        async def run(requests):
+            limits = {}
+            for request_after_id, request_limit in requests:
+                limits[request_after_id] = max(request_limit, limits.get(request_after_id, 0))
+            read_limit = sum(limits.values())
+            return read_limit, await self.db.messages.since(room, min(limits), read_limit)
+
+        read_limit, messages = await self._gathered('since', room, (after_id, limit), run)
+        start = bisect.bisect_right(messages, after_id, key=lambda message: message['id'])
+        suffix = messages[start:start + limit]
+
+        # Unless the query reached the end of the room, the messages after it have not been read.
+        if len(suffix) < limit and len(messages) == read_limit:
+            _QUERIES['since'].inc()
+            suffix += await self.db.messages.since(room, suffix[-1]['id'] if suffix else after_id, limit - len(suffix))
+        return suffix
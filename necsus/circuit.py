@@ -0,0 +1,164 @@
+"""
+Circuit breakers stop NeCSuS contacting bots on hosts which are down. Students' bots go to sleep or crash all the
+time, and without a breaker every matching message would wait on a connection to them (for up to the bot timeout), and
+post another error into the room.
+
+Each host has a breaker, which starts closed. After `threshold` consecutive failures (a connection error, a timeout, a
+reply saying the host is unavailable, or a reply slower than `slow_seconds`) it opens: requests to the host fail at
+once without being sent, and each room is told so once. After `backoff` seconds it is half-open, and lets one request
+through as a probe. If the probe succeeds the breaker closes again, and if it fails the breaker opens for twice as
+long as before, up to `max_backoff` seconds.
+
+Each change of state starts a new generation of the breaker. A request's outcome only counts if the breaker is still
+in the generation the request was allowed in, so that a request sent before the breaker opened cannot close it again
+when it finally succeeds, skipping the backoff and probe.
+"""
+import time
+import urllib.parse
+
+from .metrics import Counter, Gauge
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+STATES = (CLOSED, OPEN, HALF_OPEN)
+
+# Status codes from proxies in front of a bot (like Replit's) when the bot itself is asleep or down.
+UNAVAILABLE_STATUSES = {502, 503, 504}
+
+# The weight of each request's latency in a breaker's moving average.
+LATENCY_WEIGHT = 0.2
+
+BREAKER_OPENS = Counter('necsus_bot_breaker_opens', 'Times a bot host\'s circuit breaker opened.')
+BREAKER_REJECTIONS = Counter('necsus_bot_breaker_rejections', 'Bot requests failed at once because their host\'s breaker was open.')
+BREAKERS = Gauge('necsus_bot_breakers', 'Bot hosts with a circuit breaker in each state.', ['state'])
+
+
+def host(url: str) -> str:
+    """The key of the breaker for a bot URL."""
+    return urllib.parse.urlsplit(url).netloc
+
+
+class CircuitBreaker:
+    def __init__(self, host: str, backoff: float):
+        self.host = host
+        self.state = CLOSED
+        self.failures = 0  # Consecutive failures.
+        self.latency = None  # Moving average of the seconds taken by requests, failed or not.
+        self.backoff = backoff  # Seconds to stay open for the next time the breaker opens.
+        self.retry_at = None  # When an open breaker becomes half-open, by the breakers' clock.
+        self.probing = False  # Whether a half-open breaker's probe is in flight.
+        self.generation = 0  # Counts the changes of state.
+        self.noticed_rooms = set()  # Rooms told the breaker is open since it last opened.
+
+
+class CircuitBreakers:
+    """The circuit breakers of every bot host contacted, as described at the top of the module."""
+
+    def __init__(
+        self,
+        threshold: int = 5,
+        backoff: float = 10.0,
+        max_backoff: float = 300.0,
+        slow_seconds: float = 60.0,
+        clock=time.monotonic,
+    ):
+        self.threshold = threshold
+        self.initial_backoff = backoff
+        self.max_backoff = max_backoff
+        self.slow_seconds = slow_seconds
+        self.clock = clock
+        self._breakers: dict[str, CircuitBreaker] = {}
+        BREAKERS.set_function(self._state_counts)
+
+    def _state_counts(self):
+        counts = dict.fromkeys(STATES, 0)
+        for breaker in self._breakers.values():
+            counts[self._state(breaker)] += 1
+        return [((state,), count) for state, count in counts.items()]
+
+    def get(self, url: str) -> CircuitBreaker:
+        key = host(url)
+        if (breaker := self._breakers.get(key)) is None:
+            breaker = self._breakers[key] = CircuitBreaker(key, self.initial_backoff)
+        return breaker
+
+    def state(self, url: str) -> str:
+        """The state of the breaker for a bot URL, without creating one."""
+        breaker = self._breakers.get(host(url))
+        return self._state(breaker) if breaker is not None else CLOSED
+
+    def _state(self, breaker: CircuitBreaker) -> str:
+        # An open breaker only becomes half-open when a request comes along, but shows as half-open from its retry time.
+        if breaker.state == OPEN and self.clock() >= breaker.retry_at:
+            return HALF_OPEN
+        return breaker.state
+
+    def allow(self, breaker: CircuitBreaker) -> int | None:
+        """
+        Return the breaker's generation if a request may be sent through it, or None if not. Each request allowed must
+        be followed by record() or, if it is given up without an outcome, release().
+        """
+        if (state := self._state(breaker)) != breaker.state:
+            self._change_state(breaker, state)
+        if breaker.state == CLOSED:
+            return breaker.generation
+        if breaker.state == HALF_OPEN and not breaker.probing:
+            breaker.probing = True
+            return breaker.generation
+
+        BREAKER_REJECTIONS.inc()
+        return None
+
+    def _change_state(self, breaker: CircuitBreaker, state: str):
+        breaker.state = state
+        breaker.generation += 1
+        breaker.probing = False
+
+    def should_notice(self, breaker: CircuitBreaker, room: str) -> bool:
+        """Whether a room still needs to be told the breaker is open, this time it has opened."""
+        if room in breaker.noticed_rooms:
+            return False
+        breaker.noticed_rooms.add(room)
+        return True
+
+    def record(self, breaker: CircuitBreaker, generation: int, seconds: float, failed: bool):
+        """Record the outcome of a request which the breaker allowed in the given generation."""
+        breaker.latency = seconds if breaker.latency is None else (1 - LATENCY_WEIGHT) * breaker.latency + LATENCY_WEIGHT * seconds
+        if generation != breaker.generation:
+            return
+
+        failed = failed or seconds > self.slow_seconds
+        if not failed:
+            if breaker.state != CLOSED:
+                self._change_state(breaker, CLOSED)
+            breaker.failures = 0
+            breaker.backoff = self.initial_backoff
+            return
+
+        breaker.failures += 1
+        if breaker.state == HALF_OPEN or breaker.failures >= self.threshold:
+            self._change_state(breaker, OPEN)
+            breaker.retry_at = self.clock() + breaker.backoff
+            breaker.backoff = min(2 * breaker.backoff, self.max_backoff)
+            breaker.noticed_rooms.clear()
+            BREAKER_OPENS.inc()
+
+    def release(self, breaker: CircuitBreaker, generation: int):
+        """Give up a request which the breaker allowed, without an outcome: for instance because it was cancelled."""
+        if generation == breaker.generation:
+            breaker.probing = False
+
+    def as_list(self) -> list:
+        """The state of each host's breaker, for the API."""
+        now = self.clock()
+        return [
+            {
+                'host': breaker.host,
+                'state': self._state(breaker),
+                'failures': breaker.failures,
+                'latency': breaker.latency,
+                'retry_in': max(0.0, breaker.retry_at - now) if breaker.state == OPEN else None,
+            }
+            for breaker in self._breakers.values()
+        ]
@@ -0,0 +1,148 @@
+"""
+Compression of websocket frames with permessage-deflate (RFC 7692), set up for rooms where every event is sent to
+many websockets at once.
+
+uvicorn negotiates permessage-deflate with zlib's default settings, where each connection keeps its own compressor
+between messages (a 32 KiB window, and about 256 KiB of memory in all), and so every frame is compressed again for
+every websocket it is sent to. In the 'shared' mode, the server compresses each message on its own instead (the
+server_no_context_takeover parameter), so the same frame compressed with the same settings gives the same bytes on
+every connection: each frame is compressed once, and the result reused for the other websockets it goes to. This
+compresses short messages less well, but bot replies with large HTML, CSS and JS compress well enough on their own.
+
+Run uvicorn with `ws=WebSocketProtocol` (as `python -m necsus` does) to use these settings.
+"""
+import collections
+import functools
+import hashlib
+import zlib
+
+from uvicorn.protocols.websockets.websockets_impl import (
+    WebSocketProtocol as UvicornWebSocketProtocol,
+)
+from websockets.extensions.permessage_deflate import (
+    PerMessageDeflate,
+    ServerPerMessageDeflateFactory,
+)
+from websockets.frames import CTRL_OPCODES, Frame, Opcode
+
+from .metrics import Counter
+from .server import config
+
+DEFLATE_MODES = ('shared', 'context', 'off')
+
+BYTES_IN = Counter('necsus_ws_deflate_bytes_in', 'Bytes of websocket messages before compression.')
+BYTES_OUT = Counter('necsus_ws_deflate_bytes_out', 'Bytes of websocket messages after compression.')
+SHARED_HITS = Counter('necsus_ws_deflate_shared_hits', 'Websocket messages sent already compressed for another websocket.')
+
+# The same bytes which Z_SYNC_FLUSH ends with, which permessage-deflate leaves off the end of each message.
+_EMPTY_UNCOMPRESSED_BLOCK = b'\x00\x00\xff\xff'
+
+
+class SharedCompressions:
+    """
+    The most recently compressed messages, keyed by (window bits, digest of the uncompressed message) so that the
+    uncompressed messages themselves are not kept. At most `size` messages are kept, and `max_bytes` of them in all.
+    """
+
+    def __init__(self, size: int = 64, max_bytes: int = 4 * 1024 * 1024):
+        self.size = size
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._compressed = collections.OrderedDict()
+
+    def compress(self, data: bytes, window_bits: int, compress_settings: dict) -> bytes:
+        key = (window_bits, hashlib.blake2b(data, digest_size=16).digest())
+        if (compressed := self._compressed.get(key)) is not None:
+            self._compressed.move_to_end(key)
+            SHARED_HITS.inc()
+        else:
+            encoder = zlib.compressobj(wbits=-window_bits, **compress_settings)
+            compressed = (encoder.compress(data) + encoder.flush(zlib.Z_SYNC_FLUSH))[:-len(_EMPTY_UNCOMPRESSED_BLOCK)]
+            self._compressed[key] = compressed
+            self.bytes += len(compressed)
+            while len(self._compressed) > self.size or self.bytes > self.max_bytes:
+                _, dropped = self._compressed.popitem(last=False)
+                self.bytes -= len(dropped)
+
+        BYTES_IN.inc(len(data))
+        BYTES_OUT.inc(len(compressed))
+        return compressed
+
+
+class SharedPerMessageDeflate(PerMessageDeflate):
+    """PerMessageDeflate without server context takeover, sharing the compression of each message between connections."""
+
+    def __init__(self, *args, shared: SharedCompressions):
+        super().__init__(*args)
+        self.shared = shared
+
+    def encode(self, frame: Frame) -> Frame:
+        # Messages sent in several frames are compressed as usual, though websockets only does that for messages
+        # sent from an iterator, which Starlette never does.
+        if frame.opcode in CTRL_OPCODES or frame.opcode is Opcode.CONT or not frame.fin:
+            return super().encode(frame)
+
+        data = self.shared.compress(bytes(frame.data), self.local_max_window_bits, self.compress_settings)
+        return Frame(frame.opcode, data, frame.fin, True, frame.rsv2, frame.rsv3)
+
+
+class SharedDeflateFactory(ServerPerMessageDeflateFactory):
+    def __init__(self, shared: SharedCompressions, **kwargs):
+        super().__init__(server_no_context_takeover=True, **kwargs)
+        self.shared = shared
+
+    def process_request_params(self, params, accepted_extensions):
+        response_params, extension = super().process_request_params(params, accepted_extensions)
+        return response_params, SharedPerMessageDeflate(
+            extension.remote_no_context_takeover,
+            extension.local_no_context_takeover,
+            extension.remote_max_window_bits,
+            extension.local_max_window_bits,
+            extension.compress_settings,
+            shared=self.shared,
+        )
+
+
+def deflate_factory(mode: str, window_bits: int = 12, mem_level: int = 5, level: int = 6, shared: SharedCompressions | None = None):
+    """
+    Return the permessage-deflate extension factory for a mode:
+      - 'shared': each message is compressed on its own, and the compression shared between connections.
+      - 'context': each connection keeps its compressor between messages, compressing better but separately.
+      - 'off': no compression.
+    The window bits bound the memory a client needs to decompress, and the server's memory is also bounded by the
+    zlib memory level. Both are used for each direction.
+    """
+    if mode not in DEFLATE_MODES:
+        raise ValueError(f"The websocket deflate mode should be one of {DEFLATE_MODES}, got {mode!r}")
+    if mode == 'off':
+        return None
+
+    options = dict(
+        server_max_window_bits=window_bits,
+        client_max_window_bits=window_bits,
+        compress_settings={'memLevel': mem_level, 'level': level},
+    )
+    if mode == 'shared':
+        return SharedDeflateFactory(shared if shared is not None else SharedCompressions(), **options)
+    return ServerPerMessageDeflateFactory(**options)
+
+
+@functools.cache
+def configured_extensions() -> list:
+    """The extensions for websockets to offer, from the NECSUS_WS_DEFLATE_* settings, shared by every connection."""
+    factory = deflate_factory(
+        config.get('WS_DEFLATE', str, 'shared'),
+        window_bits=config.get('WS_DEFLATE_WINDOW_BITS', int, 12),
+        mem_level=config.get('WS_DEFLATE_MEM_LEVEL', int, 5),
+        level=config.get('WS_DEFLATE_LEVEL', int, 6),
+        shared=SharedCompressions(max_bytes=config.get('WS_DEFLATE_SHARED_BYTES', int, 4 * 1024 * 1024)),
+    )
+    return [factory] if factory is not None else []
+
+
+class WebSocketProtocol(UvicornWebSocketProtocol):
+    """uvicorn's websockets protocol, with permessage-deflate configured by the NECSUS_WS_DEFLATE_* settings."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.available_extensions = configured_extensions()
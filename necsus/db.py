@@ -1,27 +1,74 @@
+import asyncio
+import concurrent.futures
+import functools
 import json
+import queue
 import sqlite3
+import threading
 import time
 
-import pypika
-from pypika import Query, Table
+from .metrics import Histogram
+
+# RETURNING clauses were added in SQLite 3.35.0.
+HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+# The largest integer SQLite can store, so larger than any message ID.
+MAX_ID = 2**63 - 1
+
+
+# The SQL for each access pattern is built once and cached, with values always passed as ? parameters, so that the
+# same SQL text is reused on each call and sqlite3 can reuse its prepared statement from the connection's cache.
+
+def _quote(name: str) -> str:
+  return '"' + name.replace('"', '""') + '"'
+
+
+def _where(columns) -> str:
+  return ' WHERE ' + ' AND '.join(f'{_quote(column)} = ?' for column in columns) if columns else ''
+
+
+@functools.lru_cache(maxsize=None)
+def select_sql(table: str, columns: tuple) -> str:
+  """SELECT * FROM table WHERE column = ? AND ..."""
+  return f'SELECT * FROM {_quote(table)}{_where(columns)}'
+
+
+@functools.lru_cache(maxsize=None)
+def insert_sql(table: str, columns: tuple, returning: bool) -> str:
+  """INSERT INTO table (column, ...) VALUES (?, ...), optionally returning the inserted row."""
+  sql = f'INSERT INTO {_quote(table)} ({", ".join(map(_quote, columns))}) VALUES ({", ".join("?" * len(columns))})'
+  return sql + ' RETURNING *' if returning else sql
+
+
+@functools.lru_cache(maxsize=None)
+def update_sql(table: str, columns: tuple, where: tuple, returning: bool) -> str:
+  """UPDATE table SET column = ?, ... WHERE column = ? AND ..., optionally returning the updated row."""
+  sql = f'UPDATE {_quote(table)} SET {", ".join(f"{_quote(column)} = ?" for column in columns)}{_where(where)}'
+  return sql + ' RETURNING *' if returning else sql
+
+
+@functools.lru_cache(maxsize=None)
+def delete_sql(table: str, columns: tuple) -> str:
+  """DELETE FROM table WHERE column = ? AND ..."""
+  return f'DELETE FROM {_quote(table)}{_where(columns)}'
 
 
 class DBList(dict):
-  table = Table('')
+  table = ''
 
-  def __init__(self, connection):
+  def __init__(self, connection, autocommit: bool = True):
     self.connection = connection
     self.connection.row_factory = lambda x,y: dict(sqlite3.Row(x,y))
+    self.autocommit = autocommit
+
+  def commit(self):
+    """Commit after a write, unless commits are left to the caller (see GroupCommitWriter)."""
+    if self.autocommit:
+      self.connection.commit()
 
   def _find(self, **kwargs):
     c = self.connection.cursor()
-
-    search = [getattr(self.table, key) == value for key, value in kwargs.items()]
-    q = Query.from_(self.table).select(self.table.star)
-    for condition in search:
-      q = q.where(condition)
-
-    c.execute(q.get_sql())
+    c.execute(select_sql(self.table, tuple(kwargs)), tuple(kwargs.values()))
     return c
 
   def find(self, **kwargs):
@@ -30,106 +77,102 @@ class DBList(dict):
   def find_all(self, **kwargs):
     return self._find(**kwargs).fetchall()
 
+  def _write_returning(self, c, sql: str, params, rowid=None):
+    """
+    Run an INSERT or UPDATE of a single row built with returning=HAS_RETURNING, and return the row as it was stored
+    (including defaults and any type conversions). With RETURNING this is the same round trip. On older versions of
+    SQLite, the row is looked up by its rowid, which is the inserted row's unless given.
+    """
+    if HAS_RETURNING:
+      rows = c.execute(sql, params).fetchall()
+      return rows[0] if rows else None
+
+    c.execute(sql, params)
+    rowid = c.lastrowid if rowid is None else rowid
+    return c.execute(select_sql(self.table, ('rowid',)), (rowid,)).fetchone()
+
   def add(self, **kwargs):
+    """Insert a row, returning it as stored."""
     c = self.connection.cursor()
-    q = Query.into(self.table).columns(*kwargs.keys()).insert(*kwargs.values())
-    c.execute(q.get_sql())
-    self.connection.commit()
-    return kwargs
+    row = self._write_returning(c, insert_sql(self.table, tuple(kwargs), HAS_RETURNING), tuple(kwargs.values()))
+    self.commit()
+    return row
 
   def update_or_add(self, **kwargs):
     c = self.connection.cursor()
 
     try:
       # Try to add
-      q = Query.into(self.table)\
-      .columns(*kwargs.keys())\
-      .insert(*kwargs.values())
-      c.execute(q.get_sql())
-      kwargs['id'] = c.lastrowid
+      row = self._write_returning(c, insert_sql(self.table, tuple(kwargs), HAS_RETURNING), tuple(kwargs.values()))
     except sqlite3.IntegrityError:
       # If the key is a duplicate
       # then update
-      q = Query.update(self.table).where(self.table.id == kwargs['id'])
-      for key, value in kwargs.items():
-        if key != id:
-          q = q.set(key, value)
-      c.execute(q.get_sql())
+      sql = update_sql(self.table, tuple(kwargs), ('id',), HAS_RETURNING)
+      row = self._write_returning(c, sql, (*kwargs.values(), kwargs['id']), rowid=kwargs['id'])
 
-    self.connection.commit()
-    return self.find(id=kwargs['id'])
+    self.commit()
+    return row
 
   def add_if_new(self, **kwargs):
     c = self.connection.cursor()
 
-    search = [getattr(self.table, key) == value for key, value in kwargs.items()]
-    q = Query.from_(self.table).select(self.table.star)
-    for condition in search:
-      q = q.where(condition)
-    c.execute(q.get_sql())
-
+    c.execute(select_sql(self.table, tuple(kwargs)), tuple(kwargs.values()))
     result = c.fetchone()
     new = result == None
 
     if new:
-      q = Query.into(self.table)\
-      .columns(*kwargs.keys())\
-      .insert(*kwargs.values())
-      c.execute(q.get_sql())
+      c.execute(insert_sql(self.table, tuple(kwargs), False), tuple(kwargs.values()))
 
-    self.connection.commit()
+    self.commit()
     return kwargs
 
   def delete(self, **kwargs):
     c = self.connection.cursor()
-
-    search = [getattr(self.table, key) == value for key, value in kwargs.items()]
-    q = Query.from_(self.table).delete()
-    for condition in search:
-      q = q.where(condition)
-    c.execute(q.get_sql())
-    self.connection.commit()
+    c.execute(delete_sql(self.table, tuple(kwargs)), tuple(kwargs.values()))
+    self.commit()
 
     return c.fetchone()
 
   def remove(self, id):
     c = self.connection.cursor()
-    q = Query.from_(self.table).delete().where(self.table.id == id)
-    c.execute(q.get_sql())
-    self.connection.commit()
+    c.execute(delete_sql(self.table, ('id',)), (id,))
+    self.commit()
     return c.rowcount > 0
 
 
 class Messages(DBList):
-  table = Table('messages')
+  table = 'messages'
   allowed_keys = ['id', 'room', 'author', 'kind', 'text', 'when', 'image', 'media', 'js', 'css', 'from_bot', 'base_url', 'state']
 
-  def since(self, room: str, since_id: int = -1):
-    """Return a list of all messages in the room with IDs strictly greater than a given ID, in ascending ID order."""
-    query = (
-      Query
-      .from_(self.table)
-      .select(self.table.star)
-      .where(self.table.room == room)
-      .where(self.table.id > since_id)
-      .orderby('id')
-    )
+  SINCE_SQL = 'SELECT * FROM messages WHERE room = ? AND id > ? AND id < ? ORDER BY id LIMIT ?'
+  BEFORE_SQL = 'SELECT * FROM (SELECT * FROM messages WHERE room = ? AND id > ? AND id < ? ORDER BY id DESC LIMIT ?) ORDER BY id'
+  LAST_SQL = 'SELECT * FROM messages WHERE room = ? ORDER BY id DESC LIMIT 1'
+  SET_ROOM_STATE_SQL = 'REPLACE INTO room_state (room, from_bot, state) VALUES (?, ?, ?)'
+  CLEAR_ROOM_STATE_SQL = 'DELETE FROM room_state WHERE room = ?'
+  GET_ROOM_STATE_SQL = 'SELECT from_bot, state FROM room_state WHERE room = ?'
+
+  def since(self, room: str, since_id: int = -1, limit: int = -1, before_id: int | None = None):
+    """
+    Return a list of the messages in the room with IDs strictly greater than a given ID (and strictly less than
+    before_id, if given), in ascending ID order: all of them, or if a limit is given, the first `limit` of them.
+    """
     c = self.connection.cursor()
-    c.execute(query.get_sql())
+    c.execute(self.SINCE_SQL, (room, since_id, MAX_ID if before_id is None else before_id, limit))
+    return c.fetchall()
+
+  def before(self, room: str, before_id: int | None = None, limit: int = -1, after_id: int = -1):
+    """
+    Return a list of the latest `limit` messages in the room with IDs strictly less than before_id (or the latest in
+    the room, if before_id is None), and strictly greater than after_id, in ascending ID order.
+    """
+    c = self.connection.cursor()
+    c.execute(self.BEFORE_SQL, (room, after_id, MAX_ID if before_id is None else before_id, limit))
     return c.fetchall()
 
   def last(self, room: str):
     """Return the most recent message in the room."""
-    query = (
-      Query
-      .from_(self.table)
-      .select(self.table.star)
-      .where(self.table.room == room)
-      .orderby('id', order=pypika.Order.desc)
-      .limit(1)
-    )
     c = self.connection.cursor()
-    c.execute(query.get_sql())
+    c.execute(self.LAST_SQL, (room,))
     message = c.fetchone()
     return message
 
@@ -141,49 +184,316 @@ class Messages(DBList):
       message['state'] = json.dumps(message['state'])
 
     c = self.connection.cursor()
-    keys = [key for key in message.keys() if key in self.allowed_keys]
-    values = [value for key,value in message.items() if key in self.allowed_keys]
-    q = Query.into(self.table).columns(*keys).insert(*values)
-    c.execute(q.get_sql())
-    self.connection.commit()
-    return self.last(room=message['room'])
+    keys = tuple(key for key in message.keys() if key in self.allowed_keys)
+    values = tuple(value for key,value in message.items() if key in self.allowed_keys)
+    row = self._write_returning(c, insert_sql(self.table, keys, HAS_RETURNING), values)
+    self._update_room_state(c, message['room'], message.get('from_bot'), message.get('state'))
+    self.commit()
+    return row
+
+  def _update_room_state(self, c, room: str, from_bot, state):
+    """The room state follows the most recent message: set it if the message has state, otherwise clear it."""
+    if state != None:
+      c.execute(self.SET_ROOM_STATE_SQL, (room, from_bot, state))
+    else:
+      c.execute(self.CLEAR_ROOM_STATE_SQL, (room,))
+
+  def clear_room(self, room: str):
+    """
+    Delete all messages in a room, along with any conversation state.
+    Returns the ID of the last message deleted, or None if the room was already empty.
+    """
+    if (last := self.last(room=room)) is None:
+      return None
 
+    c = self.connection.cursor()
+    c.execute(delete_sql(self.table, ('room',)), (room,))
+    self._update_room_state(c, room, None, None)
+    self.commit()
+    return last['id']
 
   def room_state(self, room_name):
     "Return None if the room has no special state, otherwise (bot_id, state)"
 
-    room_messages = self.find_all(room=room_name)
-    if room_messages == []:
+    c = self.connection.cursor()
+    c.execute(self.GET_ROOM_STATE_SQL, (room_name,))
+    if (row := c.fetchone()) is None:
       return None
 
-    last_message = room_messages[-1]
-    if last_message['state'] != None:
-      state = json.loads(last_message.get('state', None))
-      return last_message['from_bot'], state
+    return row['from_bot'], json.loads(row['state'])
 
+
+class Bots(DBList):
+  """
+  Bots are read on every message posted, but change rarely, so the bots in each room are kept in a write-through
+  cache. A room's bots are loaded the first time .in_room() asks for them, and kept up to date by the methods below,
+  so all writes to the bots table should go through this class.
+
+  The cached bots of a room are an immutable tuple which is replaced on each change, so .cached() may be called from
+  any thread, while the other methods run on the thread owning the connection.
+  """
+  table = 'bots'
+
+  PAGE_SQL = 'SELECT * FROM bots WHERE id > ? ORDER BY id LIMIT ?'
+
+  def __init__(self, connection, autocommit: bool = True):
+    super().__init__(connection, autocommit)
+    self._by_room: dict[str, tuple] = {}  # Maps room -> bots in the room, in ID order.
+
+  def cached(self, room: str):
+    """Return the bots in a room if they are cached, otherwise None."""
+    if (bots := self._by_room.get(room)) is not None:
+      return list(bots)
     return None
 
+  def in_room(self, room: str) -> list:
+    """Return the bots in a room, in ID order. The bots are shared with the cache, and should not be modified."""
+    if (bots := self._by_room.get(room)) is None:
+      bots = self._by_room[room] = tuple(self._find(room=room).fetchall())
+    return list(bots)
 
-class Bots(DBList):
-  table = Table('bots')
+  def page(self, after_id: int = -1, limit: int = -1) -> list:
+    """Return the first `limit` bots on the server (or all of them) with IDs strictly greater than after_id, in ID order."""
+    return self.connection.execute(self.PAGE_SQL, (after_id, limit)).fetchall()
+
+  def clear_cache(self):
+    """Forget all the cached bots, for instance because another process has changed the bots table."""
+    self._by_room.clear()
+
+  def _forget(self, id):
+    for room, bots in list(self._by_room.items()):
+      if any(bot['id'] == id for bot in bots):
+        self._by_room[room] = tuple(bot for bot in bots if bot['id'] != id)
+
+  def add(self, **kwargs):
+    bot = super().add(**kwargs)
+    if (bots := self._by_room.get(bot['room'])) is not None:
+      self._by_room[bot['room']] = tuple(sorted([*bots, bot], key=lambda bot: bot['id']))
+    return bot
+
+  def update_or_add(self, **kwargs):
+    bot = super().update_or_add(**kwargs)
+    self._forget(bot['id'])
+    if (bots := self._by_room.get(bot['room'])) is not None:
+      self._by_room[bot['room']] = tuple(sorted([*bots, bot], key=lambda bot: bot['id']))
+    return bot
+
+  def add_if_new(self, **kwargs):
+    self._by_room.clear()
+    return super().add_if_new(**kwargs)
+
+  def delete(self, **kwargs):
+    self._by_room.clear()
+    return super().delete(**kwargs)
+
+  def remove(self, id):
+    self._forget(id)
+    return super().remove(id)
 
 
 class Clears(DBList):
-  table = Table('clears')
+  table = 'clears'
 
   def set_last_cleared_id(self, room: str, last_cleared_id: int):
     if self.find(room=room) is None:
       self.add(room=room, last_cleared_id=last_cleared_id)
     else:
       c = self.connection.cursor()
-      q = Query.update(self.table).where(self.table.room == room).set('last_cleared_id', last_cleared_id)
-      c.execute(q.get_sql())
-      self.connection.commit()
+      c.execute(update_sql(self.table, ('last_cleared_id',), ('room',), False), (last_cleared_id, room))
+      self.commit()
 
 
 class DB():
-  def __init__(self, connection):
+  def __init__(self, connection, autocommit: bool = True):
     self._connection = connection
-    self.messages = Messages(connection)
-    self.bots = Bots(connection)
-    self.clears = Clears(connection)
+    self.messages = Messages(connection, autocommit)
+    self.bots = Bots(connection, autocommit)
+    self.clears = Clears(connection, autocommit)
+
+
+# Methods of the tables above which only read from the database, and so may run on a read-only connection.
+READ_METHODS = {'find', 'find_all', 'since', 'before', 'last', 'room_state', 'page'}
+
+QUERY_SECONDS = Histogram('necsus_db_query_seconds', 'Time spent running each kind of database query.', ['table', 'method'])
+QUEUE_SECONDS = Histogram('necsus_db_queue_seconds', 'Time database queries spent waiting for a connection.', ['pool'])
+COMMIT_SECONDS = Histogram('necsus_db_commit_seconds', 'Time spent committing each batch of writes.')
+COMMIT_BATCH_SIZE = Histogram('necsus_db_commit_batch_size', 'Number of queries committed together.', buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+
+
+class GroupCommitWriter():
+  """
+  Runs write jobs on a single thread owning the writer connection, committing them in batches. After taking a job,
+  the writer keeps taking jobs until `window` seconds have passed or it has `max_batch` of them, runs them all in one
+  transaction (each inside its own savepoint, so a job which fails does not undo the others), and commits once.
+  Only then are the jobs' futures resolved, so a write is as durable when its future resolves as with a commit each.
+  """
+
+  def __init__(self, connection, window: float = 0.001, max_batch: int = 100):
+    self.connection = connection
+    self.db = DB(connection, autocommit=False)
+    self.window = window
+    self.max_batch = max_batch
+    self._jobs = queue.SimpleQueue()
+    self._thread = threading.Thread(target=self._run, name='necsus-db-writer', daemon=True)
+    self._thread.start()
+
+  def submit(self, job) -> concurrent.futures.Future:
+    """Queue a call of job(), returning a future for its result."""
+    future = concurrent.futures.Future()
+    self._jobs.put((job, future))
+    return future
+
+  def _run(self):
+    stopping = False
+    while not stopping:
+      if (first := self._jobs.get()) is None:
+        break
+
+      batch = [first]
+      deadline = time.perf_counter() + self.window
+      while len(batch) < self.max_batch:
+        try:
+          job = self._jobs.get(timeout=max(deadline - time.perf_counter(), 0))
+        except queue.Empty:
+          break
+        if job is None:
+          stopping = True
+          break
+        batch.append(job)
+
+      self._run_batch(batch)
+
+  def _run_batch(self, batch):
+    COMMIT_BATCH_SIZE.observe(len(batch))
+    outcomes = []
+    try:
+      # Take the write lock up front, waiting for any other process writing to the database, rather than finding the
+      # database locked partway through a job which reads before it writes.
+      self.connection.execute('BEGIN IMMEDIATE')
+    except Exception as e:
+      for job, future in batch:
+        if future.set_running_or_notify_cancel():
+          future.set_exception(e)
+      return
+    for job, future in batch:
+      if not future.set_running_or_notify_cancel():
+        continue
+
+      self.connection.execute('SAVEPOINT job')
+      try:
+        outcomes.append((future, job(), None))
+        self.connection.execute('RELEASE job')
+      except BaseException as e:
+        self.connection.execute('ROLLBACK TO job')
+        self.connection.execute('RELEASE job')
+        outcomes.append((future, None, e))
+
+    started_at = time.perf_counter()
+    try:
+      self.connection.commit()
+    except Exception as e:
+      self.connection.rollback()
+      # The cached bots may include writes which were just rolled back.
+      self.db.bots._by_room.clear()
+      for future, _, _ in outcomes:
+        future.set_exception(e)
+      return
+    finally:
+      COMMIT_SECONDS.observe(time.perf_counter() - started_at)
+
+    for future, result, exception in outcomes:
+      if exception is None:
+        future.set_result(result)
+      else:
+        future.set_exception(exception)
+
+  def close(self):
+    """Finish the queued jobs, then stop the writer thread."""
+    self._jobs.put(None)
+    self._thread.join()
+
+
+class AsyncDB():
+  """
+  An async facade over DB, which runs every query on a thread so that the event loop never waits for SQLite. It is
+  used like DB, but each method call must be awaited, eg `await db.messages.since(room, since_id)`.
+
+  Writes (and anything else not in READ_METHODS) run on a GroupCommitWriter, which owns the main connection, since
+  SQLite only allows one writer anyway. Reads run on a pool of reader threads, each with its own read-only
+  connection, which WAL mode allows to read while the writer is writing. With no reader_connect function (for instance
+  for an in-memory database, which other connections cannot see), reads also go to the writer.
+  """
+
+  def __init__(self, connection, reader_connect=None, readers: int = 4, commit_window: float = 0.001, commit_batch: int = 100):
+    self._writer = GroupCommitWriter(connection, window=commit_window, max_batch=commit_batch)
+    self._write_db = self._writer.db
+    self._connections = [connection]
+
+    self._readers = None
+    if reader_connect is not None and readers > 0:
+      self._reader_connect = reader_connect
+      self._reader_dbs = threading.local()
+      self._readers = concurrent.futures.ThreadPoolExecutor(max_workers=readers, thread_name_prefix='necsus-db-reader')
+
+    self.messages = _AsyncTable(self, 'messages')
+    self.bots = _AsyncBots(self, 'bots')
+    self.clears = _AsyncTable(self, 'clears')
+
+  def _reader_db(self) -> DB:
+    """The DB for the current reader thread, connecting on first use."""
+    if (db := getattr(self._reader_dbs, 'db', None)) is None:
+      connection = self._reader_connect()
+      self._connections.append(connection)
+      db = self._reader_dbs.db = DB(connection)
+    return db
+
+  async def _run(self, read: bool, table: str, method: str, query_seconds, args=(), kwargs={}):
+    queued_at = time.perf_counter()
+    read = read and self._readers is not None
+    queue_seconds = QUEUE_SECONDS.labels('reader' if read else 'writer')
+
+    def query():
+      started_at = time.perf_counter()
+      queue_seconds.observe(started_at - queued_at)
+      db = self._reader_db() if read else self._write_db
+      try:
+        return getattr(getattr(db, table), method)(*args, **kwargs)
+      finally:
+        query_seconds.observe(time.perf_counter() - started_at)
+
+    return await asyncio.wrap_future((self._readers if read else self._writer).submit(query))
+
+  def close(self):
+    """Wait for queued queries to finish, then close all connections."""
+    if self._readers is not None:
+      self._readers.shutdown()
+    self._writer.close()
+    for connection in self._connections:
+      connection.close()
+
+
+class _AsyncTable():
+  """Stands in for one of the tables of a DB, turning each method into an async function run by the AsyncDB."""
+
+  def __init__(self, adb: AsyncDB, table: str):
+    self._adb = adb
+    self._table = table
+
+  def __getattr__(self, method: str):
+    read = method in READ_METHODS
+    query_seconds = QUERY_SECONDS.labels(self._table, method)
+
+    async def call(*args, **kwargs):
+      return await self._adb._run(read, self._table, method, query_seconds, args, kwargs)
+
+    # Keep the function around, so that __getattr__ is only called the first time.
+    setattr(self, method, call)
+    return call
+
+
+class _AsyncBots(_AsyncTable):
+  async def in_room(self, room: str) -> list:
+    """Bots.in_room(), answered straight from the cache without leaving the event loop when possible."""
+    if (bots := self._adb._write_db.bots.cached(room)) is not None:
+      return bots
+    return await self._adb._run(False, 'bots', 'in_room', QUERY_SECONDS.labels('bots', 'in_room'), (room,))
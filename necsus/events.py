@@ -3,14 +3,63 @@ Events contains the business logic for receiving messages and dispatching them t
 """
 import html
 import json
+import time
 import urllib.parse
 
+import anyio
 import httpx
-import regex
+
+from . import circuit, matching
+from .botclient import ReplyTooLarge
+from .metrics import Counter, Histogram
+
+# The outcomes of contacting a bot, for the necsus_bot_requests metric.
+BOT_OUTCOMES = ('ok', 'connect_error', 'timeout', 'http_error', 'invalid_reply', 'circuit_open', 'error')
+
+BOT_REQUEST_SECONDS = Histogram('necsus_bot_request_seconds', 'Time taken for each bot to reply, whatever the outcome.', ['bot'])
+BOT_REQUESTS = Counter('necsus_bot_requests', 'Requests to each bot, by outcome.', ['bot', 'outcome'])
+
+REPLIES_REJECTED = Counter('necsus_bot_replies_rejected', 'Bot replies ignored for being longer than the byte limit.')
+REPLIES_TRUNCATED = Counter(
+    'necsus_bot_replies_truncated', 'Bot replies with a field cut short (text) or left out (css, js) for being too long, by field.', ['field'],
+)
+_REPLIES_TRUNCATED = {field: REPLIES_TRUNCATED.labels(field) for field in ('text', 'css', 'js')}
+
+# The most characters of a bot's invalid reply to quote back in an error message.
+ERROR_EXCERPT_CHARS = 1000
+
+# Maps a bot ID (None for bots not installed in a room) -> (its BOT_REQUEST_SECONDS, {outcome: its BOT_REQUESTS}).
+_bot_metrics = {}
+
+
+def bot_metrics(bot_id):
+    if (metrics := _bot_metrics.get(bot_id)) is None:
+        label = str(bot_id) if bot_id is not None else 'none'
+        metrics = _bot_metrics[bot_id] = (
+            BOT_REQUEST_SECONDS.labels(label),
+            {outcome: BOT_REQUESTS.labels(label, outcome) for outcome in BOT_OUTCOMES},
+        )
+    return metrics
+
+
+def forget_bot_metrics(bot_id):
+    """Stop reporting the metrics of a bot, for instance because it has been deleted."""
+    if _bot_metrics.pop(bot_id, None) is not None:
+        BOT_REQUEST_SECONDS.remove(str(bot_id))
+        for outcome in BOT_OUTCOMES:
+            BOT_REQUESTS.remove(str(bot_id), outcome)
 
 
 class BotException(Exception):
-    """An exception type for when we can tell what is probably going wrong with a bot."""
+    """
+    An exception type for when we can tell what is probably going wrong with a bot. A silent exception is not posted
+    to the room, since the room has already been told.
+    """
+
+    def __init__(self, message: str, outcome: str = 'invalid_reply', silent: bool = False):
+        super().__init__(message)
+        self.outcome = outcome
+        self.silent = silent
 
 
 def system_message(room: str, text: str):
@@ -31,34 +80,46 @@ def standard_message_for_bot(room: str, author: str, text: str, params=None, sta
     return message
 
 
-async def trigger_message_post(db, broker, room: str, author: str, text: str, image, media, css, js, base_url):
-    special_state = db.messages.room_state(room_name=room)
-    message = db.messages.add(room=room, author=author, text=text, image=image, media=media, css=css, js=js, base_url=base_url)
-    broker.publish_message(room, message)
+async def trigger_message_post(db, broker, client, matcher, room: str, author: str, text: str, image, media, css, js, base_url):
+    message, special_state = await post_user_message(db, broker, room, author, text, image, media, css, js, base_url)
+    await trigger_message_bots(db, broker, client, matcher, room, author, text, special_state)
+    return message
+
+
+async def post_user_message(db, broker, room: str, author: str, text: str, image, media, css, js, base_url):
+    """
+    Store and broadcast a message from a user, without triggering any bots. Returns (message, special_state), where
+    special_state is the state of the room from before the message was posted, to be passed to trigger_message_bots().
+    """
+    special_state = await db.messages.room_state(room_name=room)
+    message = await db.messages.add(room=room, author=author, text=text, image=image, media=media, css=css, js=js, base_url=base_url)
+    await broker.publish_message(room, message)
+    return message, special_state
+
 
+async def trigger_message_bots(db, broker, client, matcher, room: str, author: str, text: str, special_state) -> None:
+    """Trigger the bot holding the room's state if there is one, otherwise all bots matching the message."""
     if special_state:
         bot_id, state = special_state
-        bots = db.bots.find_all(id=bot_id)
+        bots = await db.bots.find_all(id=bot_id)
         if len(bots) != 1:
-            return message
+            return
 
         bot = bots[0]
         msg = standard_message_for_bot(room=room, author=author, text=text, params={}, state=state)
-        reply = await trigger_bot(room, bot, msg)
-        reply = db.messages.add(**reply)
-        broker.publish_message(room, reply)
+        if (reply := await trigger_bot(client, room, bot, msg)) is not None:
+            reply = await db.messages.add(**reply)
+            await broker.publish_message(room, reply)
     else:
-        await match_and_trigger_bots(db, broker, room, author, text)
-
-    return message
+        await match_and_trigger_bots(db, broker, client, matcher, room, author, text)
 
 
-async def trigger_message_form_post(db, broker, room: str, author: str, bot_id: int, action_url: str, form_data):
-    bot = db.bots.find(id=bot_id)
+async def trigger_message_form_post(db, broker, client, room: str, author: str, bot_id: int, action_url: str, form_data):
+    bot = await db.bots.find(id=bot_id)
     if bot is None:
         error = system_message(room, "The bot associated to that form can't be found - perhaps it was deleted?")
-        db.messages.add(**error)
-        broker.publish_message(room, error)
+        error = await db.messages.add(**error)
+        await broker.publish_message(room, error)
         return
 
     # We want the action_url to be relative to the bot's endpoint. For instance, say that the bot is at
@@ -69,95 +130,152 @@ async def trigger_message_form_post(db, broker, room: str, author: str, bot_id:
     url = urllib.parse.urljoin(bot['url'], action_url)
 
     # Either fetch the bot with this URL, or create a new transient bot which has no ID.
-    to_bot = db.bots.find(room=room, url=url) or {'room': room, 'name': url, 'url': url}
+    to_bot = (await db.bots.find(room=room, url=url)) or {'room': room, 'name': url, 'url': url}
     msg = {'room': room, 'author': author, 'form_data': form_data}
-    special_state = db.messages.room_state(room_name=room)
+    special_state = await db.messages.room_state(room_name=room)
     if special_state is not None:
         _, state = special_state
         msg['state'] = state
 
-    reply = await trigger_bot(room, to_bot, msg)
+    if (reply := await trigger_bot(client, room, to_bot, msg)) is None:
+        return
 
     # If this new bot replied with some conversation state, but it's not installed into the room, let's just make up a
     # new bot so that we can put an ID in the from_bot field.
     if reply.get('state') is not None and to_bot.get('id') is None:
-        db.bots.add(room=room, name=f"(Auto) {url}", url=url)
-        to_bot = db.bots.find(room=room, url=url)
-        broker.put_bot(room, to_bot)
+        to_bot = await db.bots.add(room=room, name=f"(Auto) {url}", url=url)
+        await broker.put_bot(room, to_bot)
         reply['from_bot'] = to_bot['id']
 
     print("Reply before:", reply)
-    reply = db.messages.add(**reply)
+    reply = await db.messages.add(**reply)
     print("Reply after:", reply)
-    broker.publish_message(room, reply)
+    await broker.publish_message(room, reply)
 
 
-def trigger_clear_room_state(db, broker, room: str):
+async def trigger_clear_room_state(db, broker, room: str):
     """Post an emptyish message to a room to clear any state left over from the last
     message. This is meant to be used for debugging and development purposes."""
 
-    if db.messages.room_state(room_name=room):
+    if await db.messages.room_state(room_name=room):
         message = system_message(room, 'The room state has been cleared')
-        message = db.messages.add(**message)
-        broker.publish_message(room, message)
+        message = await db.messages.add(**message)
+        await broker.publish_message(room, message)
 
 
-async def match_and_trigger_bots(db, broker, room: str, author: str, text: str) -> None:
-    room_bots = db.bots.find_all(room=room)
+async def match_and_trigger_bots(db, broker, client, matcher, room: str, author: str, text: str) -> None:
+    room_bots = await db.bots.in_room(room)
+    triggered = []
+    unchecked = []
 
-    for bot in room_bots:
-        search = bot.get('responds_to') or bot.get('name')
-        try:
-            print(f"Testing pattern {search!r} in room {room!r} against the message {text!r}")
-            match = regex.search(search, text, flags=regex.IGNORECASE, timeout=0.01)
-        except TimeoutError:
+    for bot, match in await matcher.match(room_bots, text):
+        search = matching.bot_pattern(bot)
+        print(f"Tested pattern {search!r} in room {room!r} against the message {text!r}")
+        if isinstance(match, matching.MatchBudgetExceeded):
+            unchecked.append(bot.get('name'))
+            continue
+        elif isinstance(match, TimeoutError):
             print("Timed out")
             message = system_message(room=room, text=f'The regular expression <code>{search}</code> timed out on input: <pre><code>{search}</code></pre>')
-            message = db.messages.add(**message)
-            broker.publish_message(room, message)
+            message = await db.messages.add(**message)
+            await broker.publish_message(room, message)
             continue
-        except:
+        elif isinstance(match, Exception):
             name = bot.get('name')
             t = 'responds_to' if bot.get('responds_to') else 'name'
             message = system_message(room=room, text=f'Something went wrong. Bot {name!r} has an invalid {t} regex: <pre>{search}</pre>')
-            message = db.messages.add(**message)
-            broker.publish_message(room, message)
+            message = await db.messages.add(**message)
+            await broker.publish_message(room, message)
             continue
 
         if search and match:
             msg = standard_message_for_bot(room=room, author=author, text=text, params=match.groupdict())
-            reply = await trigger_bot(room, bot, msg)
-            reply = db.messages.add(**reply)
-            broker.publish_message(room, reply)
+            triggered.append((bot, msg))
+
+    if unchecked:
+        names = ', '.join(html.escape(repr(name)) for name in unchecked)
+        message = system_message(room=room, text=f'Matching the message took too long, so these bots were not checked: {names}')
+        message = await db.messages.add(**message)
+        await broker.publish_message(room, message)
 
+    await trigger_bots(db, broker, client, room, triggered)
 
-async def trigger_bot(room: str, bot, msg):
+
+async def trigger_bots(db, broker, client, room: str, triggered) -> None:
+    """
+    Trigger several bots concurrently, given a list of (bot, msg) pairs, within the client's concurrency limits.
+    Each reply is posted into the room as soon as it arrives, or if the client's reply_order is 'bot', as soon as the
+    replies of all bots before it have been posted.
+    """
+    replies = {}
+    next_index = 0
+
+    async def post_reply(reply):
+        if reply is None:
+            return
+        reply = await db.messages.add(**reply)
+        await broker.publish_message(room, reply)
+
+    async def run(index: int, bot, msg):
+        nonlocal next_index
+        async with client.dispatch_slot(room):
+            reply = await trigger_bot(client, room, bot, msg)
+
+        if client.reply_order == 'arrival':
+            await post_reply(reply)
+            return
+
+        # Hold onto replies which arrive early, until every reply ahead of them has been posted.
+        replies[index] = reply
+        while next_index in replies:
+            await post_reply(replies.pop(next_index))
+            next_index += 1
+
+    async with anyio.create_task_group() as tg:
+        for index, (bot, msg) in enumerate(triggered):
+            tg.start_soon(run, index, bot, msg)
+
+
+async def trigger_bot(client, room: str, bot, msg):
     """
     Trigger a bot, sending msg to it in JSON-encoded POST data.
-    Return either the message from the bot, or a system error message.
+    Return either the message from the bot, or a system error message, or None if the room has already been told why
+    the bot can't be contacted.
     """
+    request_seconds, requests = bot_metrics(bot.get('id'))
+    started_at = time.perf_counter()
     try:
-        return await run_bot(room, bot, msg)
+        reply = await run_bot(client, room, bot, msg)
+        requests['ok'].inc()
+        return reply
     except Exception as e:
+        requests[e.outcome if isinstance(e, BotException) else 'error'].inc()
+        if isinstance(e, BotException) and e.silent:
+            return None
+
         error_message = f"<p>Error when running bot {bot['name']}: {type(e).__name__}: {e}.</p>"
         if (f := e.__cause__) is not None:
             error_message += f"Further information: {type(f).__name__}: {f}."
 
         return system_message(room, error_message)
+    finally:
+        request_seconds.observe(time.perf_counter() - started_at)
 
 
-def trigger_clear_room_messages(db, broker, room):
-    if (msg := db.messages.last(room=room)) is not None:
-        db.clears.set_last_cleared_id(room=room, last_cleared_id=msg['id'])
-        db.messages.delete(room=room)
-        broker.clear_room(room)
+async def trigger_clear_room_messages(db, broker, room):
+    if (last_cleared_id := await db.messages.clear_room(room=room)) is not None:
+        await db.clears.set_last_cleared_id(room=room, last_cleared_id=last_cleared_id)
+        await broker.clear_room(room, last_cleared_id)
 
     return room
 
 
-# Timeout before ignoring a bot and considering it unresponsive, in seconds.
-# This used to be 15 seconds, but changed to 120 seconds for bots which use the OpenAI API.
-BOT_TIMEOUT = httpx.Timeout(120.0)
+def excerpt(text: str, max_chars: int = ERROR_EXCERPT_CHARS) -> str:
+    """The start of some text to quote in an error message, saying how much was left out."""
+    if len(text) <= max_chars:
+        return text
+    return f'{text[:max_chars]}\n... ({len(text) - max_chars} more characters)'
+
 
 # Common reasons that students might be getting status codes.
 ERROR_GUESSES = {
@@ -170,34 +288,69 @@ ERROR_GUESSES = {
 }
 
 
-async def run_bot(room: str, bot, msg):
+async def run_bot(client, room: str, bot, msg):
     """
     Contact a bot using a POST request. Either returns a valid message from that bot to be inserted into the room,
-    or raises a BotException.
+    or raises a BotException. The client is the app's shared BotClient.
     """
     name = bot.get('name', 'bot')
     if not (endpoint_url := bot.get('url')):
-        raise BotException("The bot has an empty endpoint URL.")
-
+        raise BotException("The bot has an empty endpoint URL.", 'error')
+
+    breakers = client.breakers
+    breaker = breakers.get(endpoint_url)
+    if (generation := breakers.allow(breaker)) is None:
+        raise BotException(
+            f"Not contacting {bot['name']}, since its host {breaker.host!r} has failed {breaker.failures} time(s) in a row. "
+            f"NeCSuS will try it again in a while.",
+            'circuit_open',
+            silent=not breakers.should_notice(breaker, room),
+        )
+
+    timeout = client.timeouts.timeout(bot)
+    failed = True
+    cancelled = False
+    started_at = time.perf_counter()
     try:
-        async with httpx.AsyncClient() as client:
-            reply = await client.post(endpoint_url, json=msg, timeout=BOT_TIMEOUT)
+        reply = await client.post(endpoint_url, json=msg, timeout=timeout)
+        failed = reply.status_code in circuit.UNAVAILABLE_STATUSES
+        client.timeouts.observe(endpoint_url, time.perf_counter() - started_at)
+    except anyio.get_cancelled_exc_class():
+        # Being cancelled (when the server shuts down, say) says nothing about the bot's host.
+        cancelled = True
+        raise
+    except ReplyTooLarge as e:
+        # The bot is up, just replying with too much.
+        failed = False
+        REPLIES_REJECTED.inc()
+        raise BotException(f"The bot {bot['name']} replied with more than {e.max_bytes} bytes, so its reply was ignored.") from e
     except httpx.ConnectError as e:
-        raise BotException(f"Could not connect to {bot['name']} at the endpoint {endpoint_url!r}. Is the URL correct?") from e
+        raise BotException(f"Could not connect to {bot['name']} at the endpoint {endpoint_url!r}. Is the URL correct?", 'connect_error') from e
+    except httpx.ConnectTimeout as e:
+        raise BotException(f"Could not connect to {bot['name']} at the endpoint {endpoint_url!r} within {timeout.connect} second(s). Is the bot running?", 'timeout') from e
     except httpx.TimeoutException as e:
-        raise BotException(f"The bot {bot['name']} timed out after {BOT_TIMEOUT.read} seconds(s)") from e
+        # Timing out counts towards the endpoint's reply times, so a bot which has become slower gets longer next time.
+        # Waiting for a connection from the pool says nothing about the bot, though.
+        if not isinstance(e, httpx.PoolTimeout):
+            client.timeouts.observe(endpoint_url, time.perf_counter() - started_at)
+        raise BotException(f"The bot {bot['name']} timed out after {timeout.read:g} seconds(s)", 'timeout') from e
+    finally:
+        if cancelled:
+            breakers.release(breaker, generation)
+        else:
+            breakers.record(breaker, generation, time.perf_counter() - started_at, failed)
 
     if reply.status_code != httpx.codes.OK:
         err = f"<p>The bot {bot['name']} responded with a non-ok status code of {reply.status_code} ({reply.reason_phrase})</p>"
         if guess := ERROR_GUESSES.get(reply.status_code):
             err += '<p>' + guess.format(**bot) + '</p>'
 
-        raise BotException(err)
+        raise BotException(err, 'http_error')
 
     try:
         message = reply.json()
     except json.decoder.JSONDecodeError as e:
-        raise BotException(f"The bot {bot['name']} responded with status code {reply.status_code}, but returned invalid JSON: <pre>{html.escape(reply.text)}</pre>") from e
+        raise BotException(f"The bot {bot['name']} responded with status code {reply.status_code}, but returned invalid JSON: <pre>{html.escape(excerpt(reply.text))}</pre>") from e
 
     if not isinstance(message, dict):
         raise BotException(f"The bot {bot['name']} responded, but its JSON message was <code>{type(message).__name__}</code> instead of <code>dict</code>.")
@@ -209,6 +362,9 @@ async def run_bot(room: str, bot, msg):
         raise BotException(f"The bot {bot['name']} responded, but the <code>text</code> key had the wrong type (should be a string).")
 
     safe_message = {'text': message['text']}
+    if len(message['text']) > client.max_text_chars:
+        _REPLIES_TRUNCATED['text'].inc()
+        safe_message['text'] = f"{message['text'][:client.max_text_chars]}... <em>(cut off after {client.max_text_chars} characters)</em>"
 
     if 'author' in message and isinstance(message['author'], str):
         safe_message['author'] = message['author']
@@ -230,11 +386,13 @@ async def run_bot(room: str, bot, msg):
     if 'media' in message and isinstance(message['media'], str):
         safe_message['media'] = message['media']
 
-    if 'js' in message and isinstance(message['js'], str):
-        safe_message['js'] = message['js']
-
-    if 'css' in message and isinstance(message['css'], str):
-        safe_message['css'] = message['css']
+    # A stylesheet or script cut short would be broken, so one too long is left out.
+    for field in ('js', 'css'):
+        if field in message and isinstance(message[field], str):
+            if len(message[field]) <= client.max_asset_chars:
+                safe_message[field] = message[field]
+            else:
+                _REPLIES_TRUNCATED[field].inc()
 
     safe_message['kind'] = 'bot'
     safe_message['from_bot'] = bot.get('id')
@@ -0,0 +1,134 @@
+"""
+The hub relays broker events between the worker processes of a NeCSuS server, so that a websocket connected to any
+worker sees the events published by every worker. Each worker's HubBroker connects to the hub over a Unix domain
+socket and sends it each event it publishes; the hub sends every event on to every worker, including the one which
+sent it. Since the hub handles one event at a time, all workers see all events in the same order.
+
+Each event is one line: a JSON header [origin, seq, room, kind, id], a tab, and the encoded frame. Neither part can
+contain a raw tab or newline, since JSON escapes them inside strings. The origin identifies the worker which published
+the event, and seq counts up from 0 in each worker, so that a worker can drop an event which arrives twice because it
+was sent again after losing the connection to the hub.
+
+Run the hub on its own with `python -m necsus.hub [socket path]`, or let `python -m necsus` start it when running
+more than one worker.
+"""
+import json
+import logging
+import os
+import pathlib
+import sys
+
+import anyio
+import anyio.abc
+from anyio.streams.buffered import BufferedByteReceiveStream
+
+logger = logging.getLogger('necsus')
+
+# The longest event line accepted, in bytes.
+MAX_LINE = 16 * 1024 * 1024
+
+# The most event lines queued for sending to a worker by the hub, or to the hub by a worker. A worker which falls this
+# far behind is disconnected by the hub, and a worker whose hub falls this far behind drops the queue and reconnects:
+# either way, the worker's websockets are sent to catch up from the database.
+QUEUE_SIZE = 10000
+
+
+def encode_line(origin: str, seq: int, room: str, kind: str, id, frame: str) -> bytes:
+    return (json.dumps([origin, seq, room, kind, id]) + '\t' + frame + '\n').encode()
+
+
+def decode_line(line: bytes):
+    """Return (origin, seq, room, kind, id, frame) from an event line, without its newline."""
+    header, frame = line.decode().split('\t', 1)
+    origin, seq, room, kind, id = json.loads(header)
+    return origin, seq, room, kind, id, frame
+
+
+async def read_lines(stream: anyio.abc.ByteReceiveStream):
+    """
+    Yield each line from a stream (without the newline), until it closes or sends a line longer than MAX_LINE. The
+    caller then closes the connection, so that a worker or hub sending such a line is cut off rather than stopping
+    everything reading from it.
+    """
+    buffered = BufferedByteReceiveStream(stream)
+    while True:
+        try:
+            line = await buffered.receive_until(b'\n', MAX_LINE)
+        except (anyio.EndOfStream, anyio.IncompleteRead):
+            return
+        except anyio.DelimiterNotFound:
+            line = None
+
+        # A long line which arrived in one read is returned whole, rather than raising DelimiterNotFound.
+        if line is None or len(line) > MAX_LINE:
+            logger.error(f"Closing a hub connection which sent a line longer than {MAX_LINE} bytes")
+            return
+        yield line
+
+
+class Hub:
+    """Accepts worker connections on a Unix domain socket, and relays each line from any worker to every worker."""
+
+    def __init__(self, path: str, queue_size: int = QUEUE_SIZE):
+        self.path = path
+        self.queue_size = queue_size
+        self.workers = {}  # Maps the sending end of each worker's queue -> the cancel scope of its connection.
+
+    async def serve(self, task_status=anyio.TASK_STATUS_IGNORED):
+        # A socket file left behind by a hub which did not shut down cleanly would stop us listening.
+        pathlib.Path(self.path).unlink(missing_ok=True)
+        listener = await anyio.create_unix_listener(self.path)
+        logger.info(f"Hub listening on {self.path!r}")
+        task_status.started()
+        await listener.serve(self._handle)
+
+    async def _handle(self, stream: anyio.abc.SocketStream):
+        # Each worker gets its own queue and sender task, so that a worker slow to read cannot hold up the others.
+        send, recv = anyio.create_memory_object_stream(max_buffer_size=self.queue_size)
+        async with stream, anyio.create_task_group() as tg:
+            self.workers[send] = tg.cancel_scope
+            logger.info(f"A worker connected to the hub, making {len(self.workers)}")
+            tg.start_soon(self._send_lines, stream, recv, tg.cancel_scope)
+            try:
+                async for line in read_lines(stream):
+                    self._relay(line + b'\n')
+            except (anyio.BrokenResourceError, OSError) as e:
+                logger.warning(f"Lost the connection to a worker: {e!r}")
+            finally:
+                self.workers.pop(send, None)
+                send.close()
+                tg.cancel_scope.cancel()
+
+    def _relay(self, line: bytes):
+        for worker, cancel_scope in list(self.workers.items()):
+            try:
+                worker.send_nowait(line)
+            except anyio.WouldBlock:
+                # The worker will reconnect, and send its websockets to catch up from the database.
+                logger.warning(f"Disconnecting a worker which fell {self.queue_size} events behind")
+                del self.workers[worker]
+                cancel_scope.cancel()
+
+    async def _send_lines(self, stream: anyio.abc.SocketStream, recv, cancel_scope: anyio.CancelScope):
+        async with recv:
+            try:
+                async for line in recv:
+                    await stream.send(line)
+            except (anyio.BrokenResourceError, anyio.ClosedResourceError, OSError) as e:
+                logger.warning(f"Lost the connection to a worker: {e!r}")
+                cancel_scope.cancel()
+
+
+def main(path: str):
+    if not logger.hasHandlers():
+        logging.basicConfig(level=logging.INFO)
+    try:
+        anyio.run(Hub(path).serve)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        pathlib.Path(path).unlink(missing_ok=True)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1] if len(sys.argv) > 1 else os.environ.get('NECSUS_BROKER_HUB', 'necsus-hub.sock'))
@@ -0,0 +1,288 @@
+"""
+Matching decides which bots in a room respond to a message, by searching the message with each bot's pattern.
+
+Most patterns (bot names especially) can only match text containing some literal string, such as 'echobot' for the
+name 'EchoBot'. Before searching a message with a room's bots, the Matcher looks for each of their required literals in
+the message, and only searches with the patterns whose literals it contains: the others cannot match.
+"""
+import collections
+import functools
+import re
+import threading
+import time
+import warnings
+
+import anyio
+import anyio.to_thread
+import regex
+
+try:
+    from re import _constants as sre_constants
+    from re import _parser as sre_parse
+except ImportError:  # Python 3.10
+    import sre_constants
+    import sre_parse
+
+from .metrics import Counter, Histogram
+
+PATTERN_CACHE_HITS = Counter('necsus_pattern_cache_hits', 'Bot patterns found already compiled in the pattern cache.')
+PATTERN_CACHE_MISSES = Counter('necsus_pattern_cache_misses', 'Bot patterns which had to be compiled.')
+MATCH_SECONDS = Histogram(
+    'necsus_pattern_match_seconds', 'Time spent searching a message with a bot pattern.',
+    buckets=(0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05),
+)
+MATCH_TIMEOUTS = Counter('necsus_pattern_match_timeouts', 'Searches of a message with a bot pattern which timed out.')
+MESSAGE_MATCH_SECONDS = Histogram(
+    'necsus_message_match_seconds', "Time spent matching each message with a room's bots, on a worker thread.",
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5),
+)
+MATCH_BUDGET_EXCEEDED = Counter(
+    'necsus_message_match_budget_exceeded', 'Messages which ran out of time before being searched with every bot pattern.',
+)
+PREFILTER_SKIPS = Counter(
+    'necsus_pattern_prefilter_skips', 'Searches of a message with a bot pattern skipped, since it lacked a required literal.',
+)
+
+# The flags every bot pattern is compiled with.
+BOT_PATTERN_FLAGS = regex.IGNORECASE
+
+
+def bot_pattern(bot):
+    """The pattern a bot responds to: its responds_to regex if it has one, otherwise its name."""
+    return bot.get('responds_to') or bot.get('name')
+
+
+# The characters other than ASCII letters which an ASCII letter matches ignoring case, and whose str.lower() is not that
+# letter alone: the dotted capital I (which lowers to i and a combining dot), the dotless i and the long s. (The Kelvin
+# sign matches k, but lowers to k as well.)
+_ASCII_CASE_EQUIVALENTS = str.maketrans({'\u0130': 'i', '\u0131': 'i', '\u017f': 's'})
+
+
+def fold(text: str) -> str:
+    """Fold text so that it contains a literal from required_literals() wherever the text matches it ignoring case."""
+    return text.translate(_ASCII_CASE_EQUIVALENTS).lower()
+
+
+# Syntax which the regex module reads differently to the re module's parser used below: fuzzy matching such as
+# {e<=1}, and nested or POSIX character sets.
+_REGEX_ONLY_SYNTAX = re.compile(r'\{(?!\d*,?\d*\})|\[[\[:]')
+
+_REPEATS = {
+    sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT, getattr(sre_constants, 'POSSESSIVE_REPEAT', sre_constants.MAX_REPEAT),
+}
+_ATOMIC_GROUP = getattr(sre_constants, 'ATOMIC_GROUP', None)
+
+
+def _may_backtrack(items, in_repeat: bool = False) -> bool:
+    """
+    Whether a parsed pattern repeats something which can itself match in several ways (a repeat or an alternation),
+    as the patterns which time out on long enough input do.
+    """
+    for op, av in items:
+        if op in _REPEATS:
+            repeated = av[1] > 1
+            if (in_repeat and repeated) or _may_backtrack(av[2], in_repeat or repeated):
+                return True
+        elif op is sre_constants.BRANCH:
+            if in_repeat or any(_may_backtrack(branch, in_repeat) for branch in av[1]):
+                return True
+        elif op is sre_constants.SUBPATTERN and _may_backtrack(av[-1], in_repeat):
+            return True
+        elif op is _ATOMIC_GROUP and _may_backtrack(av, in_repeat):
+            return True
+        elif op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT) and _may_backtrack(av[1], in_repeat):
+            return True
+        elif op is sre_constants.GROUPREF_EXISTS:
+            return True
+    return False
+
+
+def _requirements(items) -> list:
+    """
+    Return tuples of lower case ASCII literals for a parsed pattern, such that any text it matches contains at least
+    one literal of each tuple, ignoring case.
+    """
+    requirements = []
+    run = []
+
+    def end_run():
+        if run:
+            requirements.append((''.join(run),))
+            run.clear()
+
+    def walk(items):
+        for op, av in items:
+            if op is sre_constants.LITERAL and av < 128:
+                run.append(chr(av).lower())
+            elif op is sre_constants.SUBPATTERN:
+                walk(av[-1])
+            elif op is _ATOMIC_GROUP:
+                walk(av)
+            else:
+                end_run()
+                if op in _REPEATS and av[0] >= 1:
+                    requirements.extend(_requirements(av[2]))
+                elif op is sre_constants.BRANCH:
+                    branches = [_best(_requirements(branch)) for branch in av[1]]
+                    if all(branches):
+                        requirements.append(tuple(dict.fromkeys(literal for branch in branches for literal in branch)))
+
+    walk(items)
+    end_run()
+    return requirements
+
+
+def _best(requirements: list):
+    """The requirement whose shortest literal is longest, which is likely to rule out the most text."""
+    return max(requirements, key=lambda literals: min(map(len, literals)), default=None)
+
+
+@functools.lru_cache(maxsize=4096)
+def required_literals(pattern) -> tuple | None:
+    """
+    Return a tuple of lower case ASCII literals, at least one of which fold(text) contains wherever the pattern
+    (compiled with BOT_PATTERN_FLAGS) matches the text; or None if the pattern has to be searched with every text.
+
+    That includes patterns which may backtrack badly enough to time out, so that searching with them still times out
+    on the same messages as before: a message lacking the literal can't match, but would take as long to find that.
+    """
+    if not isinstance(pattern, str) or _REGEX_ONLY_SYNTAX.search(pattern):
+        return None
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            items = sre_parse.parse(pattern, re.IGNORECASE)
+    except Exception:
+        return None
+    if _may_backtrack(items):
+        return None
+    return _best(_requirements(items))
+
+
+class MatchBudgetExceeded(Exception):
+    """The result for a bot whose pattern was not searched, since matching the message had run out of time."""
+
+
+class Matcher:
+    """
+    Compiles bot patterns, keeping the most recently used ones in an LRU cache keyed by (pattern, flags). Patterns
+    which fail to compile are cached as well, so that each message doesn't re-parse a broken pattern just to find the
+    same error again.
+
+    match() searches a message with all of a room's bots in one job on a worker thread, so that slow patterns don't
+    hold up the event loop: the regex module releases the GIL while searching a str. Each search may take up to
+    `timeout` seconds, and no search starts once the job has taken `budget` seconds. With threads=0, the job runs on
+    the event loop instead.
+    """
+
+    def __init__(self, max_patterns: int = 4096, timeout: float = 0.01, budget: float = 0.25, threads: int = 4):
+        self.max_patterns = max_patterns
+        self.timeout = timeout
+        self.budget = budget
+        self.threads = threads
+        self._patterns = collections.OrderedDict()
+        self._lock = threading.Lock()  # Held while using the cache, which the worker threads share.
+        self._limiter = None
+
+    def compile(self, pattern, flags=BOT_PATTERN_FLAGS):
+        """Return the compiled pattern, or raise the error from compiling it."""
+        key = (pattern, flags)
+        with self._lock:
+            try:
+                compiled = self._patterns[key]
+                self._patterns.move_to_end(key)
+                PATTERN_CACHE_HITS.inc()
+            except KeyError:
+                PATTERN_CACHE_MISSES.inc()
+                try:
+                    compiled = regex.compile(pattern, flags)
+                except Exception as e:
+                    compiled = e
+
+                self._patterns[key] = compiled
+                if len(self._patterns) > self.max_patterns:
+                    self._patterns.popitem(last=False)
+
+        if isinstance(compiled, Exception):
+            # Drop the traceback from the last time this was raised, so they do not pile up on the cached exception.
+            raise compiled.with_traceback(None)
+        return compiled
+
+    def candidates(self, bots, text: str) -> list:
+        """
+        Return the bots, in order, whose pattern may match the text: those with no required literals, or with one the
+        text contains. Each literal is looked for once, however many bots require it. Patterns not compiled yet, or
+        which failed to compile, are always candidates, so that searching with them compiles them or raises the error.
+        """
+        folded = fold(text)
+        found = {}
+
+        def contains(literal):
+            if literal not in found:
+                found[literal] = literal in folded
+            return found[literal]
+
+        candidates = []
+        with self._lock:
+            for bot in bots:
+                pattern = bot_pattern(bot)
+                compiled = self._patterns.get((pattern, BOT_PATTERN_FLAGS))
+                literals = required_literals(pattern) if compiled is not None and not isinstance(compiled, Exception) else None
+                if literals is None or any(map(contains, literals)):
+                    candidates.append(bot)
+                else:
+                    PREFILTER_SKIPS.inc()
+        return candidates
+
+    async def match(self, bots, text: str) -> list:
+        """
+        Search the text with the pattern of each bot which may match it (see candidates()), returning (bot, result)
+        pairs in order. The result is the regex.Match or None; or the exception from compiling the pattern, a
+        TimeoutError, or MatchBudgetExceeded if the pattern was not searched.
+        """
+        if self.threads <= 0:
+            results, searches, elapsed = self._match_all(bots, text)
+        else:
+            if self._limiter is None:
+                self._limiter = anyio.CapacityLimiter(self.threads)
+            results, searches, elapsed = await anyio.to_thread.run_sync(self._match_all, bots, text, limiter=self._limiter)
+
+        # The metrics are only ever updated from the event loop's thread.
+        for seconds, timed_out in searches:
+            MATCH_SECONDS.observe(seconds)
+            if timed_out:
+                MATCH_TIMEOUTS.inc()
+        MESSAGE_MATCH_SECONDS.observe(elapsed)
+        if any(isinstance(result, MatchBudgetExceeded) for _, result in results):
+            MATCH_BUDGET_EXCEEDED.inc()
+        return results
+
+    def _match_all(self, bots, text: str):
+        """Run match() on the calling thread, returning (results, [(seconds, timed out) for each search], seconds)."""
+        started_at = time.perf_counter()
+        deadline = started_at + self.budget
+        results = []
+        searches = []
+        for bot in self.candidates(bots, text):
+            try:
+                compiled = self.compile(bot_pattern(bot))
+            except Exception as e:
+                results.append((bot, e))
+                continue
+
+            search_started_at = time.perf_counter()
+            if search_started_at >= deadline:
+                results.append((bot, MatchBudgetExceeded()))
+                continue
+            try:
+                result = compiled.search(text, timeout=self.timeout)
+            except TimeoutError as e:
+                result = e
+            searches.append((time.perf_counter() - search_started_at, isinstance(result, TimeoutError)))
+            results.append((bot, result))
+        return results, searches, time.perf_counter() - started_at
+
+    def discard(self, pattern, flags=BOT_PATTERN_FLAGS):
+        """Forget a pattern, for instance because the bot using it has been changed or deleted."""
+        with self._lock:
+            self._patterns.pop((pattern, flags), None)
@@ -0,0 +1,235 @@
+"""
+Metrics contains a small, dependency-free implementation of counters, gauges and histograms, which are rendered in the
+Prometheus text exposition format by the /api/metrics endpoint.
+
+Metrics are declared once at module level, and any labelled children should be looked up once and kept (for instance
+in a dict keyed by the label value), so that recording a value on the hot path is only an attribute update.
+"""
+import bisect
+import math
+
+# Default histogram buckets for latencies, in seconds.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def _format_labels(labelnames, labelvalues, extra=()) -> str:
+    pairs = [*zip(labelnames, labelvalues), *extra]
+    if not pairs:
+        return ''
+
+    escaped = (str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value) -> str:
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = 'untyped'
+    suffix = ''  # Appended to the name in the HELP and TYPE lines.
+
+    def __init__(self, name: str, documentation: str, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        (REGISTRY if registry is None else registry).register(self)
+
+    def labels(self, *labelvalues):
+        """Return the child metric for the given label values, creating it on first use."""
+        if (child := self._children.get(labelvalues)) is None:
+            if len(labelvalues) != len(self.labelnames):
+                raise ValueError(f"Metric {self.name} expects labels {self.labelnames}, got {labelvalues}")
+            child = self._children[labelvalues] = self._child()
+        return child
+
+    def remove(self, *labelvalues):
+        """Forget a labelled child, for instance once the room or subscriber it described is gone."""
+        self._children.pop(labelvalues, None)
+
+    def _child(self):
+        raise NotImplementedError
+
+    def _samples(self):
+        """Yield (suffix, labelvalues, extra_labels, value) for each sample of this metric."""
+        children = self._children if self.labelnames else {(): self._unlabelled}
+        for labelvalues, child in list(children.items()):
+            yield from child._samples(labelvalues)
+
+    @property
+    def _unlabelled(self):
+        return self.labels()
+
+    def render(self) -> str:
+        name = self.name + self.suffix
+        lines = [f'# HELP {name} {self.documentation}', f'# TYPE {name} {self.kind}']
+        for suffix, labelvalues, extra, value in self._samples():
+            lines.append(f'{self.name}{suffix}{_format_labels(self.labelnames, labelvalues, extra)} {_format_value(value)}')
+        return '\n'.join(lines)
+
+
+def bucket_quantile(buckets, counts, total: int, q: float):
+    """
+    Estimate a quantile from histogram counts (one per bucket, then one for values above the last bucket) as the upper
+    bound of the bucket it falls into, or None if `total` is 0.
+    """
+    if total == 0:
+        return None
+
+    rank = q * total
+    cumulative = 0
+    for bound, count in zip(buckets, counts):
+        cumulative += count
+        if cumulative >= rank:
+            return bound
+    return math.inf
+
+
+class _CounterChild:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def _samples(self, labelvalues):
+        yield '_total', labelvalues, (), self.value
+
+
+class Counter(_Metric):
+    """A value which only goes up, like a number of requests. The name should not include the _total suffix."""
+    kind = 'counter'
+    suffix = '_total'
+    _child = _CounterChild
+
+    @property
+    def value(self):
+        return self._unlabelled.value
+
+    def inc(self, amount=1):
+        self._unlabelled.inc(amount)
+
+
+class _GaugeChild:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def _samples(self, labelvalues):
+        yield '', labelvalues, (), self.value
+
+
+class Gauge(_Metric):
+    """
+    A value which can go up and down. Instead of being set, a gauge may be given a function which is called at scrape
+    time, returning an iterable of (labelvalues, value) pairs: this is cheaper for values like queue depths which
+    already exist somewhere else.
+    """
+    kind = 'gauge'
+    _child = _GaugeChild
+
+    def __init__(self, name: str, documentation: str, labelnames=(), registry=None, function=None):
+        super().__init__(name, documentation, labelnames, registry)
+        self.function = function
+
+    def set_function(self, function):
+        self.function = function
+
+    @property
+    def value(self):
+        return self._unlabelled.value
+
+    def set(self, value):
+        self._unlabelled.set(value)
+
+    def inc(self, amount=1):
+        self._unlabelled.inc(amount)
+
+    def dec(self, amount=1):
+        self._unlabelled.dec(amount)
+
+    def _samples(self):
+        if self.function is None:
+            yield from super()._samples()
+            return
+
+        for labelvalues, value in self.function():
+            yield '', tuple(labelvalues), (), value
+
+
+class _HistogramChild:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float):
+        """Estimate a quantile as the upper bound of the bucket it falls into (None if nothing has been observed)."""
+        return bucket_quantile(self.buckets, self.counts, self.count, q)
+
+    def _samples(self, labelvalues):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield '_bucket', labelvalues, (('le', _format_value(float(bound))),), cumulative
+        yield '_bucket', labelvalues, (('le', '+Inf'),), self.count
+        yield '_sum', labelvalues, (), self.sum
+        yield '_count', labelvalues, (), self.count
+
+
+class Histogram(_Metric):
+    """A distribution of observed values (by default latencies in seconds), counted into fixed buckets."""
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames=(), registry=None, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self._unlabelled.observe(value)
+
+
+class Registry:
+    """A collection of metrics which are rendered together."""
+
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric: _Metric):
+        if metric.name in self.metrics:
+            raise ValueError(f"A metric named {metric.name} is already registered.")
+        self.metrics[metric.name] = metric
+
+    def render(self) -> str:
+        """Render all metrics in the Prometheus text format."""
+        return ''.join(metric.render() + '\n' for metric in self.metrics.values())
+
+
+# The default registry, which all metrics are registered in unless another one is given.
+REGISTRY = Registry()
@@ -1,10 +1,13 @@
 import asyncio
 import contextlib
+import functools
 import json
 import logging
 import pathlib
 import sqlite3
+import time
 
+import anyio
 from starlette.applications import Starlette
 from starlette.config import Config
 from starlette.endpoints import HTTPEndpoint, WebSocketEndpoint
@@ -12,15 +15,35 @@ from starlette.middleware import Middleware
 from starlette.middleware.base import BaseHTTPMiddleware
 from starlette.middleware.cors import CORSMiddleware
 from starlette.requests import Request
-from starlette.responses import FileResponse, JSONResponse, RedirectResponse
+from starlette.responses import (
+    FileResponse,
+    JSONResponse,
+    PlainTextResponse,
+    RedirectResponse,
+    Response,
+    StreamingResponse,
+)
 from starlette.routing import Mount, Route, WebSocketRoute
 from starlette.staticfiles import StaticFiles
 from starlette.websockets import WebSocket
 
 from . import (
+    botclient,
     broker,
+    catchup,
+    circuit,
     db,
     events,
+    matching,
+    metrics,
+    timeouts,
+    workqueue,
+)
+
+REQUEST_SECONDS = metrics.Histogram('necsus_http_request_seconds', 'Time taken to respond to HTTP requests, by route.', ['route', 'method'])
+EVENT_LOOP_LAG = metrics.Histogram(
+    'necsus_event_loop_lag_seconds', 'How late the event loop was in waking a task from a sleep.',
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0),
 )
 
 # Config will be read from environment variables (first priority), falling back to a .env file.
@@ -31,6 +54,13 @@ BASE_DIR = pathlib.Path(__file__).parent.parent
 logger = logging.getLogger('necsus')
 
 
+# Columns added to the tables in schema.sql after they were first created, as (table, column, type).
+ADDED_COLUMNS = [
+    ('bots', 'connect_timeout', 'REAL'),
+    ('bots', 'read_timeout', 'REAL'),
+]
+
+
 def create_db_connection(db_path: str) -> sqlite3.Connection:
     """Create and initialise a connection to an Sqlite3 database."""
 
@@ -39,17 +69,39 @@ def create_db_connection(db_path: str) -> sqlite3.Connection:
         'PRAGMA synchronous = normal',  # Default is 'full', which requires a full fsync after each commit.
     ]
 
-    connection = sqlite3.connect(db_path)
+    # The connection is made here, but used from the database writer thread.
+    connection = sqlite3.connect(db_path, check_same_thread=False)
     for sql in PRAGMAS:
         connection.execute(sql)
 
     with open(BASE_DIR / 'schema.sql') as f:
         connection.executescript(f.read())
 
+    # CREATE TABLE IF NOT EXISTS leaves a table from an older schema as it was, without the columns added since.
+    for table, column, column_type in ADDED_COLUMNS:
+        if column not in {row[1] for row in connection.execute(f'PRAGMA table_info({table})')}:
+            connection.execute(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}')
+
     connection.commit()
     return connection
 
 
+def create_read_connection(db_path: str) -> sqlite3.Connection:
+    """Create a read-only connection to an Sqlite3 database already initialised by create_db_connection()."""
+    return sqlite3.connect(pathlib.Path(db_path).resolve().as_uri() + '?mode=ro', uri=True, check_same_thread=False)
+
+
+async def measure_event_loop_lag(interval: float):
+    """
+    Sleep for interval seconds at a time, recording how much later than that each sleep ends. Anything which holds up
+    the event loop (a slow regex, or a synchronous call) delays every websocket and request by about as long.
+    """
+    while True:
+        started_at = time.perf_counter()
+        await anyio.sleep(interval)
+        EVENT_LOOP_LAG.observe(max(time.perf_counter() - started_at - interval, 0.0))
+
+
 @contextlib.asynccontextmanager
 async def lifespan(app: Starlette):
     # Read the environment variable NECSUS_DB, with a sensible default of the repo root.
@@ -58,14 +110,142 @@ async def lifespan(app: Starlette):
     logger.info(f"Connecting to SQLite database {db_path!r}")
     connection = create_db_connection(db_path)
 
-    app.state.connection = connection
-    app.state.db = db.DB(connection)
+    # An in-memory database is private to its connection, so can't have separate reader connections.
+    reader_connect = None if db_path == ':memory:' else functools.partial(create_read_connection, db_path)
+    app.state.db = db.AsyncDB(
+        connection,
+        reader_connect,
+        readers=config.get('DB_READERS', int, 4),
+        commit_window=config.get('DB_COMMIT_WINDOW', float, 0.001),
+        commit_batch=config.get('DB_COMMIT_BATCH', int, 100),
+    )
+
+    # With several worker processes, events are published through the hub (see necsus/hub.py) to reach every worker.
+    broker_options = dict(
+        log_size=config.get('BROKER_LOG_SIZE', int, 1000),
+        log_bytes=config.get('BROKER_LOG_BYTES', int, 4 * 1024 * 1024),
+        idle_seconds=config.get('BROKER_LOG_IDLE_SECONDS', float, 600.0),
+        overflow=config.get('BROKER_OVERFLOW', str, 'drop'),
+        warn_depth=config.get('BROKER_WARN_DEPTH', int, None),
+    )
+    broker_kind = config.get('BROKER', str, 'memory')
+    if broker_kind == 'hub':
+        hub_path = config.get('BROKER_HUB', str, str(BASE_DIR / 'necsus-hub.sock'))
+        app.state.broker = broker.HubBroker(hub_path, on_remote_bot_change=app.state.db.bots.clear_cache, **broker_options)
+    elif broker_kind == 'memory':
+        app.state.broker = broker.Broker(**broker_options)
+    else:
+        raise ValueError(f"NECSUS_BROKER should be 'memory' or 'hub', got {broker_kind!r}")
+
+    # A single HTTP client (and so a single connection pool) is used for contacting all bots.
+    app.state.bot_client = botclient.BotClient(
+        max_connections=config.get('BOT_MAX_CONNECTIONS', int, 200),
+        max_connections_per_host=config.get('BOT_MAX_CONNECTIONS_PER_HOST', int, 20),
+        max_keepalive_connections=config.get('BOT_MAX_KEEPALIVE_CONNECTIONS', int, 100),
+        keepalive_expiry=config.get('BOT_KEEPALIVE_EXPIRY', float, 30.0),
+        http2=config.get('BOT_HTTP2', bool, False),
+        max_concurrent_bots=config.get('BOT_MAX_CONCURRENT', int, 200),
+        max_concurrent_bots_per_room=config.get('BOT_MAX_CONCURRENT_PER_ROOM', int, 20),
+        reply_order=config.get('BOT_REPLY_ORDER', str, 'bot'),
+        breakers=circuit.CircuitBreakers(
+            threshold=config.get('BOT_BREAKER_THRESHOLD', int, 5),
+            backoff=config.get('BOT_BREAKER_BACKOFF', float, 10.0),
+            max_backoff=config.get('BOT_BREAKER_MAX_BACKOFF', float, 300.0),
+            slow_seconds=config.get('BOT_BREAKER_SLOW_SECONDS', float, 60.0),
+        ),
+        timeouts=timeouts.AdaptiveTimeouts(
+            connect=config.get('BOT_CONNECT_TIMEOUT', float, 5.0),
+            min_read=config.get('BOT_MIN_TIMEOUT', float, 5.0),
+            max_read=config.get('BOT_MAX_TIMEOUT', float, 120.0),
+            multiplier=config.get('BOT_TIMEOUT_MULTIPLIER', float, 4.0),
+            window=config.get('BOT_TIMEOUT_WINDOW', int, 200),
+            min_samples=config.get('BOT_TIMEOUT_MIN_SAMPLES', int, 20),
+        ),
+        max_reply_bytes=config.get('BOT_MAX_REPLY_BYTES', int, 2 * 1024 * 1024),
+        max_text_chars=config.get('BOT_MAX_TEXT_CHARS', int, 256 * 1024),
+        max_asset_chars=config.get('BOT_MAX_ASSET_CHARS', int, 64 * 1024),
+    )
+
+    # Listings which could be arbitrarily long are read from the database and sent this many rows at a time.
+    app.state.api_page_size = config.get('API_PAGE_SIZE', int, 500)
+    # The most messages one page of /api/messages with a 'limit' may hold.
+    app.state.api_max_limit = config.get('API_MAX_LIMIT', int, 1000)
+    # The longest request body of a posted message. Each message is relayed as one line through the hub, which must be
+    # well under its maximum line length (see necsus/hub.py).
+    app.state.api_max_message_bytes = config.get('API_MAX_MESSAGE_BYTES', int, 1024 * 1024)
+
+    app.state.websocket_initial_messages = config.get('WEBSOCKET_INITIAL_MESSAGES', int, 100)
+
+    # When many websockets reconnect to a room at once, their reads of what they missed are coalesced.
+    app.state.catch_up = catchup.CatchUpReader(app.state.db, window=config.get('CATCH_UP_WINDOW', float, 0.01))
+
+    app.state.matcher = matching.Matcher(
+        max_patterns=config.get('PATTERN_CACHE_SIZE', int, 4096),
+        timeout=config.get('MATCH_TIMEOUT', float, 0.01),
+        budget=config.get('MATCH_BUDGET', float, 0.25),
+        threads=config.get('MATCH_THREADS', int, 4),
+    )
+
+    # Bots are either triggered while the request which posted the message waits ('inline'), or by a pool of
+    # background workers after the request has returned ('background'), with replies arriving over the websocket.
+    app.state.bot_dispatch = config.get('BOT_DISPATCH', str, 'inline')
+    if app.state.bot_dispatch not in ('inline', 'background'):
+        raise ValueError(f"NECSUS_BOT_DISPATCH should be 'inline' or 'background', got {app.state.bot_dispatch!r}")
+    app.state.bot_queue = workqueue.WorkQueue(workers=config.get('BOT_WORKERS', int, 50))
+
+    async with anyio.create_task_group() as tg:
+        await tg.start(app.state.broker.run)
+        tg.start_soon(app.state.bot_queue.run)
+        tg.start_soon(measure_event_loop_lag, config.get('EVENT_LOOP_LAG_INTERVAL', float, 0.5))
+        yield
+        await app.state.bot_queue.drain(timeout=config.get('BOT_DRAIN_TIMEOUT', float, 30.0))
+        tg.cancel_scope.cancel()
+
+    await app.state.bot_client.aclose()
+    app.state.db.close()
+
+
+def encode_json(content) -> bytes:
+    """Encode content exactly as JSONResponse does."""
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(',', ':')).encode('utf-8')
+
+
+class JSONStreamResponse(StreamingResponse):
+    """
+    A response listing rows read a page at a time, so that memory use does not grow with the number of rows. The body
+    is a JSON array, byte for byte what JSONResponse would send for the whole list, or with ndjson=True, one JSON row
+    per line. fetch_page(after_id, limit) should return up to `limit` rows with IDs strictly greater than after_id, in
+    ascending ID order.
+    """
+    def __init__(self, fetch_page, page_size: int, ndjson: bool = False, headers=None):
+        super().__init__(
+            self._body(fetch_page, page_size, ndjson),
+            headers=headers,
+            media_type='application/x-ndjson' if ndjson else 'application/json',
+        )
+
+    @staticmethod
+    async def _body(fetch_page, page_size: int, ndjson: bool):
+        after_id = -1
+        separator = b'' if ndjson else b'['
+        while True:
+            page = await fetch_page(after_id, page_size)
+            if page:
+                if ndjson:
+                    yield b''.join(encode_json(row) + b'\n' for row in page)
+                else:
+                    yield separator + b','.join(encode_json(row) for row in page)
+                    separator = b','
+                after_id = page[-1]['id']
+            if len(page) < page_size:
+                break
 
-    app.state.broker = broker.Broker()
+        if not ndjson:
+            yield b'[]' if separator == b'[' else b']'
 
-    yield
 
-    app.state.connection.close()
+def wants_ndjson(request: Request) -> bool:
+    return request.query_params.get('format') == 'ndjson' or 'application/x-ndjson' in request.headers.get('accept', '')
 
 
 class Lobby(HTTPEndpoint):
@@ -88,11 +268,21 @@ class ApiSpec(HTTPEndpoint):
         return FileResponse(BASE_DIR / 'api.yaml')
 
 
+class ApiMetrics(HTTPEndpoint):
+    async def get(self, request):
+        """Server metrics, in the Prometheus text format."""
+        return PlainTextResponse(metrics.REGISTRY.render(), media_type='text/plain; version=0.0.4')
+
+
 class ApiMessages(HTTPEndpoint):
     async def get(self, request):
         """
-        List all messages in a room with IDs strictly larger than 'since'.
+        List all messages in a room with IDs strictly larger than 'since' (or 'after').
         If 'since' is not specified, list all messages in the room.
+
+        Given a 'limit', list at most that many messages: the first after 'after' if it is given alone, otherwise the
+        last before 'before' (or the last in the room). If there may be more messages in that direction, the
+        X-Next-Cursor header holds the ID to pass as the next 'after' or 'before'.
         """
         if (room := request.query_params.get('room')) is None:
             return JSONResponse({'message': 'The room name is required.'}, status_code=400)
@@ -103,26 +293,85 @@ class ApiMessages(HTTPEndpoint):
         except:
             pass
 
-        new_messages = list(request.app.state.db.messages.since(room, since_id))
-        return JSONResponse(new_messages)
+        try:
+            after_id = int(request.query_params.get('after', since_id))
+            before_id = int(before) if (before := request.query_params.get('before')) is not None else None
+            limit = int(limit) if (limit := request.query_params.get('limit')) is not None else None
+        except ValueError:
+            return JSONResponse({'message': "The 'after', 'before' and 'limit' parameters should be integers."}, status_code=400)
+
+        if limit is not None and limit <= 0:
+            return JSONResponse({'message': "The 'limit' parameter should be positive."}, status_code=400)
+        if limit is not None:
+            # A page never holds more than the maximum: the X-Next-Cursor header leads on to the rest.
+            limit = min(limit, request.app.state.api_max_limit)
+
+        messages = request.app.state.db.messages
+        if limit is None:
+            # Without a limit the whole history of the room could be asked for, so it is streamed.
+            async def fetch_page(page_after_id, page_size):
+                return await messages.since(room, max(after_id, page_after_id), page_size, before_id)
+
+            return JSONStreamResponse(fetch_page, request.app.state.api_page_size, ndjson=wants_ndjson(request))
+
+        headers = {}
+        if before_id is None and ('after' in request.query_params or 'since' in request.query_params):
+            page = await messages.since(room, after_id, limit)
+            if len(page) == limit:
+                headers['X-Next-Cursor'] = str(page[-1]['id'])
+        else:
+            page = await messages.before(room, before_id, limit, after_id)
+            if len(page) == limit:
+                headers['X-Next-Cursor'] = str(page[0]['id'])
+
+        return JSONResponse(page, headers=headers)
+
+
+def with_breaker_states(breakers: circuit.CircuitBreakers, bots) -> list:
+    """The bots, each with the state of the circuit breaker for its URL's host."""
+    return [{**bot, 'breaker': breakers.state(bot['url'])} for bot in bots]
 
 
 class ApiBots(HTTPEndpoint):
     async def get(self, request: Request):
         """List all bots in a room, or if no room is given, list all bots on the server."""
-        if (room := request.query_params.get('room')) is not None:
-            bots = list(request.app.state.db.bots.find_all(room=room))
-        else:
-            bots = list(request.app.state.db.bots.find_all())
+        db, breakers = request.app.state.db, request.app.state.bot_client.breakers
+        if (room := request.query_params.get('room')) is None:
+            async def fetch_page(after_id, limit):
+                return with_breaker_states(breakers, await db.bots.page(after_id, limit))
 
+            return JSONStreamResponse(fetch_page, request.app.state.api_page_size, ndjson=wants_ndjson(request))
+
+        bots = with_breaker_states(breakers, await db.bots.in_room(room))
+        if wants_ndjson(request):
+            return Response(b''.join(encode_json(bot) + b'\n' for bot in bots), media_type='application/x-ndjson')
         return JSONResponse(bots)
 
 
+class ApiBreakers(HTTPEndpoint):
+    async def get(self, request: Request):
+        """The circuit breaker of each bot host contacted since the server started (see necsus/circuit.py)."""
+        return JSONResponse(request.app.state.bot_client.breakers.as_list())
+
+
+async def read_body(request: Request, max_bytes: int) -> bytes | None:
+    """Read a request's body, or return None as soon as it turns out to be longer than max_bytes."""
+    body = bytearray()
+    async for chunk in request.stream():
+        body += chunk
+        if len(body) > max_bytes:
+            return None
+    return bytes(body)
+
+
 class ApiActionsMessage(HTTPEndpoint):
     async def post(self, request: Request):
         """Post a message to a room."""
+        max_bytes = request.app.state.api_max_message_bytes
+        if (body := await read_body(request, max_bytes)) is None:
+            return JSONResponse({'message': f'Messages should be at most {max_bytes} bytes'}, status_code=413)
         try:
-            data = await request.json()
+            data = json.loads(body)
         except json.JSONDecodeError:
             return JSONResponse({'message': 'Invalid JSON'}, status_code=400)
 
@@ -130,7 +379,13 @@ class ApiActionsMessage(HTTPEndpoint):
         if None in (text, room, author):
             return JSONResponse({'message': f'All of text, room, and author should be non-null, got {text=}, {room=}, {author=}'}, status_code=400)
 
-        message = await events.trigger_message_post(request.app.state.db, request.app.state.broker, room, author, text, image, media, css, js, base_url)
+        state = request.app.state
+        if state.bot_dispatch == 'background':
+            message, special_state = await events.post_user_message(state.db, state.broker, room, author, text, image, media, css, js, base_url)
+            state.bot_queue.submit(events.trigger_message_bots, state.db, state.broker, state.bot_client, state.matcher, room, author, text, special_state)
+        else:
+            message = await events.trigger_message_post(state.db, state.broker, state.bot_client, state.matcher, room, author, text, image, media, css, js, base_url)
+
         return JSONResponse(message)
 
 
@@ -146,7 +401,13 @@ class ApiActionsMessageForm(HTTPEndpoint):
         if None in (room, author, bot_id, form_data):
             return JSONResponse({'message': f'All of room, author, bot, form_data, and action_url should be non-null, got {room=}, {author=}, {bot_id=}, {form_data=}, {action_url=}'}, status_code=400)
 
-        await events.trigger_message_form_post(request.app.state.db, request.app.state.broker, room, author, bot_id, action_url, form_data)
+        state = request.app.state
+        args = (state.db, state.broker, state.bot_client, room, author, bot_id, action_url, form_data)
+        if state.bot_dispatch == 'background':
+            state.bot_queue.submit(events.trigger_message_form_post, *args)
+        else:
+            await events.trigger_message_form_post(*args)
+
         return JSONResponse({})
 
 
@@ -159,8 +420,20 @@ class ApiActionBot(HTTPEndpoint):
             return JSONResponse({'message': 'Invalid JSON'}, status_code=400)
 
         id, room, name, responds_to, url = [data.get(key) for key in ['id', 'room', 'name', 'responds_to', 'url']]
-        bot = request.app.state.db.bots.update_or_add(id=id, room=room, name=name, responds_to=responds_to, url=url)
-        app.state.broker.put_bot(bot['room'], bot)
+        # The timeouts are only changed when given, since the UI does not send them.
+        timeouts = {key: data[key] for key in ['connect_timeout', 'read_timeout'] if key in data}
+        max_timeout = request.app.state.bot_client.timeouts.max_read
+        for timeout in timeouts.values():
+            if timeout is not None and (isinstance(timeout, bool) or not isinstance(timeout, (int, float)) or not 0 < timeout <= max_timeout):
+                return JSONResponse({'message': f'Timeouts should be a number of seconds greater than 0 and at most {max_timeout:g}, or null, got {timeout!r}'}, status_code=400)
+
+        if id is not None and (old_bot := await request.app.state.db.bots.find(id=id)) is not None:
+            request.app.state.matcher.discard(matching.bot_pattern(old_bot))
+
+        bot = await request.app.state.db.bots.update_or_add(
+            id=id, room=room, name=name, responds_to=responds_to, url=url, **timeouts,
+        )
+        await app.state.broker.put_bot(bot['room'], bot)
         return JSONResponse(bot)
 
     async def delete(self, request: Request):
@@ -173,11 +446,13 @@ class ApiActionBot(HTTPEndpoint):
         if (id := data.get('id')) is None:
             return JSONResponse({'message': 'Need to provide the ID of the bot to remove.'}, status_code=400)
 
-        if (bot := request.app.state.db.bots.find(id=id)) is None:
+        if (bot := await request.app.state.db.bots.find(id=id)) is None:
             return JSONResponse({'message': f'Bot with {id=} not found.'}, status_code=400)
 
-        request.app.state.db.bots.remove(id=id)
-        app.state.broker.delete_bot(bot['room'], bot)
+        await request.app.state.db.bots.remove(id=id)
+        request.app.state.matcher.discard(matching.bot_pattern(bot))
+        events.forget_bot_metrics(id)
+        await app.state.broker.delete_bot(bot['room'], bot)
         return JSONResponse(bot)
 
 
@@ -192,7 +467,7 @@ class ApiActionsClearRoomMessages(HTTPEndpoint):
         if (room := data.get('room')) is None:
             return JSONResponse({'message': 'Need to provide the room name to clear the messages.'}, status_code=400)
 
-        events.trigger_clear_room_messages(request.app.state.db, request.app.state.broker, room)
+        await events.trigger_clear_room_messages(request.app.state.db, request.app.state.broker, room)
         return JSONResponse({'room': room})
 
 
@@ -207,14 +482,14 @@ class ApiActionsClearRoomState(HTTPEndpoint):
         if (room := data.get('room')) is None:
             return JSONResponse({'message': 'Need to provide the room name to clear the state of.'}, status_code=400)
 
-        events.trigger_clear_room_state(request.app.state.db, request.app.state.broker, room)
+        await events.trigger_clear_room_state(request.app.state.db, request.app.state.broker, room)
         return JSONResponse({'room': room})
 
 
 class WebSocketRoom(WebSocketEndpoint):
     """
-    The websocket endpoint /ws/{room}?since_id=-1 will deliver a read-only stream of events from a room, after the given
-    message id.
+    The websocket endpoint /ws/{room}?since=-1 will deliver a read-only stream of events from a room, after the given
+    message id. Without a since id, the stream starts with the latest NECSUS_WEBSOCKET_INITIAL_MESSAGES messages.
     """
     async def on_connect(self, ws: WebSocket):
         await ws.accept()
@@ -229,36 +504,80 @@ class WebSocketRoom(WebSocketEndpoint):
         except:
             pass
 
-        last_cleared_entry = ws.app.state.db.clears.find(room=room)
-        last_cleared_id = last_cleared_entry['last_cleared_id'] if last_cleared_entry is not None else None
-
-        should_clear = False
-        if last_cleared_id is not None and last_cleared_id >= since_id:
-            should_clear = True
-            since_id = last_cleared_id
-
-        current_bots = list(ws.app.state.db.bots.find_all(room=room))
-        new_messages = list(ws.app.state.db.messages.since(room, since_id))
-        recv, self.tag = ws.app.state.broker.subscribe(
-            room=room,
-            init_bots=current_bots,
-            init_messages=new_messages,
-            should_clear=should_clear,
-        )
+        # Subscribing first means that nothing published while reading the database below can be missed.
+        self.subscription = ws.app.state.broker.subscribe(room=room, since_id=since_id)
+        self.subscription.add_bots(await ws.app.state.db.bots.in_room(room))
+
+        # A client connecting for the first time gets only the latest messages, and can fetch older ones from
+        # /api/messages as it needs them.
+        catch_up = ws.app.state.catch_up
+        if self.subscription.catching_up and since_id < 0:
+            initial_messages = ws.app.state.websocket_initial_messages
+            self.subscription.catch_up(await catch_up.latest(room, initial_messages), should_clear=False)
 
-        asyncio.create_task(self.message_pump(ws, recv), name=f'Websocket:{room}')
+        # The broker's log of recent events in the room did not go back far enough to catch up from. There could be
+        # any number of missed messages, so they are replayed from the database a page at a time as the websocket
+        # sends them, up to the latest message now.
+        if self.subscription.catching_up:
+            last_cleared_id, through_id = await catch_up.last_ids(room)
+
+            should_clear = False
+            if last_cleared_id is not None and last_cleared_id >= since_id:
+                should_clear = True
+                since_id = last_cleared_id
+
+            fetch_page = functools.partial(catch_up.since, room)
+            self.subscription.replay(fetch_page, ws.app.state.api_page_size, since_id, through_id, should_clear)
+
+        asyncio.create_task(self.message_pump(ws, self.subscription), name=f'Websocket:{room}')
 
     async def on_disconnect(self, ws: WebSocket, close_code: int):
         logger.info(f"Websocket for room {self.room} closed with {close_code=}")
-        ws.app.state.broker.unsubscribe(self.tag)
+        ws.app.state.broker.unsubscribe(self.subscription)
 
-    async def message_pump(self, ws: WebSocket, messages):
+    async def message_pump(self, ws: WebSocket, subscription: broker.Subscription):
         """
-        Move messages from an anyio stream (a queue) into the websocket, until the stream closes.
+        Move encoded events from the subscription into the websocket, until unsubscribed. If the broker evicted the
+        subscription because the websocket fell too far behind, or replaying missed messages failed, close the
+        websocket so that the client reconnects.
         This should be spawned into a new task.
         """
-        async for message in messages:
-            await ws.send_json(message)
+        async for frame in subscription.frames():
+            await ws.send_text(frame)
+
+        if subscription.evicted:
+            await ws.close(code=broker.RESYNC_CLOSE_CODE)
+        elif subscription.failed:
+            # The client reconnects (after its usual backoff) and tries again.
+            await ws.close(code=1011)
+
+
+class RouteLatency:
+    """
+    Times each HTTP request into REQUEST_SECONDS, labelled by the path of the route which handled it (such as
+    /api/messages, or /{room:path} for a room) rather than the URL, so that there is a fixed number of labels. The
+    histogram for each route and method is looked up once and kept.
+    """
+    METHODS = {'GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'}
+
+    def __init__(self, app):
+        self.app = app
+        self._histograms = {}
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+
+        started_at = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            # The router sets the endpoint of the route it matched in the scope.
+            key = (scope.get('endpoint'), scope['method'])
+            if (histogram := self._histograms.get(key)) is None:
+                route = ROUTE_PATHS.get(key[0], 'unmatched')
+                histogram = self._histograms[key] = REQUEST_SECONDS.labels(route, key[1] if key[1] in self.METHODS else 'other')
+            histogram.observe(time.perf_counter() - started_at)
 
 
 class NoCacheHeader(BaseHTTPMiddleware):
@@ -289,6 +608,8 @@ routes = [
     # API endpoints which are GET routes accepting query parameters.
     Route('/api/messages', ApiMessages),
     Route('/api/bots', ApiBots),
+    Route('/api/breakers', ApiBreakers),
+    Route('/api/metrics', ApiMetrics),
 
     # API endpoints which are POST or DELETE routes accepting JSON payloads.
     Route('/api/actions/message', ApiActionsMessage),
@@ -304,11 +625,17 @@ routes = [
     Route('/{room:path}', Room),
 ]
 
+# Maps the endpoint (or for a mount, the app) of each route to its path, for RouteLatency.
+ROUTE_PATHS = {getattr(route, 'endpoint', route.app): route.path for route in routes}
+
 middleware = [
+    # The time taken for each request, including the other middleware.
+    Middleware(RouteLatency),
+
     # I'm assuming that at some point we needed this cross-origin stuff on the API endpoints.
     # Here we heavy-handedly apply it across the whole application, an alternative would be wrapping
     # the API endpoints into their own app, and mounting that app perhaps?
-    Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*']),
+    Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'], expose_headers=['X-Next-Cursor']),
 
     # Ensure that clients are always getting the freshest Necsus version.
     Middleware(NoCacheHeader),
@@ -0,0 +1,100 @@
+"""
+Timeouts for contacting bots. Most bots reply in well under a second, but a few (those calling the OpenAI API, say)
+take a minute, so one timeout for every bot is either too short for the slow bots, or lets a hung bot hold its
+connection for minutes.
+
+Instead, each bot endpoint's recent reply times are kept in a rolling histogram, and a bot's read timeout is its
+endpoint's 99th percentile times a multiplier, clamped between a minimum and a maximum. Until an endpoint has replied
+enough times, it gets the maximum. Connecting gets a separate, short timeout, since a host which is up accepts a
+connection quickly however slow the bot behind it is. A bot's connect_timeout or read_timeout columns, when set,
+override these.
+"""
+import bisect
+import collections
+import operator
+
+import httpx
+
+from .metrics import LATENCY_BUCKETS, bucket_quantile
+
+
+class RollingHistogram:
+    """
+    Counts of observed values in fixed buckets, over between `window` and 2 * `window` of the latest observations: the
+    counts are kept in two generations, and the older is dropped each time the newer fills up.
+    """
+
+    def __init__(self, window: int, buckets=LATENCY_BUCKETS):
+        self.window = window
+        self.buckets = buckets
+        self._current = [0] * (len(buckets) + 1)
+        self._previous = [0] * (len(buckets) + 1)
+        self._current_count = 0
+        self._previous_count = 0
+
+    @property
+    def count(self) -> int:
+        return self._current_count + self._previous_count
+
+    def observe(self, value: float):
+        if self._current_count >= self.window:
+            self._previous, self._previous_count = self._current, self._current_count
+            self._current, self._current_count = [0] * (len(self.buckets) + 1), 0
+
+        self._current[bisect.bisect_left(self.buckets, value)] += 1
+        self._current_count += 1
+
+    def quantile(self, q: float) -> float | None:
+        """Estimate a quantile as the upper bound of the bucket it falls into (None if nothing has been observed)."""
+        return bucket_quantile(self.buckets, map(operator.add, self._current, self._previous), self.count, q)
+
+
+class AdaptiveTimeouts:
+    """The timeouts for contacting each bot, adapted to the reply times of its endpoint as described above."""
+
+    def __init__(
+        self,
+        connect: float = 5.0,
+        min_read: float = 5.0,
+        # This used to be a fixed 15 seconds, but changed to 120 seconds for bots which use the OpenAI API.
+        max_read: float = 120.0,
+        multiplier: float = 4.0,
+        quantile: float = 0.99,
+        window: int = 200,
+        min_samples: int = 20,
+        max_endpoints: int = 4096,
+    ):
+        self.connect = connect
+        self.min_read = min_read
+        self.max_read = max_read
+        self.multiplier = multiplier
+        self.quantile = quantile
+        self.window = window
+        self.min_samples = min_samples
+        self.max_endpoints = max_endpoints
+        self._latencies = collections.OrderedDict()  # Maps endpoint URL -> RollingHistogram, least recently used first.
+
+    def _histogram(self, url: str) -> RollingHistogram:
+        if (histogram := self._latencies.get(url)) is None:
+            histogram = self._latencies[url] = RollingHistogram(self.window)
+            if len(self._latencies) > self.max_endpoints:
+                self._latencies.popitem(last=False)
+        else:
+            self._latencies.move_to_end(url)
+        return histogram
+
+    def observe(self, url: str, seconds: float):
+        """Record how long a bot endpoint took to reply, or to time out."""
+        self._histogram(url).observe(seconds)
+
+    def read_timeout(self, url: str) -> float:
+        """The adaptive read timeout for a bot endpoint."""
+        histogram = self._latencies.get(url)
+        if histogram is None or histogram.count < self.min_samples:
+            return self.max_read
+        return min(max(histogram.quantile(self.quantile) * self.multiplier, self.min_read), self.max_read)
+
+    def timeout(self, bot) -> httpx.Timeout:
+        """The timeouts for a request to a bot: its own settings if it has them, otherwise the adaptive ones."""
+        read = bot.get('read_timeout') or self.read_timeout(bot['url'])
+        return httpx.Timeout(read, connect=bot.get('connect_timeout') or self.connect)
@@ -0,0 +1,77 @@
+"""
+The WorkQueue runs jobs (async functions) in the background on a fixed number of worker tasks, so that a request
+handler can return before the work it started is finished.
+"""
+import logging
+import math
+import time
+
+import anyio
+
+from .metrics import Counter, Gauge, Histogram
+
+logger = logging.getLogger('necsus')
+
+QUEUE_DEPTH = Gauge('necsus_bot_queue_depth', 'Jobs waiting in the background bot dispatch queue.')
+JOBS_RUNNING = Gauge('necsus_bot_queue_running', 'Jobs currently being run by background bot dispatch workers.')
+JOBS_FAILED = Counter('necsus_bot_queue_failed', 'Background bot dispatch jobs which raised an exception.')
+JOB_WAIT = Histogram('necsus_bot_queue_wait_seconds', 'Time background bot dispatch jobs spent queued before starting.')
+JOB_LATENCY = Histogram('necsus_bot_queue_job_seconds', 'Time from queueing a background bot dispatch job to it finishing.')
+
+
+class WorkQueue:
+    """
+    A queue of jobs and a pool of workers to run them. Start the workers with .run() in a task group, add jobs with
+    .submit(), and call .drain() on shutdown to finish the queued jobs (cancelling any still running after a timeout).
+    """
+
+    def __init__(self, workers: int = 50, max_queued: float = math.inf):
+        self.workers = workers
+        self._send, self._recv = anyio.create_memory_object_stream(max_buffer_size=max_queued)
+        self._cancel_scope = anyio.CancelScope()
+        self._finished = anyio.Event()
+        QUEUE_DEPTH.set_function(lambda: [((), self.depth)])
+
+    @property
+    def depth(self) -> int:
+        return self._send.statistics().current_buffer_used
+
+    def submit(self, job, *args):
+        """Queue a call of job(*args). Raises anyio.WouldBlock if the queue is full."""
+        self._send.send_nowait((time.monotonic(), job, args))
+
+    async def run(self):
+        """Run the workers until the queue is drained."""
+        with self._cancel_scope:
+            async with anyio.create_task_group() as tg:
+                for _ in range(self.workers):
+                    tg.start_soon(self._worker, self._recv.clone())
+                self._recv.close()
+
+        self._finished.set()
+
+    async def _worker(self, recv):
+        async with recv:
+            async for queued_at, job, args in recv:
+                started_at = time.monotonic()
+                JOB_WAIT.observe(started_at - queued_at)
+                JOBS_RUNNING.inc()
+                try:
+                    await job(*args)
+                except Exception:
+                    JOBS_FAILED.inc()
+                    logger.exception(f"Background job {job.__name__} failed")
+                finally:
+                    JOBS_RUNNING.dec()
+                    JOB_LATENCY.observe(time.monotonic() - queued_at)
+
+    async def drain(self, timeout: float):
+        """Stop accepting jobs, and wait for the queued ones to finish, cancelling them if that takes too long."""
+        self._send.close()
+        with anyio.move_on_after(timeout):
+            await self._finished.wait()
+
+        if not self._finished.is_set():
+            logger.warning(f"Cancelling {self.depth} queued background jobs which did not finish within {timeout}s")
+            self._cancel_scope.cancel()
+            await self._finished.wait()
@@ -23,7 +23,9 @@ CREATE TABLE IF NOT EXISTS bots (
   room TEXT CHECK (room != ''), -- There is no "default" empty-name room.
   name TEXT,
   responds_to TEXT,
-  url TEXT
+  url TEXT,
+  connect_timeout REAL,  -- Seconds to wait to connect to the bot, if not the server's default.
+  read_timeout REAL      -- Seconds to wait for the bot to reply, if not adapted to its past reply times.
 );
 
 -- Contains the last-cleared-message id of each room, so that we can replay clears onto clients that
@@ -32,3 +34,18 @@ CREATE TABLE IF NOT EXISTS clears (
   room TEXT PRIMARY KEY,
   last_cleared_id INTEGER
 );
+
+-- The conversation state of each room: a row is present only when the most recent message in the room carries a
+-- non-null state. Messages.add() keeps this up to date, so that looking up the state of a room does not need to scan
+-- the messages in the room.
+CREATE TABLE IF NOT EXISTS room_state (
+  room TEXT PRIMARY KEY,
+  from_bot INTEGER,  -- The bot which left the state.
+  state BLOB         -- JSON-encoded state, as in the messages table.
+);
+
+-- Fill in the state of rooms whose last message was posted before the room_state table existed. This is a no-op for
+-- rooms already tracked (the rows would be identical), and an index-only scan of messages_byroom otherwise.
+INSERT OR IGNORE INTO room_state (room, from_bot, state)
+  SELECT room, from_bot, state FROM messages
+  WHERE id IN (SELECT MAX(id) FROM messages GROUP BY room) AND state IS NOT NULL;
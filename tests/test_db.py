@@ -0,0 +1,256 @@
+import functools
+import random
+import sqlite3
+
+import anyio
+import pytest
+
+import necsus.db
+from necsus.catchup import QUERIES, CatchUpReader
+from necsus.db import COMMIT_BATCH_SIZE, DB, QUEUE_SECONDS, AsyncDB
+from necsus.server import create_db_connection, create_read_connection
+
+ROOMS = ['room_a', 'room_b', 'room_c']
+
+
+@pytest.fixture
+def db() -> DB:
+    """Return a DB wrapping a fresh in-memory database."""
+    connection = create_db_connection(':memory:')
+    yield DB(connection)
+    connection.close()
+
+
+def bots_table(db: DB, room: str) -> list:
+    """Read the bots in a room straight from the table, bypassing the cache."""
+    return db._connection.execute('SELECT * FROM bots WHERE room = ? ORDER BY id', (room,)).fetchall()
+
+
+def assert_bot_cache_consistent(db: DB):
+    for room in ROOMS:
+        assert db.bots.in_room(room) == bots_table(db, room), room
+
+
+def test_bot_cache_loads_lazily(db: DB):
+    """Bots written before a room is first read should still be seen, as should bots written afterwards."""
+    db.bots.update_or_add(id=None, room='room_a', name='Before', responds_to=None, url='http://before')
+    assert [bot['name'] for bot in db.bots.in_room('room_a')] == ['Before']
+
+    db.bots.update_or_add(id=None, room='room_a', name='After', responds_to=None, url='http://after')
+    assert [bot['name'] for bot in db.bots.in_room('room_a')] == ['Before', 'After']
+    assert_bot_cache_consistent(db)
+
+
+def test_bot_cache_moves_rooms(db: DB):
+    """Updating a bot to live in another room should move it between the cached rooms."""
+    bot = db.bots.update_or_add(id=None, room='room_a', name='Mover', responds_to=None, url='http://mover')
+    assert_bot_cache_consistent(db)
+
+    db.bots.update_or_add(id=bot['id'], room='room_b', name='Mover', responds_to=None, url='http://mover')
+    assert db.bots.in_room('room_a') == []
+    assert_bot_cache_consistent(db)
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_bot_cache_random_operations(seed: int, db: DB):
+    """Run a random sequence of bot writes and reads, checking the cache against the table after each one."""
+    rng = random.Random(seed)
+
+    for step in range(200):
+        ids = [row['id'] for row in db._connection.execute('SELECT id FROM bots').fetchall()]
+        operation = rng.choice(['add', 'update', 'remove', 'read', 'auto_add', 'delete_room'])
+
+        if operation == 'add' or (operation in ('update', 'remove') and not ids):
+            db.bots.update_or_add(id=None, room=rng.choice(ROOMS), name=f'Bot{step}', responds_to=None, url=f'http://bot/{step}')
+        elif operation == 'update':
+            db.bots.update_or_add(id=rng.choice(ids), room=rng.choice(ROOMS), name=f'Renamed{step}', responds_to=f'r{step}', url=f'http://bot/{step}')
+        elif operation == 'remove':
+            db.bots.remove(id=rng.choice(ids))
+        elif operation == 'auto_add':
+            db.bots.add(room=rng.choice(ROOMS), name=f'(Auto) {step}', url=f'http://auto/{step}')
+        elif operation == 'delete_room':
+            db.bots.delete(room=rng.choice(ROOMS))
+        else:
+            db.bots.in_room(rng.choice(ROOMS))
+
+        assert_bot_cache_consistent(db)
+
+
+def test_room_state(db: DB):
+    """The room state should follow the state of the last message in the room, and be removed by a clear."""
+    assert db.messages.room_state('room_a') is None
+
+    db.messages.add(room='room_a', author='Bot', text='Where?', from_bot=7, state={'step': 1})
+    db.messages.add(room='room_b', author='User', text='Elsewhere')
+    assert db.messages.room_state('room_a') == (7, {'step': 1})
+    assert db.messages.room_state('room_b') is None
+
+    db.messages.add(room='room_a', author='User', text='Here')
+    assert db.messages.room_state('room_a') is None
+
+    db.messages.add(room='room_a', author='Bot', text='Where?', from_bot=7, state=[1, 2])
+    db.messages.clear_room('room_a')
+    assert db.messages.room_state('room_a') is None
+
+
+def test_room_state_backfill(tmp_path):
+    """Databases from before the room_state table should have the state of each room filled in on startup."""
+    db_path = str(tmp_path / 'necsus.db')
+    db = DB(create_db_connection(db_path))
+    db.messages.add(room='room_a', author='Bot', text='Where?', from_bot=7, state={'step': 1})
+    db.messages.add(room='room_b', author='Bot', text='Where?', from_bot=7, state={'step': 1})
+    db.messages.add(room='room_b', author='User', text='Here')
+    db._connection.execute('DROP TABLE room_state')
+    db._connection.close()
+
+    db = DB(create_db_connection(db_path))
+    assert db.messages.room_state('room_a') == (7, {'step': 1})
+    assert db.messages.room_state('room_b') is None
+    db._connection.close()
+
+
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_async_db(anyio_backend, tmp_path):
+    """Writes through the AsyncDB should be seen by reads, which run concurrently on the reader connections."""
+    db_path = str(tmp_path / 'necsus.db')
+    adb = AsyncDB(create_db_connection(db_path), functools.partial(create_read_connection, db_path), readers=2)
+    reads_before = QUEUE_SECONDS.labels('reader').count
+
+    message = await adb.messages.add(room='room_a', author='User', text='Hello')
+    bot = await adb.bots.update_or_add(id=None, room='room_a', name='Bot', responds_to=None, url='http://bot')
+    assert await adb.bots.in_room('room_a') == [bot]
+    assert await adb.bots.find(id=bot['id']) == bot
+
+    results = []
+
+    async def read():
+        results.append(await adb.messages.since('room_a', -1))
+
+    async with anyio.create_task_group() as tg:
+        for _ in range(10):
+            tg.start_soon(read)
+
+    assert results == [[message]] * 10
+    assert QUEUE_SECONDS.labels('reader').count - reads_before == 11
+    adb.close()
+
+
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_coalesced_catch_up(anyio_backend):
+    """Reads by websockets catching up on the same room at once should share queries, and get the same results."""
+    adb = AsyncDB(create_db_connection(':memory:'))
+    reader = CatchUpReader(adb, window=0.01)
+    messages = [await adb.messages.add(room='room_a', author='User', text=f'Message {i}') for i in range(10)]
+    await adb.messages.add(room='room_b', author='User', text='Elsewhere')
+    await adb.clears.set_last_cleared_id('room_a', messages[0]['id'] - 1)
+
+    def queries(query):
+        return QUERIES.labels(query).value
+
+    async def gather(*reads):
+        results = [None] * len(reads)
+
+        async def read(i, function, *args):
+            results[i] = await function(*args)
+
+        async with anyio.create_task_group() as tg:
+            for i, (function, *args) in enumerate(reads):
+                tg.start_soon(read, i, function, *args)
+        return results
+
+    before = {query: queries(query) for query in ['last_ids', 'latest', 'since']}
+    assert await gather(*[(reader.last_ids, 'room_a')] * 5) == [(messages[0]['id'] - 1, messages[-1]['id'])] * 5
+    assert await gather((reader.latest, 'room_a', 2), (reader.latest, 'room_a', 3)) == [messages[-2:], messages[-3:]]
+
+    # Each websocket gets what it asked for, even past the end of the shared query, which is read separately.
+    ids = [message['id'] for message in messages]
+    assert await gather(
+        (reader.since, 'room_a', ids[0], 3),
+        (reader.since, 'room_a', ids[1], 3),
+        (reader.since, 'room_a', ids[5], 3),
+        (reader.since, 'room_a', ids[8], 3),
+    ) == [messages[1:4], messages[2:5], messages[6:9], messages[9:]]
+    assert await gather(
+        (reader.since, 'room_a', ids[0], 2),
+        (reader.since, 'room_a', ids[7], 2),
+    ) == [messages[1:3], messages[8:10]]
+
+    assert {query: queries(query) - before[query] for query in before} == {'last_ids': 1, 'latest': 1, 'since': 3}
+
+    # If the websocket whose read was to run the query goes away, the others carry on without it.
+    results = []
+
+    async def lead():
+        with anyio.move_on_after(reader.window / 2):
+            results.append(await reader.since('room_a', ids[0], 3))
+
+    async def follow():
+        results.append(await reader.since('room_a', ids[1], 3))
+
+    async with anyio.create_task_group() as tg:
+        tg.start_soon(lead)
+        tg.start_soon(follow)
+    assert results == [messages[2:5]]
+    adb.close()
+
+
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_group_commit(anyio_backend, tmp_path):
+    """Concurrent writes should be committed together, and a failing write should not undo the others in its batch."""
+    db_path = str(tmp_path / 'necsus.db')
+    adb = AsyncDB(create_db_connection(db_path), functools.partial(create_read_connection, db_path), commit_window=0.05)
+    batches_before = COMMIT_BATCH_SIZE.labels().count
+    added, failed = [], []
+
+    async def add(room: str):
+        try:
+            added.append(await adb.messages.add(room=room, author='User', text='Hello'))
+        except sqlite3.IntegrityError:
+            failed.append(room)
+
+    async with anyio.create_task_group() as tg:
+        for i in range(20):
+            # The empty room name fails the CHECK constraint on the messages table.
+            tg.start_soon(add, '' if i == 10 else 'room_a')
+
+    assert COMMIT_BATCH_SIZE.labels().count - batches_before < 20
+    assert failed == ['']
+    assert len({message['id'] for message in added}) == 19
+    adb.close()
+
+    # Everything written should be durable, as seen from a new connection.
+    db = DB(create_db_connection(db_path))
+    assert db.messages.since('room_a') == sorted(added, key=lambda message: message['id'])
+    db._connection.close()
+
+
+@pytest.mark.parametrize('has_returning', [True, False])
+def test_writes_return_stored_rows(has_returning: bool, db: DB, monkeypatch):
+    """Writes should return exactly the row which was stored, whether or not SQLite supports RETURNING."""
+    monkeypatch.setattr(necsus.db, 'HAS_RETURNING', has_returning)
+
+    def stored(table: str, id: int):
+        return db._connection.execute(f'SELECT * FROM {table} WHERE id = ?', (id,)).fetchone()
+
+    message = db.messages.add(room='room_a', author='Bot', text='Hi', from_bot=1, state={'step': 1})
+    assert message == stored('messages', message['id'])
+    assert message['kind'] == 'user' and isinstance(message['when'], str)
+
+    bot = db.bots.update_or_add(id=None, room='room_a', name='Bot', responds_to=None, url='http://bot')
+    assert bot == stored('bots', bot['id'])
+
+    bot = db.bots.update_or_add(id=bot['id'], room='room_a', name='Renamed', responds_to='hi', url='http://bot')
+    assert bot == stored('bots', bot['id']) and bot['name'] == 'Renamed'
+
+    bot = db.bots.add(room='room_a', name='(Auto) Bot', url='http://auto')
+    assert bot == stored('bots', bot['id'])
+
+
+def test_queries_are_parameterised(db: DB):
+    """Values are passed as parameters rather than inlined, so the SQL text is the same whatever they contain."""
+    assert necsus.db.select_sql('bots', ('room', 'url')) == 'SELECT * FROM "bots" WHERE "room" = ? AND "url" = ?'
+
+    room = "room'); DROP TABLE messages; --"
+    message = db.messages.add(room=room, author='O\'Brien "Bob"', text='?')
+    assert db.messages.since(room) == [message]
+    assert db.messages.find(room=room, author='O\'Brien "Bob"') == message
@@ -0,0 +1,226 @@
+import concurrent.futures
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import anyio
+import httpx
+import pytest
+import websockets.sync.client
+
+from necsus import hub
+from necsus.broker import HUB_OVERFLOWS, HubBroker
+from necsus.hub import Hub
+
+ROOM = 'hub_room'
+
+
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_hub_broker_order(anyio_backend, tmp_path):
+    """Events published concurrently by several brokers should reach each broker's room log once each, in one order."""
+    path = str(tmp_path / 'hub.sock')
+    bot_changes = []
+
+    def bot_changed(i: int):
+        async def on_remote_bot_change():
+            bot_changes.append(i)
+        return on_remote_bot_change
+
+    async with anyio.create_task_group() as tg:
+        await tg.start(Hub(path).serve)
+        brokers = [HubBroker(path, on_remote_bot_change=bot_changed(i)) for i in range(3)]
+        for broker in brokers:
+            await tg.start(broker.run)
+        subscriptions = [broker.subscribe(ROOM, since_id=-1, init_bots=[]) for broker in brokers]
+
+        async def publish(broker: HubBroker, worker: int):
+            for n in range(50):
+                await broker.publish_message(ROOM, {'id': None, 'text': f'{worker}:{n}'})
+                await anyio.sleep(0)
+
+        async with anyio.create_task_group() as publishers:
+            for worker, broker in enumerate(brokers):
+                publishers.start_soon(publish, broker, worker)
+        await brokers[0].put_bot(ROOM, {'id': 1})
+
+        received = [[] for _ in brokers]
+
+        async def read(subscription, frames: list):
+            async for frame in subscription.frames():
+                frames.append(json.loads(frame))
+                if len(frames) == 151:
+                    return
+
+        with anyio.fail_after(5):
+            async with anyio.create_task_group() as readers:
+                for subscription, frames in zip(subscriptions, received):
+                    readers.start_soon(read, subscription, frames)
+
+        # Only the brokers which did not change the bot were told about it.
+        await anyio.wait_all_tasks_blocked()
+        tg.cancel_scope.cancel()
+
+    assert received[0] == received[1] == received[2]
+    texts = [event['data']['text'] for event in received[0] if event['kind'] == 'message']
+    for worker in range(3):
+        assert [text for text in texts if text.startswith(f'{worker}:')] == [f'{worker}:{n}' for n in range(50)]
+    assert sorted(bot_changes) == [1, 2]
+
+
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_hub_oversized_line(anyio_backend, tmp_path, monkeypatch):
+    """A connection sending a line longer than the hub accepts should be closed, leaving the hub relaying the others."""
+    monkeypatch.setattr(hub, 'MAX_LINE', 1024)
+    path = str(tmp_path / 'hub.sock')
+
+    async with anyio.create_task_group() as tg:
+        await tg.start(Hub(path).serve)
+        broker = HubBroker(path)
+        await tg.start(broker.run)
+        subscription = broker.subscribe(ROOM, since_id=-1, init_bots=[])
+
+        with anyio.fail_after(5):
+            async with await anyio.connect_unix(path) as stream:
+                await stream.send(b'x' * 2048 + b'\n')
+                with pytest.raises(anyio.EndOfStream):
+                    await stream.receive()
+
+            # The broker does not send the hub an event too long for it.
+            await broker.publish_message(ROOM, {'id': None, 'text': 'x' * 2048})
+            await broker.publish_message(ROOM, {'id': None, 'text': 'Still here'})
+            frame = await subscription.frames().__anext__()
+        tg.cancel_scope.cancel()
+
+    assert json.loads(frame)['data']['text'] == 'Still here'
+
+
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_hub_slow_worker(anyio_backend, tmp_path):
+    """The hub should disconnect a worker which stops reading once its queue is full, and keep relaying to the others."""
+    path = str(tmp_path / 'hub.sock')
+    server = Hub(path, queue_size=2)
+
+    async with anyio.create_task_group() as tg:
+        await tg.start(server.serve)
+        broker = HubBroker(path)
+        await tg.start(broker.run)
+
+        with anyio.fail_after(5):
+            async with await anyio.connect_unix(path) as slow:
+                while len(server.workers) < 2:
+                    await anyio.sleep(0.01)
+
+                # Lines this long fill the socket's buffers, so the hub's queue for the slow worker fills too.
+                for _ in range(20):
+                    await broker.publish_message(ROOM, {'id': None, 'text': 'x' * 100_000})
+                while len(server.workers) > 1:
+                    await anyio.sleep(0.01)
+
+                received = 0
+                with pytest.raises(anyio.EndOfStream):
+                    while True:
+                        received += len(await slow.receive())
+        tg.cancel_scope.cancel()
+
+    assert received < 20 * 100_000
+
+
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_hub_broker_overflow(anyio_backend, tmp_path):
+    """A worker should drop the events queued for a hub which is not taking them, and send its websockets to catch up."""
+    broker = HubBroker(str(tmp_path / 'no-hub.sock'), queue_size=2)
+    overflows = HUB_OVERFLOWS.value
+
+    async with anyio.create_task_group() as tg:
+        await tg.start(broker.run)
+        subscription = broker.subscribe(ROOM, since_id=-1, init_bots=[])
+        for n in range(3):
+            await broker.publish_message(ROOM, {'id': n, 'text': f'{n}'})
+        tg.cancel_scope.cancel()
+
+    assert subscription.evicted
+    assert HUB_OVERFLOWS.value == overflows + 1
+    assert broker._outbox_recv.statistics().current_buffer_used == 0
+
+
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_hub_broker_duplicates(anyio_backend, tmp_path):
+    """An event sent again after losing the connection to the hub, having reached it already, should be dropped."""
+    broker = HubBroker(str(tmp_path / 'hub.sock'))
+    lines = [
+        hub.encode_line('a', 0, ROOM, 'message', 1, '"A0"'),
+        hub.encode_line('b', 0, ROOM, 'message', 2, '"B0"'),
+        hub.encode_line('a', 1, ROOM, 'message', 3, '"A1"'),
+        hub.encode_line('a', 1, ROOM, 'message', 3, '"A1"'),
+        hub.encode_line('b', 1, ROOM, 'message', 4, '"B1"'),
+    ]
+    for line in lines:
+        broker._receive(line.rstrip(b'\n'), tg=None)
+
+    log = broker.logs[ROOM]
+    assert [log.entries[seq][1] for seq in range(log.next_seq)] == ['"A0"', '"B0"', '"A1"', '"B1"']
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+def test_workers(tmp_path):
+    """Run several server processes sharing a hub, and check that every websocket sees every message once, in order."""
+    env = {
+        **os.environ,
+        'NECSUS_DB': str(tmp_path / 'necsus.db'),
+        'NECSUS_BROKER': 'hub',
+        'NECSUS_BROKER_HUB': str(tmp_path / 'hub.sock'),
+    }
+    processes = [subprocess.Popen([sys.executable, '-m', 'necsus.hub', env['NECSUS_BROKER_HUB']], env=env)]
+    ports = [free_port() for _ in range(3)]
+
+    try:
+        for port in ports:
+            processes.append(subprocess.Popen(
+                [sys.executable, '-m', 'uvicorn', 'necsus.server:app', '--port', str(port), '--log-level', 'warning'],
+                env=env,
+            ))
+
+        deadline = time.monotonic() + 20
+        for port in ports:
+            while True:
+                try:
+                    httpx.get(f'http://localhost:{port}/api/bots')
+                    break
+                except httpx.TransportError:
+                    assert time.monotonic() < deadline, "The workers did not start in time"
+                    time.sleep(0.1)
+
+        websockets_ = [websockets.sync.client.connect(f'ws://localhost:{port}/ws/{ROOM}') for port in ports]
+
+        def post(port: int, worker: int):
+            with httpx.Client() as client:
+                for n in range(20):
+                    client.post(f'http://localhost:{port}/api/actions/message', json={'room': ROOM, 'author': 'Test', 'text': f'{worker}:{n}'})
+
+        with concurrent.futures.ThreadPoolExecutor() as pool:
+            for _ in pool.map(post, ports, range(3)):
+                pass
+
+        received = []
+        for ws in websockets_:
+            with ws:
+                received.append([json.loads(ws.recv(timeout=10))['data'] for _ in range(60)])
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+    assert received[0] == received[1] == received[2]
+    texts = [message['text'] for message in received[0]]
+    for worker in range(3):
+        assert [text for text in texts if text.startswith(f'{worker}:')] == [f'{worker}:{n}' for n in range(20)]
+    assert len(texts) == 60
@@ -1,16 +1,39 @@
+import gzip
 import json
 import pathlib
+import sqlite3
 import subprocess
+import time
 
+import anyio
 import asgiref.wsgi
 import httpx
 import pytest
+import regex
 import respx
+from starlette.responses import JSONResponse
 from starlette.testclient import TestClient
+from websockets.extensions.permessage_deflate import ClientPerMessageDeflateFactory
+from websockets.frames import Frame, Opcode
 
 from example_bots import app as example_bots_app
 from necsus import app as necsus_app
+from necsus.botclient import CONNECTION_WAIT_SECONDS, HOST_LIMIT_WAITS, BotClient
+from necsus.broker import Broker, encode_event
+from necsus.circuit import CircuitBreakers
+from necsus.compression import SHARED_HITS, SharedCompressions, deflate_factory
+from necsus.events import REPLIES_REJECTED, REPLIES_TRUNCATED
+from necsus.matching import (
+    BOT_PATTERN_FLAGS,
+    MATCH_BUDGET_EXCEEDED,
+    PATTERN_CACHE_MISSES,
+    PREFILTER_SKIPS,
+    MatchBudgetExceeded,
+    Matcher,
+)
 from necsus.server import create_db_connection
+from necsus.timeouts import AdaptiveTimeouts, RollingHistogram
+from necsus.workqueue import WorkQueue
 
 # The necsus() fixture resets the database for each test, so this room should always start empty.
 TEST_ROOM = 'test_room'
@@ -92,8 +115,8 @@ def test_add_remove_bots(necsus: TestClient):
     server_bot = necsus.post('/api/actions/bot', json=user_bot).json()
     assert user_bot.items() <= server_bot.items()
 
-    # Ensure the bot is in the room.
-    assert necsus.get('/api/bots', params={'room': TEST_ROOM}).json() == [server_bot]
+    # Ensure the bot is in the room, along with the state of its host's circuit breaker.
+    assert necsus.get('/api/bots', params={'room': TEST_ROOM}).json() == [{**server_bot, 'breaker': 'closed'}]
 
     # Remove the bot from the room, and ensure there are no bots remaining.
     assert necsus.request('delete', '/api/actions/bot', json={'id': server_bot['id']}).status_code == 200
@@ -134,7 +157,10 @@ def test_echo(necsus: TestClient, example_bots: respx.MockRouter):
             'room': TEST_ROOM,
             'name': 'EchoBot',
             'responds_to': None,
-            'url': f'{EXAMPLE_BOTS_URL}/echobot'
+            'url': f'{EXAMPLE_BOTS_URL}/echobot',
+            'connect_timeout': None,
+            'read_timeout': None,
+            'breaker': 'closed',
         },
     ]
 
@@ -280,3 +306,818 @@ def test_pathological_regexes(regex, text, does_match, necsus: TestClient):
 
         if does_match:
             assert route.called or last_message['kind'] == 'system'
+
+
+@pytest.mark.parametrize('pattern', [
+    r'^(.+)+_$', 'a?'*30 + 'a'*30, '^(aa|aa)*$', '(a+)+b', 'EchoBot', 'Quiz Bot', r'^stop\b', 'kit|(?P<what>cat)s?',
+    r'hello (?P<name>\w+)', 'xyz', '(', 'a{e<=1}bc', '[[:alpha:]]]', '(?-i:Hi) there', 'ab+c{2}', 'hiybot',
+])
+@pytest.mark.parametrize('text', [
+    'a'*32, 'a'*71, 'a'*5000 + 'c', 'Hi EchoBot', 'quiz bot?', 'ſtop it', 'STOP', 'Kitten', 'ı like CATS', 'hello world',
+    'abd', 'alpha]', 'hi THERE', 'ABBCC', 'HİYBOT', 'say İt', '',
+])
+def test_prefiltered_matching(pattern, text):
+    """
+    Test that the bots the Matcher picks as candidates for a message include every bot whose pattern matches it,
+    times out on it, or fails to compile, by comparing with searching every pattern.
+    """
+    matcher = Matcher()
+    bot = {'name': 'Bot', 'responds_to': pattern}
+    try:
+        outcome = matcher.compile(pattern).search(text, timeout=0.01) is not None
+    except Exception:
+        outcome = True
+    assert matcher.candidates([bot], text) == [bot] or not outcome
+
+
+def test_prefilter_skips():
+    """Test that bots whose patterns require a literal the message lacks are skipped, but not those which may time out."""
+    matcher = Matcher()
+    bots = [{'name': 'EchoBot'}, {'name': 'StopBot', 'responds_to': r'^stop\b'}, {'name': 'SlowBot', 'responds_to': '(a+)+b'}]
+    for bot in bots:
+        matcher.compile(bot.get('responds_to') or bot['name'])
+
+    skips = PREFILTER_SKIPS.value
+    assert matcher.candidates(bots, 'ſTOP, echobot') == bots[:]
+    assert matcher.candidates(bots, 'aaaa') == bots[2:]
+    assert matcher.candidates(bots, 'İ said STOP') == bots[1:]
+    assert PREFILTER_SKIPS.value == skips + 3
+
+
+def test_threaded_matching():
+    """
+    Test that matching a message with a room's bots happens off the event loop, and that bots left once the
+    matching budget runs out are not searched.
+    """
+    matcher = Matcher(timeout=0.02, budget=0.03, threads=1)
+    bots = [{'name': f'Slow{i}', 'responds_to': '(a+)+b'} for i in range(4)] + [{'name': 'Hi', 'responds_to': 'a'}]
+    ticks = 0
+
+    async def tick():
+        nonlocal ticks
+        while True:
+            await anyio.sleep(0.001)
+            ticks += 1
+
+    async def main():
+        async with anyio.create_task_group() as tg:
+            tg.start_soon(tick)
+            results = await matcher.match(bots, 'a' * 5000)
+            tg.cancel_scope.cancel()
+        return results
+
+    exceeded = MATCH_BUDGET_EXCEEDED.value
+    results = anyio.run(main)
+    assert [bot for bot, _ in results] == bots
+    assert [type(result) for _, result in results[:2]] == [TimeoutError, TimeoutError]
+    assert all(isinstance(result, MatchBudgetExceeded) for _, result in results[2:])
+    assert MATCH_BUDGET_EXCEEDED.value == exceeded + 1
+    assert ticks >= 10
+
+
+def test_stateful_conversation(necsus: TestClient):
+    """
+    Test that a bot which replies with some state receives the next message in the room (along with its state), and
+    that posting a message after the conversation ends, or clearing the room, leaves the room without state.
+    """
+    bot_url = 'http://bot.com/statebot'
+    with respx.mock:
+        route = respx.post(bot_url).mock(side_effect=[
+            httpx.Response(status_code=200, json={'text': 'Where did you see the cat?', 'state': {'step': 1}}),
+            httpx.Response(status_code=200, json={'text': 'Recorded.'}),
+            httpx.Response(status_code=200, json={'text': 'Where?', 'state': {'step': 1}}),
+        ])
+        necsus.post('/api/actions/bot', json={'room': TEST_ROOM, 'name': 'CatBot', 'url': bot_url})
+
+        # Start the conversation, and check the next message is forwarded with the state even without naming the bot.
+        necsus.post('/api/actions/message', json={'room': TEST_ROOM, 'author': TEST_AUTHOR, 'text': 'I saw a catbot!'})
+        necsus.post('/api/actions/message', json={'room': TEST_ROOM, 'author': TEST_AUTHOR, 'text': 'Behind the college'})
+        assert route.call_count == 2
+        assert json.loads(route.calls.last.request.content)['state'] == {'step': 1}
+
+        # The bot replied without state, so the room should be back to normal.
+        necsus.post('/api/actions/message', json={'room': TEST_ROOM, 'author': TEST_AUTHOR, 'text': 'Unrelated'})
+        assert route.call_count == 2
+
+        # Start a conversation again, then clear the room: the state should be gone with the messages.
+        necsus.post('/api/actions/message', json={'room': TEST_ROOM, 'author': TEST_AUTHOR, 'text': 'Hi catbot'})
+        assert route.call_count == 3
+        necsus.post('/api/actions/clear-room-messages', json={'room': TEST_ROOM})
+        necsus.post('/api/actions/message', json={'room': TEST_ROOM, 'author': TEST_AUTHOR, 'text': 'Unrelated'})
+        assert route.call_count == 3
+
+
+def metric_value(necsus: TestClient, sample: str) -> float:
+    """Read a single sample (e.g. 'necsus_bot_pool_hits_total') from /api/metrics, returning 0 if it is missing."""
+    for line in necsus.get('/api/metrics').text.splitlines():
+        if line.startswith(sample + ' '):
+            return float(line.split(' ')[-1])
+    return 0.0
+
+
+def test_metrics(necsus: TestClient, example_bots: respx.MockRouter):
+    """Test that the metrics endpoint works, and that bot requests go through the shared pool."""
+    response = necsus.get('/api/metrics')
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('text/plain')
+    assert '# TYPE necsus_bot_pool_hits_total counter' in response.text
+
+    before = metric_value(necsus, 'necsus_bot_pool_hits_total') + metric_value(necsus, 'necsus_bot_pool_misses_total')
+    necsus.post('/api/actions/bot', json={'room': TEST_ROOM, 'name': 'EchoBot', 'url': f'{EXAMPLE_BOTS_URL}/echobot'})
+    for _ in range(2):
+        necsus.post('/api/actions/message', json={'room': TEST_ROOM, 'author': TEST_AUTHOR, 'text': 'Hi echobot'})
+    after = metric_value(necsus, 'necsus_bot_pool_hits_total') + metric_value(necsus, 'necsus_bot_pool_misses_total')
+    assert after - before == 2
+
+
+def test_circuit_breaker(necsus: TestClient):
+    """
+    Test that a bot's host stops being contacted after failing enough times in a row, that each room is told so once,
+    and that the host is tried again after the backoff.
+    """
+    now = 0.0
+    necsus.app.state.bot_client.breakers = CircuitBreakers(threshold=2, backoff=10.0, clock=lambda: now)
+
+    def post(text):
+        necsus.post('/api/actions/message', json={'room': TEST_ROOM, 'author': TEST_AUTHOR, 'text': text})
+        return necsus.get('/api/messages', params={'room': TEST_ROOM}).json()[-1]
+
+    bot_url = 'http://sleepy.bot.com/bot'
+    with respx.mock:
+        route = respx.post(bot_url).mock(side_effect=httpx.ConnectError('Connection refused'))
+        necsus.post('/api/actions/bot', json={'room': TEST_ROOM, 'name': 'SleepyBot', 'url': bot_url})
+
+        for _ in range(2):
+            assert 'could not connect' in post('SleepyBot?')['text'].lower()
+        assert [bot['breaker'] for bot in necsus.get('/api/bots').json()] == ['open']
+
+        # Once open, the bot is not contacted, and the room is told so only once.
+        notice = post('SleepyBot?')
+        assert notice['kind'] == 'system' and 'not contacting' in notice['text'].lower()
+        assert post('SleepyBot?')['text'] == 'SleepyBot?'
+        assert route.call_count == 2
+        assert necsus.get('/api/breakers').json() == [
+            {'host': 'sleepy.bot.com', 'state': 'open', 'failures': 2, 'latency': pytest.approx(0, abs=1), 'retry_in': 10.0},
+        ]
+
+        # After the backoff, one request goes through, and closes the breaker when it succeeds.
+        now += 10.0
+        assert necsus.get('/api/breakers').json()[0]['state'] == 'half_open'
+        route.side_effect = None
+        route.return_value = httpx.Response(200, json={'text': 'Awake'})
+        assert post('SleepyBot?')['text'] == 'Awake'
+        assert necsus.get('/api/breakers').json()[0]['state'] == 'closed'
+
+
+def test_circuit_breaker_generations():
+    """
+    Test that the outcome of a request allowed before its breaker changed state is ignored, and that a probe given up
+    without an outcome lets another through.
+    """
+    now = 0.0
+    breakers = CircuitBreakers(threshold=1, backoff=10.0, clock=lambda: now)
+    breaker = breakers.get('http://flaky.bot.com/bot')
+    slow, failing = breakers.allow(breaker), breakers.allow(breaker)
+    breakers.record(breaker, failing, 0.1, failed=True)
+    assert breaker.state == 'open'
+
+    # The request sent before the breaker opened succeeds late, but does not close it.
+    breakers.record(breaker, slow, 0.1, failed=False)
+    assert breaker.state == 'open'
+
+    now += 10.0
+    probe = breakers.allow(breaker)
+    assert probe is not None and breakers.allow(breaker) is None
+    breakers.release(breaker, probe)
+    probe = breakers.allow(breaker)
+    assert probe is not None
+    breakers.record(breaker, probe, 0.1, failed=False)
+    assert breaker.state == 'closed'
+
+
+def test_bot_timeouts(necsus: TestClient):
+    """
+    Test that a bot's read timeout adapts to its recent reply times, and that a bot's own timeouts are used instead
+    when it has them.
+    """
+    client_timeouts = necsus.app.state.bot_client.timeouts = AdaptiveTimeouts(connect=2.0, min_read=5.0, max_read=120.0, min_samples=3)
+    bot_url = 'http://slow.bot.com/bot'
+    timeouts = []
+
+    def reply(request):
+        timeouts.append(request.extensions['timeout'])
+        return httpx.Response(200, json={'text': 'Hi'})
+
+    with respx.mock:
+        respx.post(bot_url).mock(side_effect=reply)
+        bot = necsus.post('/api/actions/bot', json={'room': TEST_ROOM, 'name': 'SlowBot', 'url': bot_url}).json()
+        assert bot['connect_timeout'] is None and bot['read_timeout'] is None
+
+        # Until the bot has replied enough times, it gets the longest timeout.
+        for _ in range(3):
+            necsus.post('/api/actions/message', json={'room': TEST_ROOM, 'author': TEST_AUTHOR, 'text': 'SlowBot?'})
+        assert [timeout['read'] for timeout in timeouts] == [120.0] * 3
+        assert timeouts[0]['connect'] == 2.0
+
+        # Replies taking up to 10 seconds give a timeout of 4 times that.
+        for seconds in [0.1, 8.0, 10.0]:
+            client_timeouts.observe(bot_url, seconds)
+        assert client_timeouts.read_timeout(bot_url) == 40.0
+
+        # The bot's own timeouts take precedence.
+        bot = necsus.post('/api/actions/bot', json={**bot, 'connect_timeout': 1, 'read_timeout': 30.5}).json()
+        assert (bot['connect_timeout'], bot['read_timeout']) == (1, 30.5)
+        necsus.post('/api/actions/message', json={'room': TEST_ROOM, 'author': TEST_AUTHOR, 'text': 'SlowBot?'})
+        assert (timeouts[-1]['connect'], timeouts[-1]['read']) == (1, 30.5)
+
+        # Editing the bot without giving its timeouts, as the UI does, keeps them.
+        edit = {key: bot[key] for key in ['id', 'room', 'name', 'url', 'responds_to']}
+        bot = necsus.post('/api/actions/bot', json={**edit, 'name': 'SlowerBot'}).json()
+        assert (bot['name'], bot['connect_timeout'], bot['read_timeout']) == ('SlowerBot', 1, 30.5)
+
+        for timeout in [0, -1, 121, 'soon', True]:
+            response = necsus.post('/api/actions/bot', json={**bot, 'read_timeout': timeout})
+            assert response.status_code == 400
+
+
+def test_rolling_histogram():
+    """Test that the rolling histogram of reply times forgets observations two windows old."""
+    histogram = RollingHistogram(window=2, buckets=(1.0, 10.0, 100.0))
+    for value in [50.0, 50.0, 5.0]:
+        histogram.observe(value)
+    assert histogram.quantile(0.99) == 100.0
+    histogram.observe(5.0)
+    histogram.observe(0.5)
+    assert histogram.count == 3
+    assert histogram.quantile(0.99) == 10.0
+    assert histogram.quantile(0.3) == 1.0
+
+
+def test_schema_migration(tmp_path: pathlib.Path):
+    """Test that columns added to the schema are added to a database created before them."""
+    db_path = str(tmp_path / 'necsus.db')
+    connection = sqlite3.connect(db_path)
+    connection.execute("CREATE TABLE bots (id INTEGER PRIMARY KEY AUTOINCREMENT, room TEXT, name TEXT, responds_to TEXT, url TEXT)")
+    connection.execute("INSERT INTO bots (room, name, url) VALUES ('room', 'OldBot', 'http://old.bot')")
+    connection.commit()
+    connection.close()
+
+    connection = create_db_connection(db_path)
+    connection.row_factory = sqlite3.Row
+    assert [dict(row) for row in connection.execute('SELECT * FROM bots')] == [
+        {'id': 1, 'room': 'room', 'name': 'OldBot', 'responds_to': None, 'url': 'http://old.bot', 'connect_timeout': None, 'read_timeout': None},
+    ]
+    connection.close()
+
+
+def test_reply_limits(necsus: TestClient):
+    """
+    Test that a bot reply longer than the byte limit is ignored, that invalid replies are only quoted in part, and
+    that fields of a reply which are too long are cut short or left out.
+    """
+    client = necsus.app.state.bot_client
+    client.max_reply_bytes, client.max_text_chars, client.max_asset_chars = 2000, 100, 50
+    bot_url = 'http://big.bot.com/bot'
+
+    def post():
+        necsus.post('/api/actions/message', json={'room': TEST_ROOM, 'author': TEST_AUTHOR, 'text': 'BigBot?'})
+        return necsus.get('/api/messages', params={'room': TEST_ROOM}).json()[-1]
+
+    with respx.mock:
+        route = respx.post(bot_url)
+        necsus.post('/api/actions/bot', json={'room': TEST_ROOM, 'name': 'BigBot', 'url': bot_url})
+
+        rejected = REPLIES_REJECTED.value
+        for headers in [{}, {'Content-Encoding': 'gzip'}]:
+            content = json.dumps({'text': 'x' * 5000}).encode()
+            route.mock(return_value=httpx.Response(200, content=gzip.compress(content) if headers else content, headers=headers))
+            message = post()
+            assert message['kind'] == 'system' and 'more than 2000 bytes' in message['text']
+        assert REPLIES_REJECTED.value == rejected + 2
+
+        # A malformed Content-Length is ignored in favour of counting the body.
+        for length in ['soon', '10, 10']:
+            route.mock(return_value=httpx.Response(200, content=b'{"text": "Hi"}', headers={'Content-Length': length}))
+            assert post()['text'] == 'Hi'
+            route.mock(return_value=httpx.Response(200, content=json.dumps({'text': 'x' * 5000}).encode(), headers={'Content-Length': length}))
+            assert 'more than 2000 bytes' in post()['text']
+
+        route.mock(return_value=httpx.Response(200, text='<html>' + 'y' * 1500))
+        message = post()
+        assert 'invalid JSON' in message['text'] and '(506 more characters)' in message['text']
+        assert 'y' * 994 in message['text'] and 'y' * 995 not in message['text']
+
+        truncated = {field: REPLIES_TRUNCATED.labels(field).value for field in ('text', 'css')}
+        route.mock(return_value=httpx.Response(200, json={'text': 'z' * 150, 'css': 'http://a/' + 's' * 50, 'js': 'http://a/app.js'}))
+        message = post()
+        assert message['text'].startswith('z' * 100 + '...') and 'z' * 101 not in message['text']
+        assert message['css'] is None and message['js'] == 'http://a/app.js'
+        assert REPLIES_TRUNCATED.labels('text').value == truncated['text'] + 1
+        assert REPLIES_TRUNCATED.labels('css').value == truncated['css'] + 1
+
+
+def test_metrics_instrumentation(necsus: TestClient, example_bots: respx.MockRouter):
+    """Test that routes, bots, pattern matching, subscribers and the event loop are measured."""
+    route = 'necsus_http_request_seconds_count{route="/api/actions/message",method="POST"}'
+    matches = 'necsus_pattern_match_seconds_count'
+    requests_before, matches_before = metric_value(necsus, route), metric_value(necsus, matches)
+
+    echo_bot = necsus.post('/api/actions/bot', json={'room': TEST_ROOM, 'name': 'EchoBot', 'url': f'{EXAMPLE_BOTS_URL}/echobot'}).json()
+    missing_bot = necsus.post('/api/actions/bot', json={'room': TEST_ROOM, 'name': 'Missing', 'responds_to': 'echobot', 'url': f'{EXAMPLE_BOTS_URL}/missing'}).json()
+
+    # Bot IDs start again for each test, but the metrics are kept.
+    bot_samples = [
+        f'necsus_bot_requests_total{{bot="{echo_bot["id"]}",outcome="ok"}}',
+        f'necsus_bot_requests_total{{bot="{missing_bot["id"]}",outcome="http_error"}}',
+        f'necsus_bot_request_seconds_count{{bot="{echo_bot["id"]}"}}',
+    ]
+    bots_before = [metric_value(necsus, sample) for sample in bot_samples]
+    with necsus.websocket_connect(f'/ws/{TEST_ROOM}') as ws:
+        assert [ws.receive_json()['kind'] for _ in range(2)] == ['put_bot', 'put_bot']
+        assert metric_value(necsus, f'necsus_broker_subscribers{{room="{TEST_ROOM}"}}') == 1
+        for _ in range(2):
+            necsus.post('/api/actions/message', json={'room': TEST_ROOM, 'author': TEST_AUTHOR, 'text': 'Hi echobot'})
+
+    assert metric_value(necsus, route) - requests_before == 2
+    assert metric_value(necsus, matches) - matches_before == 4
+    assert [metric_value(necsus, sample) - before for sample, before in zip(bot_samples, bots_before)] == [2, 2, 2]
+
+    # The metrics of a bot go when it is deleted.
+    necsus.request('DELETE', '/api/actions/bot', json={'id': missing_bot['id']})
+    assert f'bot="{missing_bot["id"]}"' not in necsus.get('/api/metrics').text
+
+    # Static files are measured by their mount.
+    static = 'necsus_http_request_seconds_count{route="/client",method="GET"}'
+    before = metric_value(necsus, static)
+    necsus.get('/client/necsus.js')
+    assert metric_value(necsus, static) - before == 1
+    assert '# TYPE necsus_event_loop_lag_seconds histogram' in necsus.get('/api/metrics').text
+
+
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_bot_client_host_limit(anyio_backend):
+    """Test that requests to a single host beyond its connection limit queue up rather than running concurrently."""
+    in_flight, max_in_flight = 0, 0
+
+    async def slow_bot(request):
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(in_flight, max_in_flight)
+        await anyio.sleep(0.01)
+        in_flight -= 1
+        return httpx.Response(200, json={'text': 'Hi'})
+
+    client = BotClient(max_connections_per_host=2)
+    waits_before = HOST_LIMIT_WAITS.value
+    with respx.mock:
+        respx.post('http://bot.com/slow').mock(side_effect=slow_bot)
+        async with anyio.create_task_group() as tg:
+            for _ in range(5):
+                tg.start_soon(client.post, 'http://bot.com/slow', {}, httpx.Timeout(1.0))
+    await client.aclose()
+
+    assert max_in_flight == 2
+    assert HOST_LIMIT_WAITS.value - waits_before == 3
+
+
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_bot_client_connection_waits(anyio_backend):
+    """Test that the time requests wait for a connection from the pool is measured, when the pool itself is full."""
+    async def serve(stream):
+        async with stream:
+            await stream.receive()
+            await anyio.sleep(0.05)
+            await stream.send(b'HTTP/1.1 200 OK\r\nContent-Length: 13\r\nConnection: close\r\n\r\n{"text":"Hi"}')
+
+    waits = CONNECTION_WAIT_SECONDS.labels()
+    count, total = waits.count, waits.sum
+    async with await anyio.create_tcp_listener(local_host='127.0.0.1') as listener, anyio.create_task_group() as tg:
+        tg.start_soon(listener.serve, serve)
+        port = listener.extra(anyio.abc.SocketAttribute.local_port)
+
+        client = BotClient(max_connections=1)
+        async with anyio.create_task_group() as requests:
+            for _ in range(2):
+                requests.start_soon(client.post, f'http://127.0.0.1:{port}/bot', {}, httpx.Timeout(5.0))
+        await client.aclose()
+        tg.cancel_scope.cancel()
+
+    # The second request waited for the first to finish with the only connection.
+    assert waits.count - count == 2
+    assert waits.sum - total >= 0.04
+
+
+@pytest.mark.parametrize('reply_order, expected_authors', [
+    ('arrival', [TEST_AUTHOR, 'FastBot', 'SlowBot']),
+    ('bot', [TEST_AUTHOR, 'SlowBot', 'FastBot']),
+])
+def test_concurrent_bots(reply_order, expected_authors, necsus: TestClient):
+    """Test that matching bots are triggered concurrently, and that their replies are posted in the configured order."""
+    def bot_reply(delay: float):
+        async def reply(request):
+            await anyio.sleep(delay)
+            return httpx.Response(200, json={'text': 'Hi'})
+        return reply
+
+    necsus.app.state.bot_client.reply_order = reply_order
+    with respx.mock:
+        respx.post('http://bot.com/slow').mock(side_effect=bot_reply(0.3))
+        respx.post('http://bot.com/fast').mock(side_effect=bot_reply(0.1))
+        necsus.post('/api/actions/bot', json={'room': TEST_ROOM, 'name': 'SlowBot', 'url': 'http://bot.com/slow', 'responds_to': 'hi'})
+        necsus.post('/api/actions/bot', json={'room': TEST_ROOM, 'name': 'FastBot', 'url': 'http://bot.com/fast', 'responds_to': 'hi'})
+
+        start = time.monotonic()
+        necsus.post('/api/actions/message', json={'room': TEST_ROOM, 'author': TEST_AUTHOR, 'text': 'hi bots'})
+        assert time.monotonic() - start < 0.39
+
+    messages = necsus.get('/api/messages', params={'room': TEST_ROOM}).json()
+    assert [message['author'] for message in messages] == expected_authors
+
+
+def test_background_dispatch(necsus: TestClient):
+    """Test that in background mode, posting a message returns before the bots reply, and the reply arrives later."""
+    async def slow_reply(request):
+        await anyio.sleep(0.3)
+        return httpx.Response(200, json={'text': 'Hi'})
+
+    necsus.app.state.bot_dispatch = 'background'
+    with respx.mock:
+        respx.post('http://bot.com/slow').mock(side_effect=slow_reply)
+        necsus.post('/api/actions/bot', json={'room': TEST_ROOM, 'name': 'SlowBot', 'url': 'http://bot.com/slow'})
+
+        start = time.monotonic()
+        user_message = necsus.post('/api/actions/message', json={'room': TEST_ROOM, 'author': TEST_AUTHOR, 'text': 'hi slowbot'}).json()
+        assert time.monotonic() - start < 0.2
+        assert necsus.get('/api/messages', params={'room': TEST_ROOM}).json() == [user_message]
+
+        for _ in range(50):
+            if len(messages := necsus.get('/api/messages', params={'room': TEST_ROOM}).json()) == 2:
+                break
+            time.sleep(0.02)
+
+    assert [message['author'] for message in messages] == [TEST_AUTHOR, 'SlowBot']
+
+
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_work_queue_drain(anyio_backend):
+    """Test that draining the work queue finishes queued jobs, and cancels jobs which outlast the timeout."""
+    finished = []
+
+    async def job(delay: float):
+        await anyio.sleep(delay)
+        finished.append(delay)
+
+    queue = WorkQueue(workers=2)
+    async with anyio.create_task_group() as tg:
+        tg.start_soon(queue.run)
+        for delay in [0.01, 0.02, 0.03, 10]:
+            queue.submit(job, delay)
+        await queue.drain(timeout=0.5)
+
+    assert finished == [0.01, 0.02, 0.03]
+
+
+def test_pattern_cache():
+    """Test that compiled patterns (and errors from invalid patterns) are cached, evicted and discarded."""
+    matcher = Matcher(max_patterns=2)
+    misses = PATTERN_CACHE_MISSES.value
+
+    assert matcher.compile('hello').search('HELLO there')
+    assert matcher.compile('hello').search('hello there')
+    assert PATTERN_CACHE_MISSES.value - misses == 1
+
+    # An invalid pattern raises the same error every time, but is only compiled once.
+    for _ in range(2):
+        with pytest.raises(regex.error):
+            matcher.compile('(unclosed')
+    assert PATTERN_CACHE_MISSES.value - misses == 2
+
+    # Adding a third pattern evicts the least recently used, and discarding forgets a pattern.
+    matcher.compile('third')
+    matcher.discard('third')
+    assert list(matcher._patterns) == [('(unclosed', BOT_PATTERN_FLAGS)]
+
+
+def test_websocket_events(necsus: TestClient):
+    """Test that a websocket receives the room's bots and messages on connecting, and then each new event."""
+    bot = necsus.post('/api/actions/bot', json={'room': TEST_ROOM, 'name': 'TestBot', 'url': 'http://definitely/a/url'}).json()
+    before = necsus.post('/api/actions/message', json={'room': TEST_ROOM, 'author': TEST_AUTHOR, 'text': 'Before'}).json()
+
+    with necsus.websocket_connect(f'/ws/{TEST_ROOM}') as ws:
+        assert ws.receive_json() == {'kind': 'put_bot', 'data': bot}
+        assert ws.receive_json() == {'kind': 'message', 'data': before}
+
+        # Events are sent as compact JSON, with non-ASCII text left as is.
+        after = necsus.post('/api/actions/message', json={'room': TEST_ROOM, 'author': TEST_AUTHOR, 'text': 'Après'}).json()
+        assert ws.receive_text() == json.dumps({'kind': 'message', 'data': after}, separators=(',', ':'), ensure_ascii=False)
+
+        necsus.post('/api/actions/clear-room-messages', json={'room': TEST_ROOM})
+        assert ws.receive_json() == {'kind': 'clear_messages', 'data': {}}
+
+    # Reconnecting is served from the broker's log of the room, which includes the clear.
+    memory_catch_ups = metric_value(necsus, 'necsus_broker_catch_ups_total{source="memory"}')
+    with necsus.websocket_connect(f'/ws/{TEST_ROOM}?since={before["id"]}') as ws:
+        assert ws.receive_json() == {'kind': 'put_bot', 'data': bot}
+        assert ws.receive_json() == {'kind': 'clear_messages', 'data': {}}
+    assert metric_value(necsus, 'necsus_broker_catch_ups_total{source="memory"}') == memory_catch_ups + 1
+
+
+def test_websocket_replay(necsus: TestClient):
+    """Test that a websocket reconnecting from further back than the broker's log is caught up from the database."""
+    necsus.app.state.api_page_size = 2
+
+    # Stored without being published (as if by an earlier run of the server), so the broker's log is empty.
+    db = necsus.app.state.db._write_db
+    messages = [db.messages.add(room=TEST_ROOM, author=TEST_AUTHOR, text=f'Message {i}') for i in range(6)]
+    db._connection.commit()
+
+    with necsus.websocket_connect(f'/ws/{TEST_ROOM}?since={messages[0]["id"]}') as ws:
+        assert [ws.receive_json() for _ in range(5)] == [{'kind': 'message', 'data': message} for message in messages[1:]]
+
+        message = necsus.post('/api/actions/message', json={'room': TEST_ROOM, 'author': TEST_AUTHOR, 'text': 'New'}).json()
+        assert ws.receive_json() == {'kind': 'message', 'data': message}
+
+
+async def collect_frames(subscription) -> list:
+    """Read the events waiting for a subscription, without waiting for any more."""
+    events = []
+    with anyio.move_on_after(0.1):
+        async for frame in subscription.frames():
+            events.append(json.loads(frame))
+    return events
+
+
+def message_event(id: int) -> dict:
+    return {'kind': 'message', 'data': {'id': id, 'text': f'Message {id}'}}
+
+
+def test_shared_deflate():
+    """Test that with shared compression, a message sent to several websockets is compressed once, and decompresses."""
+    factory = deflate_factory('shared', window_bits=10)
+    client_factory = ClientPerMessageDeflateFactory(client_max_window_bits=True)
+
+    connections = []
+    for _ in range(3):
+        response_params, extension = factory.process_request_params(client_factory.get_request_params(), [])
+        assert ('server_no_context_takeover', None) in response_params
+        connections.append((extension, client_factory.process_response_params(response_params, [])))
+
+    hits = SHARED_HITS.value
+    for event in [message_event(1), message_event(2), {'kind': 'message', 'data': {'text': 'Répété ' * 200}}]:
+        data = json.dumps(event).encode()
+        for extension, client_extension in connections:
+            frame = extension.encode(Frame(Opcode.TEXT, data))
+            assert frame.rsv1
+            assert client_extension.decode(frame).data == data
+    assert SHARED_HITS.value - hits == 6
+
+    # The cache keeps only the compressed messages, up to its byte limit.
+    shared = SharedCompressions(max_bytes=100)
+    for n in range(10):
+        shared.compress(json.dumps(message_event(n)).encode(), 10, {})
+    assert 0 < shared.bytes <= 100
+    assert all(isinstance(compressed, bytes) and len(key[1]) == 16 for key, compressed in shared._compressed.items())
+
+
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_broker_catch_up(anyio_backend):
+    """Test that subscribers are caught up from the room log when it goes back far enough, and otherwise not."""
+    broker = Broker(log_size=4)
+
+    # Nothing has been published, so the broker cannot know what was missed.
+    assert broker.subscribe(TEST_ROOM, since_id=-1, init_bots=[]).catching_up
+
+    for id in [10, 11, 12]:
+        await broker.publish_message(TEST_ROOM, message_event(id)['data'])
+    await broker.put_bot(TEST_ROOM, {'id': 1})
+
+    subscription = broker.subscribe(TEST_ROOM, since_id=10, init_bots=[{'id': 2}])
+    assert not subscription.catching_up
+    assert await collect_frames(subscription) == [{'kind': 'put_bot', 'data': {'id': 2}}, message_event(11), message_event(12)]
+
+    # A clear replaces everything before it.
+    await broker.clear_room(TEST_ROOM, 12)
+    await broker.publish_message(TEST_ROOM, message_event(13)['data'])
+    subscription = broker.subscribe(TEST_ROOM, since_id=11, init_bots=[])
+    assert await collect_frames(subscription) == [{'kind': 'clear_messages', 'data': {}}, message_event(13)]
+
+    # Messages 10 and 11 have dropped out of the log, so catching up from before them means reading the database.
+    # Anything published while reading is not sent twice.
+    subscription = broker.subscribe(TEST_ROOM, since_id=10, init_bots=[])
+    assert subscription.catching_up
+    await broker.publish_message(TEST_ROOM, message_event(14)['data'])
+    subscription.catch_up([message_event(14)['data']], should_clear=True)
+    assert await collect_frames(subscription) == [{'kind': 'clear_messages', 'data': {}}, message_event(14)]
+
+
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_broker_bots_after_subscribing(anyio_backend):
+    """Test that bots read after subscribing come first, followed by any bot change published since subscribing."""
+    broker = Broker(log_size=4)
+    await broker.publish_message(TEST_ROOM, message_event(1)['data'])
+    subscription = broker.subscribe(TEST_ROOM, since_id=0)
+    await broker.put_bot(TEST_ROOM, {'id': 2})
+    subscription.add_bots([{'id': 1}, {'id': 2}])
+    assert await collect_frames(subscription) == [
+        {'kind': 'put_bot', 'data': {'id': 1}},
+        {'kind': 'put_bot', 'data': {'id': 2}},
+        message_event(1),
+        {'kind': 'put_bot', 'data': {'id': 2}},
+    ]
+
+
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_broker_replay(anyio_backend):
+    """Test replaying missed messages a page at a time, with events published meanwhile sent after, and only once."""
+    stored = [message_event(id)['data'] for id in range(1, 8)]
+    fetches = []
+
+    async def fetch_page(after_id, limit):
+        fetches.append(after_id)
+        return [message for message in stored if message['id'] > after_id][:limit]
+
+    broker = Broker(log_size=4)
+    subscription = broker.subscribe(TEST_ROOM, since_id=2, init_bots=[])
+    assert subscription.catching_up
+
+    # Message 6 is published after subscribing, and message 7 after the latest message was looked up.
+    await broker.publish_message(TEST_ROOM, stored[5])
+    subscription.replay(fetch_page, 2, since_id=2, through_id=6, should_clear=False)
+    await broker.publish_message(TEST_ROOM, stored[6])
+    assert subscription.poll() is None
+
+    assert await collect_frames(subscription) == [message_event(id) for id in range(3, 8)]
+    assert fetches == [2, 4]
+
+    # Nothing to replay, but the room was cleared.
+    subscription = broker.subscribe(TEST_ROOM, since_id=0, init_bots=[])
+    subscription.replay(fetch_page, 2, since_id=7, through_id=7, should_clear=True)
+    assert await collect_frames(subscription) == [{'kind': 'clear_messages', 'data': {}}]
+
+    # A failed read stops the subscription, for the websocket to be closed.
+    async def fail(after_id, limit):
+        raise RuntimeError('The database is unavailable')
+
+    subscription = broker.subscribe(TEST_ROOM, since_id=0, init_bots=[])
+    subscription.replay(fail, 2, since_id=0, through_id=7, should_clear=False)
+    assert await collect_frames(subscription) == []
+    assert subscription.failed
+
+
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_broker_overflow(anyio_backend):
+    """Test what happens to a subscriber which falls behind the room log, under each overflow policy."""
+    # Dropping evicts the subscriber.
+    broker = Broker(log_size=2, overflow='drop')
+    dropped = broker.subscribe(TEST_ROOM, since_id=-1, init_bots=[])
+    for id in range(3):
+        await broker.publish_message(TEST_ROOM, message_event(id)['data'])
+    assert await collect_frames(dropped) == []
+    assert dropped.evicted
+
+    # Coalescing skips to the end of the log with a resync hint, noting whether the room was cleared, and carries on.
+    broker = Broker(log_size=2, overflow='coalesce')
+    coalesced = broker.subscribe(TEST_ROOM, since_id=-1, init_bots=[])
+    await broker.clear_room(TEST_ROOM, 0)
+    for id in range(1, 4):
+        await broker.publish_message(TEST_ROOM, message_event(id)['data'])
+    assert await collect_frames(coalesced) == [{'kind': 'resync', 'data': {'cleared': True}}]
+    await broker.publish_message(TEST_ROOM, message_event(4)['data'])
+    assert await collect_frames(coalesced) == [message_event(4)]
+
+    # Blocking holds up the publisher until the subscriber catches up.
+    broker = Broker(log_size=2, overflow='block')
+    blocked = broker.subscribe(TEST_ROOM, since_id=-1, init_bots=[])
+    for id in range(2):
+        await broker.publish_message(TEST_ROOM, message_event(id)['data'])
+    with anyio.move_on_after(0.1) as scope:
+        await broker.publish_message(TEST_ROOM, message_event(2)['data'])
+    assert scope.cancel_called
+
+    async with anyio.create_task_group() as tg:
+        tg.start_soon(broker.publish_message, TEST_ROOM, message_event(2)['data'])
+        assert await collect_frames(blocked) == [message_event(id) for id in range(3)]
+
+
+@pytest.mark.parametrize('anyio_backend', ['asyncio'])
+async def test_broker_log_limits(anyio_backend):
+    """Test that room logs are bounded by the length of their frames, and forgotten once nobody subscribes to them."""
+    frame_bytes = len(encode_event('message', message_event(10)['data']))
+    broker = Broker(log_size=10, log_bytes=3 * frame_bytes, idle_seconds=0)
+    subscription = broker.subscribe(TEST_ROOM, since_id=-1, init_bots=[])
+    for id in range(10, 15):
+        await broker.publish_message(TEST_ROOM, message_event(id)['data'])
+
+    log = broker.logs[TEST_ROOM]
+    assert (log.first_seq, log.next_seq, log.bytes) == (2, 5, 3 * frame_bytes)
+    assert broker.subscribe(TEST_ROOM, since_id=10, init_bots=[]).catching_up
+    assert not broker.subscribe(TEST_ROOM, since_id=11, init_bots=[]).catching_up
+
+    # A frame longer than the limit replaces everything else.
+    await broker.publish_message(TEST_ROOM, {'id': 15, 'text': 'x' * 4 * frame_bytes})
+    assert (log.first_seq, log.next_seq) == (5, 6)
+
+    # The log stays while anyone is subscribed, and goes once it has been seen without subscribers twice.
+    broker.forget_idle_logs()
+    assert TEST_ROOM in broker.logs
+    for subscription in list(log.subscriptions):
+        broker.unsubscribe(subscription)
+    broker.forget_idle_logs()
+    assert TEST_ROOM in broker.logs
+    broker.forget_idle_logs()
+    assert TEST_ROOM not in broker.logs
+
+
+def test_message_size_limit(necsus: TestClient):
+    """Test that a message posted with a body larger than the limit is refused, and not stored."""
+    max_bytes = necsus.app.state.api_max_message_bytes
+    message = {'room': TEST_ROOM, 'author': TEST_AUTHOR, 'text': 'x' * max_bytes}
+    response = necsus.post('/api/actions/message', json=message)
+    assert response.status_code == 413
+    assert necsus.get('/api/messages', params={'room': TEST_ROOM}).json() == []
+
+    response = necsus.post('/api/actions/message', json={**message, 'text': 'x' * (max_bytes // 2)})
+    assert response.status_code == 200
+
+
+def test_message_pages(necsus: TestClient):
+    """Test paging forwards and backwards through the messages in a room, following the X-Next-Cursor header."""
+    ids = [
+        necsus.post('/api/actions/message', json={'room': TEST_ROOM, 'author': TEST_AUTHOR, 'text': f'Message {i}'}).json()['id']
+        for i in range(5)
+    ]
+
+    def page(**params):
+        response = necsus.get('/api/messages', params={'room': TEST_ROOM, **params})
+        assert response.status_code == 200
+        return [message['id'] for message in response.json()], response.headers.get('X-Next-Cursor')
+
+    # With no limit, everything after 'since' is returned, as before.
+    assert page() == (ids, None)
+    assert page(since=ids[1]) == (ids[2:], None)
+
+    # Forwards from the start, the first page of 'after'.
+    assert page(after=-1, limit=2) == (ids[:2], str(ids[1]))
+    assert page(after=ids[1], limit=2) == (ids[2:4], str(ids[3]))
+    assert page(after=ids[3], limit=2) == (ids[4:], None)
+
+    # Backwards from the latest messages.
+    assert page(limit=2) == (ids[3:], str(ids[3]))
+    assert page(before=ids[3], limit=2) == (ids[1:3], str(ids[1]))
+    assert page(before=ids[1], limit=2) == (ids[:1], None)
+    assert page(before=ids[4], after=ids[1], limit=5) == (ids[2:4], None)
+
+    assert necsus.get('/api/messages', params={'room': TEST_ROOM, 'limit': 'lots'}).status_code == 400
+    assert necsus.get('/api/messages', params={'room': TEST_ROOM, 'limit': 0}).status_code == 400
+
+    # A limit above the maximum gets a page of the maximum, with the cursor leading on to the rest.
+    necsus.app.state.api_max_limit = 2
+    assert page(after=-1, limit=10**9) == (ids[:2], str(ids[1]))
+    assert page(limit=10**9) == (ids[3:], str(ids[3]))
+
+
+def test_streamed_listings(necsus: TestClient):
+    """Test that listings streamed a page at a time are byte-identical to sending the whole list in one response."""
+    db = necsus.app.state.db._write_db
+
+    for page_size in [1, 2, 500]:
+        necsus.app.state.api_page_size = page_size
+        assert necsus.get('/api/messages', params={'room': TEST_ROOM}).content == b'[]'
+        assert necsus.get('/api/bots', params={'format': 'ndjson'}).content == b''
+
+    for i in range(4):
+        necsus.post('/api/actions/message', json={'room': TEST_ROOM, 'author': TEST_AUTHOR, 'text': f'Message {i} ✓'})
+        necsus.post('/api/actions/bot', json={'room': f'{TEST_ROOM}{i % 2}', 'name': f'Bot {i}', 'url': f'http://bot/{i}'})
+
+    for page_size in [1, 2, 3, 500]:
+        necsus.app.state.api_page_size = page_size
+        response = necsus.get('/api/messages', params={'room': TEST_ROOM})
+        assert response.headers['content-type'] == 'application/json'
+        assert response.content == JSONResponse(db.messages.since(TEST_ROOM)).body
+
+        since_id = db.messages.since(TEST_ROOM)[0]['id']
+        response = necsus.get('/api/messages', params={'room': TEST_ROOM, 'since': since_id})
+        assert response.content == JSONResponse(db.messages.since(TEST_ROOM, since_id)).body
+
+        bots = [{**bot, 'breaker': 'closed'} for bot in db.bots.find_all()]
+        assert necsus.get('/api/bots').content == JSONResponse(bots).body
+
+        response = necsus.get('/api/bots', headers={'Accept': 'application/x-ndjson'})
+        assert response.headers['content-type'] == 'application/x-ndjson'
+        assert [json.loads(line) for line in response.text.splitlines()] == bots
+
+
+def test_websocket_initial_messages(necsus: TestClient):
+    """Test that a websocket connecting for the first time gets only the latest messages."""
+    necsus.app.state.websocket_initial_messages = 2
+    messages = [
+        necsus.post('/api/actions/message', json={'room': TEST_ROOM, 'author': TEST_AUTHOR, 'text': f'Message {i}'}).json()
+        for i in range(3)
+    ]
+
+    with necsus.websocket_connect(f'/ws/{TEST_ROOM}') as ws:
+        assert [ws.receive_json() for _ in range(2)] == [{'kind': 'message', 'data': message} for message in messages[1:]]
+
+        # New messages follow as usual.
+        message = necsus.post('/api/actions/message', json={'room': TEST_ROOM, 'author': TEST_AUTHOR, 'text': 'New'}).json()
+        assert ws.receive_json() == {'kind': 'message', 'data': message}